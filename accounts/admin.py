@@ -1,7 +1,8 @@
 from django.contrib import admin
 from .models import (
     Service, Invoice, InvoiceItem, Payment, MpesaPayment, 
-    ExpenseCategory, Expense, InventoryPurchase, SupplierInvoice, SupplierPayment, InvoiceItem
+    ExpenseCategory, Expense, InventoryPurchase, SupplierInvoice, SupplierPayment, InvoiceItem,
+    DailyRevenue, ClaimBatch
 )
 
 @admin.register(SupplierInvoice)
@@ -41,13 +42,14 @@ class InvoiceAdmin(admin.ModelAdmin):
     list_filter = ('status', 'created_at')
     search_fields = ('patient__first_name', 'patient__last_name')
     inlines = [InvoiceItemInline]
-    readonly_fields = ('total_amount', 'paid_amount', 'created_at', 'updated_at')
+    readonly_fields = ('total_amount', 'paid_amount', 'balance_due', 'created_at', 'updated_at')
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('id', 'invoice', 'amount', 'payment_method', 'transaction_reference', 'payment_date')
     list_filter = ('payment_method', 'payment_date')
     search_fields = ('invoice__id', 'transaction_reference')
+    readonly_fields = ('idempotency_key',)
 
 @admin.register(MpesaPayment)
 class MpesaPaymentAdmin(admin.ModelAdmin):
@@ -55,4 +57,17 @@ class MpesaPaymentAdmin(admin.ModelAdmin):
     list_filter = ('is_successful', 'created_at')
     search_fields = ('phone_number', 'mpesa_receipt_number', 'checkout_request_id')
 
+@admin.register(DailyRevenue)
+class DailyRevenueAdmin(admin.ModelAdmin):
+    list_display = ('date', 'payment_method', 'cashier', 'total', 'count')
+    list_filter = ('payment_method', 'date')
+    date_hierarchy = 'date'
+
+@admin.register(ClaimBatch)
+class ClaimBatchAdmin(admin.ModelAdmin):
+    list_display = ('reference', 'category', 'date_from', 'date_to', 'invoice_count', 'claimed_total', 'status', 'created_at')
+    list_filter = ('status', 'category')
+    search_fields = ('reference',)
+    readonly_fields = ('last_invoice_id', 'invoice_count', 'claimed_total', 'completed_at')
+
 admin.site.register(InvoiceItem)
\ No newline at end of file
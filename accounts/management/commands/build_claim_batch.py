@@ -0,0 +1,195 @@
+import csv
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from accounts.models import Invoice, InvoiceItem, Payment, DailyRevenue, ClaimBatch, allocate_fifo
+from accounts.utils import sha_claimable_invoices, SHA_VISIT_CATEGORIES
+from comms.utils import notify_pharmacy_queue
+from users.models import User
+
+CLAIM_HEADER = [
+    'Batch', 'Invoice #', 'Patient', 'ID Number', 'Category', 'Visit Date',
+    'Total', 'Insurance Adj.', 'Claim Amount',
+]
+
+
+def claim_category(visit):
+    if visit.visit_type == 'OUT-PATIENT':
+        return 'OPD'
+    return 'Maternity' if hasattr(visit, 'labor_delivery') else 'IPD'
+
+
+class Command(BaseCommand):
+    help = (
+        'Claims every eligible SHA invoice in a visit date range as one batch and streams the claim '
+        'lines to CSV. Re-running the same range resumes an interrupted batch from its checkpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', required=True, help='First visit date (YYYY-MM-DD), inclusive')
+        parser.add_argument('--to', dest='to_date', required=True, help='Last visit date (YYYY-MM-DD), inclusive')
+        parser.add_argument('--type', dest='category', default='all', choices=[c for c, _ in ClaimBatch.CATEGORY_CHOICES])
+        parser.add_argument('--cap', type=Decimal, help='Maximum claim per invoice; the excess is booked as insurance adjustment')
+        parser.add_argument('--output', '-o', help='Claim lines CSV (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Invoices claimed per transaction')
+        parser.add_argument('--user', help='ID number of the staff member the claims are recorded against (default: first superuser)')
+
+    def parse_date(self, value, label):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f"Invalid --{label} date '{value}', expected YYYY-MM-DD")
+
+    def handle(self, *args, **options):
+        date_from = self.parse_date(options['from_date'], 'from')
+        date_to = self.parse_date(options['to_date'], 'to')
+        if date_from > date_to:
+            raise CommandError('--from must not be after --to')
+
+        if options['user']:
+            user = User.objects.filter(id_number=options['user']).first()
+            if not user:
+                raise CommandError(f"No user with ID number '{options['user']}'")
+        else:
+            user = User.objects.filter(is_superuser=True).first()
+
+        category = options['category']
+        reference = f"SHA-{category.upper()}-{date_from:%Y%m%d}-{date_to:%Y%m%d}"
+        batch, created = ClaimBatch.objects.get_or_create(
+            reference=reference,
+            defaults={
+                'category': category,
+                'date_from': date_from,
+                'date_to': date_to,
+                'claim_cap': options['cap'],
+                'created_by': user,
+            }
+        )
+        if not created:
+            if batch.claim_cap != options['cap']:
+                self.stdout.write(self.style.WARNING(f"Keeping the original claim cap ({batch.claim_cap}) of {reference}"))
+            if batch.status == 'Running':
+                self.stdout.write(self.style.WARNING(
+                    f"Resuming {reference} after invoice #{batch.last_invoice_id} ({batch.invoice_count} already claimed)"
+                ))
+
+        if batch.status == 'Running':
+            self.claim(batch, user, options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                count = self.write_lines(f, batch)
+            self.stdout.write(self.style.SUCCESS(
+                f"{reference}: {batch.invoice_count} invoice(s), Ksh {batch.claimed_total} claimed; {count} lines written to {options['output']}"
+            ))
+        else:
+            self.write_lines(self.stdout, batch)
+
+    def eligible(self, batch):
+        category = batch.category if batch.category in SHA_VISIT_CATEGORIES else None
+        return sha_claimable_invoices(category).filter(
+            visit__visit_date__date__gte=batch.date_from,
+            visit__visit_date__date__lte=batch.date_to,
+        )
+
+    def claim(self, batch, user, chunk_size):
+        while True:
+            ids = list(
+                self.eligible(batch).filter(pk__gt=batch.last_invoice_id)
+                .order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+            # Each chunk and its checkpoint commit together
+            with transaction.atomic():
+                self.claim_chunk(batch, user, ids)
+
+        batch.status = 'Completed'
+        batch.completed_at = timezone.now()
+        batch.save(update_fields=['status', 'completed_at'])
+
+    def claim_chunk(self, batch, user, ids):
+        now = timezone.now()
+        # Re-check the balance under the row locks; a cashier may have settled some meanwhile
+        invoices = list(
+            Invoice.objects.select_for_update()
+            .filter(pk__in=ids, status__in=['Pending', 'Partial'], balance_due__gt=Decimal('0.01'))
+            .order_by('pk')
+        )
+
+        payments = []
+        for invoice in invoices:
+            balance = invoice.balance
+            if batch.claim_cap is not None and balance > batch.claim_cap:
+                invoice.insurance_adjustment += balance - batch.claim_cap
+                balance = batch.claim_cap
+            payments.append(Payment(
+                invoice=invoice,
+                amount=balance,
+                payment_method='Insurance',
+                transaction_reference=batch.reference,
+                notes=f"SHA claim batch {batch.reference}",
+                payment_date=now,
+                created_by=user,
+                idempotency_key=f"{batch.reference}:{invoice.pk}",
+            ))
+            invoice.paid_amount += balance
+            invoice.balance_due = invoice.balance
+            invoice.status = 'Paid'
+            invoice.updated_at = now
+        Payment.objects.bulk_create(payments, batch_size=500)
+
+        # FIFO allocation for every line of the chunk from one read and one bulk update
+        lines = defaultdict(list)
+        rows = InvoiceItem.objects.filter(invoice__in=invoices).order_by('invoice_id', 'created_at', 'id')
+        for invoice_id, item_id, amount, paid in rows.values_list('invoice_id', 'id', 'amount', 'paid_amount'):
+            lines[invoice_id].append((item_id, amount, paid))
+        changed = [
+            InvoiceItem(id=item_id, paid_amount=paid)
+            for invoice in invoices
+            for item_id, current, paid in allocate_fifo(invoice.paid_amount, lines[invoice.pk])
+            if current != paid
+        ]
+        InvoiceItem.objects.bulk_update(changed, ['paid_amount'], batch_size=500)
+        Invoice.objects.bulk_update(
+            invoices, ['insurance_adjustment', 'paid_amount', 'balance_due', 'status', 'updated_at'], batch_size=500
+        )
+        # Bulk writes skip update_totals, which is what unlocks dispensing on the pharmacy queue
+        notify_pharmacy_queue([invoice.visit_id for invoice in invoices])
+
+        claimed = sum((p.amount for p in payments), Decimal('0'))
+        if payments:
+            DailyRevenue.record(now, 'Insurance', user.pk if user else None, claimed, count=len(payments))
+
+        batch.last_invoice_id = ids[-1]
+        batch.invoice_count += len(payments)
+        batch.claimed_total += claimed
+        batch.save(update_fields=['last_invoice_id', 'invoice_count', 'claimed_total'])
+        self.stderr.write(f"{batch.reference}: claimed {batch.invoice_count} invoice(s) up to #{batch.last_invoice_id}")
+
+    def write_lines(self, stream, batch):
+        """Claim lines are read back from the batch's payments, so a resumed run writes the full batch"""
+        writer = csv.writer(stream)
+        writer.writerow(CLAIM_HEADER)
+        payments = Payment.objects.filter(
+            transaction_reference=batch.reference, payment_method='Insurance'
+        ).select_related('invoice__patient', 'invoice__visit__labor_delivery').order_by('invoice_id')
+        count = 0
+        for payment in payments.iterator(chunk_size=2000):
+            invoice = payment.invoice
+            writer.writerow([
+                batch.reference,
+                f"INV-{invoice.id}",
+                invoice.patient.full_name if invoice.patient else '',
+                invoice.patient.id_number if invoice.patient else '',
+                claim_category(invoice.visit),
+                invoice.visit.visit_date.strftime('%Y-%m-%d'),
+                invoice.total_amount,
+                invoice.insurance_adjustment,
+                payment.amount,
+            ])
+            count += 1
+        return count
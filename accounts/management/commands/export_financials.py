@@ -0,0 +1,73 @@
+import csv
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from accounts.models import Payment, Invoice, Expense, SupplierInvoice, DailyRevenue
+from accounts.utils import financial_report_rows
+
+
+class Command(BaseCommand):
+    help = 'Streams the full financial report (payments, invoices, expenses) for a date range to CSV, e.g. for month-end close'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', help='Start date (YYYY-MM-DD), inclusive')
+        parser.add_argument('--to', dest='to_date', help='End date (YYYY-MM-DD), inclusive')
+        parser.add_argument('--output', '-o', help='Output file (default: stdout)')
+
+    def parse_date(self, value, label):
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f"Invalid --{label} date '{value}', expected YYYY-MM-DD")
+
+    def handle(self, *args, **options):
+        from_date = self.parse_date(options['from_date'], 'from')
+        to_date = self.parse_date(options['to_date'], 'to')
+
+        payments = Payment.objects.all()
+        invoices = Invoice.objects.all()
+        expenses = Expense.objects.all()
+        supplier_invoices = SupplierInvoice.objects.all()
+        revenue = DailyRevenue.objects.all()
+
+        if from_date:
+            payments = payments.filter(payment_date__date__gte=from_date)
+            invoices = invoices.filter(created_at__date__gte=from_date)
+            expenses = expenses.filter(date__gte=from_date)
+            supplier_invoices = supplier_invoices.filter(date__gte=from_date)
+            revenue = revenue.filter(date__gte=from_date)
+        if to_date:
+            payments = payments.filter(payment_date__date__lte=to_date)
+            invoices = invoices.filter(created_at__date__lte=to_date)
+            expenses = expenses.filter(date__lte=to_date)
+            supplier_invoices = supplier_invoices.filter(date__lte=to_date)
+            revenue = revenue.filter(date__lte=to_date)
+
+        # Same basis as the accountant dashboard
+        total_revenue = revenue.aggregate(Sum('total'))['total__sum'] or 0
+        total_general_expenses = expenses.aggregate(Sum('amount'))['amount__sum'] or 0
+        total_invoice_debt = supplier_invoices.aggregate(Sum('total_amount'))['total_amount__sum'] or 0
+        total_expenses = total_general_expenses + total_invoice_debt
+        payment_methods = revenue.values('payment_method').annotate(
+            total=Sum('total'),
+            count=Sum('count')
+        ).order_by('-total')
+
+        rows = financial_report_rows(payments, invoices, expenses, total_revenue, total_expenses, payment_methods)
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                count = self.write_rows(f, rows)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {count} rows to {options['output']}"))
+        else:
+            self.write_rows(self.stdout, rows)
+
+    def write_rows(self, stream, rows):
+        writer = csv.writer(stream)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
@@ -1,128 +1,188 @@
+from collections import defaultdict
+from datetime import timedelta
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Min
+from django.db.models.functions import TruncDate
 from inpatient.models import Admission, ServiceAdmissionLink
-from morgue.models import Deceased, PerformedMortuaryService, MorgueAdmission
+from morgue.models import Deceased, PerformedMortuaryService
 from accounts.models import Service, Invoice, InvoiceItem
 from accounts.utils import get_or_create_invoice
 from users.models import User
 
+
+def missing_dates(start_date, end_date, charged_dates):
+    """Days between start_date and end_date (inclusive) that have not been charged yet"""
+    days = (end_date - start_date).days + 1
+    return [
+        day for day in (start_date + timedelta(days=i) for i in range(max(days, 0)))
+        if day not in charged_dates
+    ]
+
+
+def start_of_day(day):
+    return timezone.make_aware(timezone.datetime.combine(day, timezone.datetime.min.time()))
+
+
 class Command(BaseCommand):
     help = 'Processes daily bed charges for inpatients and storage fees for the morgue'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report missing charges without writing anything')
+
     def handle(self, *args, **options):
-        self.stdout.write(self.style.SUCCESS('Starting daily charges processing...'))
-        
+        self.dry_run = options['dry_run']
+        self.stdout.write(self.style.SUCCESS('Starting daily charges processing...' + (' (dry run)' if self.dry_run else '')))
+
         # System user for automated actions
         system_user = User.objects.filter(is_superuser=True).first()
-        today = timezone.now().date()
-        
-        self.process_inpatient_charges(today, system_user)
-        self.process_morgue_charges(today, system_user)
-        
+        today = timezone.localdate()
+
+        ipd_days, ipd_amount = self.process_inpatient_charges(today, system_user)
+        morgue_days, morgue_amount = self.process_morgue_charges(today, system_user)
+
+        verb = 'Would charge' if self.dry_run else 'Charged'
+        self.stdout.write(f"{verb} {ipd_days} inpatient day(s) (Ksh {ipd_amount}) and {morgue_days} morgue day(s) (Ksh {morgue_amount}).")
         self.stdout.write(self.style.SUCCESS('Daily charges processing completed.'))
 
-    def process_inpatient_charges(self, today, system_user):
-        active_admissions = Admission.objects.filter(status='Admitted').select_related('bed', 'bed__ward', 'visit', 'patient')
-        from datetime import timedelta
-        
-        for admission in active_admissions:
-            if not admission.bed:
-                continue
-                
-            ward = admission.bed.ward
-            # Try to find a matching service in the 'Admission' category
-            # We'll try to match ward name or ward type
-            service = Service.objects.filter(
+    def resolve_bed_service(self, ward, cache):
+        """Bed charge service for a ward type, resolved once per ward type per run"""
+        if ward.ward_type not in cache:
+            # Try to match ward type, then fall back to general ward / bed services
+            cache[ward.ward_type] = Service.objects.filter(
                 Q(name__icontains=ward.ward_type) & Q(department__name='Inpatient')
             ).first() or Service.objects.filter(
                 Q(name__icontains='General Ward') & Q(department__name='Inpatient')
             ).first() or Service.objects.filter(
                 Q(name__icontains='Bed') & Q(department__name='Inpatient')
             ).first()
+        return cache[ward.ward_type]
+
+    def report(self, label, name, service, dates):
+        verb = 'Would charge' if self.dry_run else 'Charged'
+        span = f"{dates[0]}" if len(dates) == 1 else f"{dates[0]} .. {dates[-1]}"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {len(dates)} day(s) of {service.name} ({span}) to {label} {name}"
+        ))
+
+    def process_inpatient_charges(self, today, system_user):
+        active_admissions = list(
+            Admission.objects.filter(status='Admitted', bed__isnull=False)
+            .select_related('bed', 'bed__ward', 'visit', 'patient')
+        )
+        service_cache = {}
+        plan = []
 
+        for admission in active_admissions:
+            ward = admission.bed.ward
+            service = self.resolve_bed_service(ward, service_cache)
             if not service:
                 self.stdout.write(self.style.WARNING(f"No suitable bed charge service found for ward {ward.name} ({ward.ward_type})"))
                 continue
+            plan.append((admission, service))
+
+        # Every date already charged, for all admissions, in one query
+        charged = defaultdict(set)
+        rows = ServiceAdmissionLink.objects.filter(
+            admission__in=[admission for admission, _ in plan],
+            service__in={service.id for _, service in plan},
+        ).annotate(day=TruncDate('date_provided')).values_list('admission_id', 'service_id', 'day')
+        for admission_id, service_id, day in rows:
+            charged[(admission_id, service_id)].add(day)
+
+        total_days, total_amount = 0, 0
+        links = []
+        lines_by_visit = defaultdict(list)
+        for admission, service in plan:
+            start_date = timezone.localdate(admission.admitted_at)
+            dates = missing_dates(start_date, today, charged[(admission.id, service.id)])
+            if not dates:
+                continue
 
-            # Catch up logic: Check every day from admitted_at to today
-            start_date = admission.admitted_at.date()
-            current_date = start_date
-            
-            while current_date <= today:
-                already_charged = ServiceAdmissionLink.objects.filter(
+            self.report('patient', admission.patient.full_name, service, dates)
+            total_days += len(dates)
+            total_amount += len(dates) * service.price
+            for day in dates:
+                links.append(ServiceAdmissionLink(
                     admission=admission,
                     service=service,
-                    date_provided__date=current_date
-                ).exists()
-
-                if not already_charged:
-                    with transaction.atomic():
-                        ServiceAdmissionLink.objects.create(
-                            admission=admission,
-                            service=service,
-                            quantity=1,
-                            date_provided=timezone.make_aware(timezone.datetime.combine(current_date, timezone.datetime.min.time())),
-                            provided_by=system_user
-                        )
-                        
-                        invoice = get_or_create_invoice(visit=admission.visit, user=system_user)
-                        
-                        InvoiceItem.objects.create(
-                            invoice=invoice,
-                            service=service,
-                            name=f"{service.name} - {current_date}",
-                            quantity=1,
-                            unit_price=service.price
-                        )
-                        invoice.update_totals()
-                    self.stdout.write(self.style.SUCCESS(f"Charged {service.name} for {current_date} to {admission.patient.full_name}"))
-                
-                current_date += timedelta(days=1)
+                    quantity=1,
+                    date_provided=start_of_day(day),
+                    provided_by=system_user
+                ))
+                lines_by_visit[admission.visit].append(InvoiceItem(
+                    service=service,
+                    name=f"{service.name} - {day}",
+                    quantity=1,
+                    unit_price=service.price
+                ))
+
+        if links and not self.dry_run:
+            with transaction.atomic():
+                ServiceAdmissionLink.objects.bulk_create(links, batch_size=500)
+                existing = {inv.visit_id: inv for inv in Invoice.objects.filter(visit__in=list(lines_by_visit))}
+                for visit, lines in lines_by_visit.items():
+                    invoice = existing.get(visit.id) or get_or_create_invoice(visit=visit, user=system_user)
+                    # One bulk insert and one totals recalculation per invoice
+                    invoice.add_items(lines)
+
+        return total_days, total_amount
 
     def process_morgue_charges(self, today, system_user):
-        active_deceased = Deceased.objects.filter(is_released=False)
         storage_service = Service.objects.filter(name__icontains='Storage', department__name='Morgue').first()
-        from datetime import timedelta
 
         if not storage_service:
             self.stdout.write(self.style.WARNING("Daily Storage Fee (Morgue) service not found"))
-            return
+            return 0, 0
 
+        active_deceased = list(
+            Deceased.objects.filter(is_released=False)
+            .annotate(first_admitted_at=Min('admissions__admission_datetime'))
+        )
+
+        # Every date already charged, for all deceased, in one query
+        charged = defaultdict(set)
+        rows = PerformedMortuaryService.objects.filter(
+            deceased__in=active_deceased,
+            service=storage_service,
+        ).annotate(day=TruncDate('date_performed')).values_list('deceased_id', 'day')
+        for deceased_id, day in rows:
+            charged[deceased_id].add(day)
+
+        total_days, total_amount = 0, 0
+        performed = []
+        lines_by_deceased = defaultdict(list)
         for deceased in active_deceased:
-            # Check every day from admission to today
-            admission_record = deceased.admissions.order_by('admission_datetime').first()
-            start_date = admission_record.admission_datetime.date() if admission_record else deceased.created_at.date()
-            current_date = start_date
-            
-            while current_date <= today:
-                already_charged = PerformedMortuaryService.objects.filter(
+            # Charge every day from the first admission (or registration) to today
+            start_date = timezone.localdate(deceased.first_admitted_at or deceased.created_at)
+            dates = missing_dates(start_date, today, charged[deceased.id])
+            if not dates:
+                continue
+
+            self.report('deceased', deceased.full_name, storage_service, dates)
+            total_days += len(dates)
+            total_amount += len(dates) * storage_service.price
+            for day in dates:
+                performed.append(PerformedMortuaryService(
                     deceased=deceased,
                     service=storage_service,
-                    date_performed__date=current_date
-                ).exists()
-
-                if not already_charged:
-                    with transaction.atomic():
-                        PerformedMortuaryService.objects.create(
-                            deceased=deceased,
-                            service=storage_service,
-                            quantity=1,
-                            date_performed=timezone.make_aware(timezone.datetime.combine(current_date, timezone.datetime.min.time())),
-                            performed_by=system_user
-                        )
-                        
-                        invoice = get_or_create_invoice(deceased=deceased, user=system_user)
-                        
-                        InvoiceItem.objects.create(
-                            invoice=invoice,
-                            service=storage_service,
-                            name=f"{storage_service.name} - {current_date}",
-                            quantity=1,
-                            unit_price=storage_service.price
-                        )
-                        invoice.update_totals()
-                    self.stdout.write(self.style.SUCCESS(f"Charged {storage_service.name} for {current_date} to {deceased.full_name}"))
-                
-                current_date += timedelta(days=1)
+                    quantity=1,
+                    date_performed=start_of_day(day),
+                    performed_by=system_user
+                ))
+                lines_by_deceased[deceased].append(InvoiceItem(
+                    service=storage_service,
+                    name=f"{storage_service.name} - {day}",
+                    quantity=1,
+                    unit_price=storage_service.price
+                ))
+
+        if performed and not self.dry_run:
+            with transaction.atomic():
+                PerformedMortuaryService.objects.bulk_create(performed, batch_size=500)
+                for deceased, lines in lines_by_deceased.items():
+                    invoice = get_or_create_invoice(deceased=deceased, user=system_user)
+                    invoice.add_items(lines)
+
+        return total_days, total_amount
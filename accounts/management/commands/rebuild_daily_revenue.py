@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from accounts.models import Payment, DailyRevenue
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily revenue rollup (per day, payment method and cashier) from the Payment table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Only rebuild the last N days (default: full history)')
+
+    def handle(self, *args, **options):
+        payments = Payment.objects.all()
+        rollup = DailyRevenue.objects.all()
+
+        if options['days']:
+            since = timezone.localdate() - timezone.timedelta(days=options['days'])
+            payments = payments.filter(payment_date__date__gte=since)
+            rollup = rollup.filter(date__gte=since)
+
+        buckets = payments.annotate(day=TruncDate('payment_date')).values(
+            'day', 'payment_method', 'created_by_id'
+        ).annotate(total=Sum('amount'), count=Count('id')).order_by()
+
+        with transaction.atomic():
+            deleted, _ = rollup.delete()
+            created = DailyRevenue.objects.bulk_create([
+                DailyRevenue(
+                    date=b['day'],
+                    payment_method=b['payment_method'],
+                    cashier_id=b['created_by_id'],
+                    cashier_key=b['created_by_id'] or 0,
+                    total=b['total'],
+                    count=b['count'],
+                )
+                for b in buckets.iterator()
+            ], batch_size=500)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Daily revenue rebuilt: {deleted} old rows replaced by {len(created)} rows.'
+        ))
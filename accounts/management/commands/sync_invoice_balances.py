@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from accounts.models import Invoice
+
+
+class Command(BaseCommand):
+    help = 'Backfills/repairs the stored Invoice.balance_due column (total - insurance adjustment - paid)'
+
+    def handle(self, *args, **options):
+        expected = F('total_amount') - F('insurance_adjustment') - F('paid_amount')
+        updated = Invoice.objects.exclude(balance_due=expected).update(balance_due=expected)
+        self.stdout.write(self.style.SUCCESS(f'Invoice balances synced: {updated} invoices corrected.'))
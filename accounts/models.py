@@ -1,6 +1,34 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from decimal import Decimal
+from contextlib import contextmanager
+import threading
+
+# Invoices whose totals recalculation is deferred on the current thread
+_invoice_batch = threading.local()
+
+
+@contextmanager
+def deferred_invoice_totals():
+    """
+    Coalesces invoice total recalculation for bulk line-item work.
+    Inside the block InvoiceItem.save and Invoice.add_items only record the
+    invoices they touch; each is recalculated once when the outermost block
+    exits. Can also be used as a view/function decorator.
+    """
+    if getattr(_invoice_batch, 'pending', None) is not None:
+        yield
+        return
+
+    _invoice_batch.pending = pending = {}
+    try:
+        yield
+    finally:
+        _invoice_batch.pending = None
+
+    for invoice in pending.values():
+        invoice.update_totals()
+
 
 class Service(models.Model):
     CATEGORY_CHOICES = [
@@ -51,11 +79,18 @@ class Invoice(models.Model):
     total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     insurance_adjustment = models.DecimalField(max_digits=12, decimal_places=2, default=0, help_text="Per-diem shortfall absorbed by facility for insurance patients")
     paid_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    balance_due = models.DecimalField(max_digits=12, decimal_places=2, default=0, db_index=True, editable=False, help_text="Stored total_amount - insurance_adjustment - paid_amount, kept in sync on save")
     due_date = models.DateField(null=True, blank=True)
     notes = models.TextField(blank=True, null=True, help_text="Additional notes or reference information")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey('users.User', on_delete=models.SET_NULL, null=True, related_name='created_invoices')
+    discharge_sync_mark = models.CharField(max_length=100, blank=True, default='', editable=False, help_text="Watermark of the services/medications last synced onto this discharge invoice")
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'balance_due'], name='invoice_status_balance_idx'),
+        ]
     
     def __str__(self):
         if self.deceased:
@@ -71,22 +106,79 @@ class Invoice(models.Model):
         if self.patient and self.deceased:
             raise ValidationError("Invoice cannot be linked to both patient and deceased.")
     
-    def update_totals(self):
-        """Recalculate total amount linked to this invoice"""
-        total = self.items.aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
-        self.total_amount = total
-        
-        # Determine status based on effective amount (after insurance adjustment)
-        effective = self.effective_amount
-        if self.paid_amount >= effective:
-            self.status = 'Paid'
-        elif self.paid_amount > 0:
-            self.status = 'Partial'
-        elif self.status != 'Cancelled':
-            self.status = 'Pending'
+    def save(self, *args, **kwargs):
+        # Keep the stored (indexed) balance in step with the amounts it derives from
+        self.balance_due = (
+            Decimal(str(self.total_amount)) - Decimal(str(self.insurance_adjustment)) - Decimal(str(self.paid_amount))
+        )
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'balance_due' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['balance_due']
+        super().save(*args, **kwargs)
+    
+    def update_totals(self, paid_amount=None):
+        """
+        Recalculate total amount linked to this invoice.
+        Runs under a row lock and only writes the derived columns, so a
+        concurrent posting cannot be overwritten by a stale instance.
+        """
+        with transaction.atomic(savepoint=False):
+            current = Invoice.objects.select_for_update().values(
+                'paid_amount', 'insurance_adjustment', 'status'
+            ).get(pk=self.pk)
+            self.paid_amount = current['paid_amount'] if paid_amount is None else paid_amount
+            self.insurance_adjustment = current['insurance_adjustment']
+            self.status = current['status']
+
+            total = self.items.aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
+            self.total_amount = total
             
-        self.save()
+            # Determine status based on effective amount (after insurance adjustment)
+            effective = self.effective_amount
+            if self.paid_amount >= effective:
+                self.status = 'Paid'
+            elif self.paid_amount > 0:
+                self.status = 'Partial'
+            elif self.status != 'Cancelled':
+                self.status = 'Pending'
+                
+            self.save(update_fields=['total_amount', 'paid_amount', 'status', 'updated_at'])
+
+        if self.status != current['status'] and self.visit_id:
+            # Payment unlocks dispensing on the pharmacy queue
+            from comms.utils import notify_pharmacy_queue
+            notify_pharmacy_queue([self.visit_id])
+
+    def lock(self):
+        """Take a row lock on this invoice for the rest of the current transaction"""
+        Invoice.objects.select_for_update().filter(pk=self.pk).values_list('pk', flat=True).get()
     
+    def items_changed(self):
+        """Recalculate totals now, or once at the end of a deferred_invoice_totals block"""
+        pending = getattr(_invoice_batch, 'pending', None)
+        if pending is None:
+            self.update_totals()
+        else:
+            pending[self.pk] = self
+
+    def add_items(self, items):
+        """
+        Bulk-creates unsaved InvoiceItem instances on this invoice and
+        recalculates totals once instead of once per line.
+        """
+        items = list(items)
+        for item in items:
+            item.invoice = self
+            item.amount = item.quantity * item.unit_price
+        created = InvoiceItem.objects.bulk_create(items)
+        # bulk_create skips the save() signals that keep the visit fulfilment ledger
+        from inventory.models import VisitFulfilment
+        VisitFulfilment.record('billed', [
+            (self.visit_id, item.inventory_item_id, item.quantity) for item in items
+        ])
+        self.items_changed()
+        return created
+
     @property
     def effective_amount(self):
         """Amount the hospital expects to collect (after insurance adjustment)"""
@@ -100,28 +192,62 @@ class Invoice(models.Model):
     def distribute_payments(self):
         """
         Distributes the total paid amount across invoice items using FIFO logic.
+        The split is computed in one pass and only items whose allocation
+        changed are written back, in a single bulk UPDATE.
         """
         total_paid = self.payments.aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
-        self.paid_amount = total_paid
-        
-        remaining_pool = total_paid
-        items = self.items.all().order_by('created_at')
         
-        for item in items:
-            if remaining_pool <= 0:
-                item.paid_amount = 0
-            elif remaining_pool >= item.amount:
-                item.paid_amount = item.amount
-                remaining_pool -= item.amount
-            else:
-                item.paid_amount = remaining_pool
-                remaining_pool = 0
-            
-            # Using update to avoid recursive save calls
-            self.items.filter(id=item.id).update(paid_amount=item.paid_amount)
+        rows = self.items.order_by('created_at', 'id').values_list('id', 'amount', 'paid_amount')
+        changed = [
+            InvoiceItem(id=item_id, paid_amount=paid)
+            for item_id, current, paid in allocate_fifo(total_paid, rows)
+            if current != paid
+        ]
+        if changed:
+            InvoiceItem.objects.bulk_update(changed, ['paid_amount'])
         
         # After distributing, update the status without triggering distribute again
-        self.update_totals()
+        self.update_totals(paid_amount=total_paid)
+
+
+def allocate_fifo(pool, rows):
+    """
+    Splits a paid amount across (id, amount, paid_amount) rows in order.
+    Yields (id, current_paid, new_paid) for every row.
+    """
+    remaining_pool = pool
+    for item_id, amount, current in rows:
+        if remaining_pool <= 0:
+            paid = Decimal('0')
+        elif remaining_pool >= amount:
+            paid = amount
+            remaining_pool -= amount
+        else:
+            paid = remaining_pool
+            remaining_pool = Decimal('0')
+        yield item_id, current, paid
+
+
+class InvoiceItemQuerySet(models.QuerySet):
+    def with_fulfilment_status(self):
+        """
+        Annotates the dispensed / completed-service flags of every line in
+        the same query (EXISTS subqueries over DispensedItem and LabResult),
+        instead of one query per line through is_dispensed / is_completed_service.
+        """
+        from inventory.models import DispensedItem
+        from lab.models import LabResult
+        return self.annotate(
+            dispensed_status=models.Exists(DispensedItem.objects.filter(
+                visit=models.OuterRef('invoice__visit'),
+                item=models.OuterRef('inventory_item'),
+                quantity=models.OuterRef('quantity')
+            )),
+            completed_service_status=models.Exists(LabResult.objects.filter(
+                invoice_item=models.OuterRef('pk'),
+                status='Completed'
+            )),
+        )
 
 
 class InvoiceItem(models.Model):
@@ -138,6 +264,13 @@ class InvoiceItem(models.Model):
     created_by = models.ForeignKey('users.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='created_invoice_items')
     paid_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
 
+    objects = InvoiceItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='invoiceitem_created_idx'),
+        ]
+
     @property
     def balance(self):
         return self.amount - self.paid_amount
@@ -151,8 +284,11 @@ class InvoiceItem(models.Model):
         """
         Checks if this item has been physically dispensed.
         Matches by inventory_item, visit, and quantity.
+        Uses the with_fulfilment_status() annotation when present.
         """
-        if not self.inventory_item or not self.invoice.visit:
+        if hasattr(self, 'dispensed_status'):
+            return self.dispensed_status
+        if not self.inventory_item_id or not self.invoice.visit_id:
             return False
             
         from inventory.models import DispensedItem
@@ -167,8 +303,11 @@ class InvoiceItem(models.Model):
         """
         Checks if this item represents a service that has been completed 
         (e.g., a lab test marked as Completed).
+        Uses the with_fulfilment_status() annotation when present.
         """
-        if self.service and hasattr(self, 'labresult_set') and self.labresult_set.filter(status='Completed').exists():
+        if hasattr(self, 'completed_service_status'):
+            return bool(self.service_id and self.completed_service_status)
+        if self.service_id and hasattr(self, 'labresult_set') and self.labresult_set.filter(status='Completed').exists():
             return True
         return False
 
@@ -176,8 +315,8 @@ class InvoiceItem(models.Model):
         # Auto-calculate amount
         self.amount = self.quantity * self.unit_price
         super().save(*args, **kwargs)
-        # Update parent invoice totals
-        self.invoice.update_totals()
+        # Update parent invoice totals (coalesced inside deferred_invoice_totals)
+        self.invoice.items_changed()
 
     def __str__(self):
         return f"{self.name} x{self.quantity}"
@@ -200,18 +339,33 @@ class Payment(models.Model):
     notes = models.TextField(blank=True, null=True)
     payment_date = models.DateTimeField(default=timezone.now)
     created_by = models.ForeignKey('users.User', on_delete=models.SET_NULL, null=True)
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False, help_text="Client-generated key so a repeated submit is not posted twice")
     
     def save(self, *args, **kwargs):
-        is_new = self.pk is None
-        super().save(*args, **kwargs)
-        
-        # Distribute payment to invoice items (FIFO)
-        self.invoice.distribute_payments()
-        
-        # Updates invoice paid amount
-        total_paid = self.invoice.payments.aggregate(total=models.Sum('amount'))['total'] or 0
-        self.invoice.paid_amount = total_paid
-        self.invoice.update_totals()
+        with transaction.atomic(savepoint=False):
+            # Postings against the same invoice queue on its row lock, so
+            # allocation and status are always computed from every payment
+            self.invoice.lock()
+
+            is_new = self.pk is None
+            previous = None
+            if not is_new:
+                previous = Payment.objects.filter(pk=self.pk).values(
+                    'payment_date', 'payment_method', 'created_by_id', 'amount'
+                ).first()
+            super().save(*args, **kwargs)
+            
+            # Keep the daily revenue rollup current (reverse the old figures on edit)
+            if previous:
+                DailyRevenue.record(
+                    previous['payment_date'], previous['payment_method'],
+                    previous['created_by_id'], -previous['amount'], count=-1
+                )
+            DailyRevenue.record(self.payment_date, self.payment_method, self.created_by_id, self.amount)
+            
+            # Distribute payment to invoice items (FIFO). This also refreshes the
+            # invoice paid amount, totals and status exactly once.
+            self.invoice.distribute_payments()
 
     def __str__(self):
         return f"Payment {self.id} - {self.payment_method} - {self.amount}"
@@ -220,6 +374,86 @@ class Payment(models.Model):
         ordering = ['-payment_date']
 
 
+class DailyRevenue(models.Model):
+    """
+    Daily revenue rollup per payment method and cashier.
+    Maintained by Payment.save and payment deletion; rebuild with
+    `python manage.py rebuild_daily_revenue`.
+    """
+    date = models.DateField()
+    payment_method = models.CharField(max_length=20, choices=Payment.PAYMENT_METHOD_CHOICES)
+    cashier = models.ForeignKey('users.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_revenue')
+    # The bucket key: cashier may be NULL, and NULLs never clash in a unique constraint
+    cashier_key = models.PositiveIntegerField(default=0, editable=False, help_text="Cashier id, or 0 for payments without one")
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('date', 'payment_method', 'cashier_key')
+        ordering = ['-date']
+        verbose_name = "Daily Revenue"
+        verbose_name_plural = "Daily Revenue"
+
+    def __str__(self):
+        return f"{self.date} - {self.payment_method} - {self.total}"
+
+    @classmethod
+    def record(cls, payment_date, payment_method, cashier_id, amount, count=1):
+        """Add (or with negative values, remove) a payment from its day's bucket"""
+        cls.add(timezone.localdate(payment_date), payment_method, cashier_id, amount, count)
+
+    @classmethod
+    def add(cls, date, payment_method, cashier_id, amount, count):
+        row, _ = cls.objects.get_or_create(
+            date=date,
+            payment_method=payment_method,
+            cashier_key=cashier_id or 0,
+            defaults={'cashier_id': cashier_id},
+        )
+        cls.objects.filter(pk=row.pk).update(
+            total=models.F('total') + Decimal(str(amount)),
+            count=models.F('count') + count,
+        )
+
+
+class ClaimBatch(models.Model):
+    """
+    A month-end SHA claim run built by `python manage.py build_claim_batch`.
+    last_invoice_id is the checkpoint: invoices are claimed in id order, one
+    committed chunk at a time, so a crashed run continues where it stopped.
+    """
+    CATEGORY_CHOICES = [
+        ('all', 'All'),
+        ('opd', 'OPD'),
+        ('ipd', 'IPD'),
+        ('maternity', 'Maternity'),
+    ]
+    STATUS_CHOICES = [
+        ('Running', 'Running'),
+        ('Completed', 'Completed'),
+    ]
+
+    reference = models.CharField(max_length=50, unique=True, help_text="Claim batch reference, also stored on each claim payment")
+    category = models.CharField(max_length=20, choices=CATEGORY_CHOICES, default='all')
+    date_from = models.DateField()
+    date_to = models.DateField()
+    claim_cap = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True, help_text="Maximum claim per invoice; the excess becomes insurance adjustment")
+    last_invoice_id = models.PositiveIntegerField(default=0)
+    invoice_count = models.IntegerField(default=0)
+    claimed_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Running')
+    created_by = models.ForeignKey('users.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='claim_batches')
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name_plural = "Claim Batches"
+
+    def __str__(self):
+        return f"{self.reference} ({self.status})"
+
+
 class PatientCredit(models.Model):
     """
     Tracks credit or refunds owed to a patient due to overpayment 
@@ -393,3 +627,26 @@ class InventoryPurchase(models.Model):
         verbose_name = "Goods Received Note"
         verbose_name_plural = "Goods Received Notes"
         ordering = ['-date', '-created_at']
+
+
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+@receiver(post_delete, sender=Payment)
+def remove_payment_from_daily_revenue(sender, instance, **kwargs):
+    """Keep the daily revenue rollup in step when a payment is deleted (incl. cascades)"""
+    DailyRevenue.record(instance.payment_date, instance.payment_method, instance.created_by_id, -instance.amount, count=-1)
+
+@receiver(post_delete, sender=InvoiceItem)
+def clear_discharge_sync_mark(sender, instance, **kwargs):
+    """The watermark only follows the sources, so a removed line must force the next discharge sync to run"""
+    Invoice.objects.filter(pk=instance.invoice_id).exclude(discharge_sync_mark='').update(discharge_sync_mark='')
+
+@receiver(pre_delete, sender='users.User')
+def fold_deleted_cashier_into_daily_revenue(sender, instance, **kwargs):
+    """A deleted cashier's payments lose their cashier, so their buckets join those of payments without one"""
+    with transaction.atomic():
+        rows = list(DailyRevenue.objects.select_for_update().filter(cashier_key=instance.pk))
+        for row in rows:
+            DailyRevenue.add(row.date, row.payment_method, None, row.total, row.count)
+        DailyRevenue.objects.filter(pk__in=[row.pk for row in rows]).delete()
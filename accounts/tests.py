@@ -1,3 +1,443 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+from unittest import mock
+from io import StringIO
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Sum
+from django.utils import timezone
+
+from home.models import Patient, Visit, Departments
+from inpatient.models import Ward, Bed, Admission, ServiceAdmissionLink
+from inventory.models import InventoryCategory, InventoryItem, DispensedItem
+from lab.models import LabResult
+from users.models import User
+from .models import Service, Invoice, InvoiceItem, Payment, DailyRevenue, ClaimBatch, allocate_fifo, deferred_invoice_totals
+from .utils import post_payment, sync_discharge_invoice
+
+
+class BillingTestMixin:
+    def setUp(self):
+        self.user = User.objects.create_user(id_number='CASH001', password='password', role='Receptionist')
+        self.patient = Patient.objects.create(
+            first_name='John',
+            last_name='Doe',
+            date_of_birth=timezone.now().date() - timezone.timedelta(days=365 * 30),
+            phone='0712345678',
+            location='Nairobi',
+            gender='M'
+        )
+        self.visit = Visit.objects.create(patient=self.patient, visit_type='IN-PATIENT', visit_mode='Walk In')
+        self.invoice = Invoice.objects.create(patient=self.patient, visit=self.visit, created_by=self.user)
+
+    def add_lines(self, count, unit_price=100):
+        InvoiceItem.objects.bulk_create([
+            InvoiceItem(invoice=self.invoice, name=f'Bed Charge - Day {i}', quantity=1,
+                        unit_price=unit_price, amount=unit_price)
+            for i in range(count)
+        ])
+        self.invoice.update_totals()
+
+
+class AllocateFifoTest(TestCase):
+    def test_splits_pool_in_order(self):
+        rows = [(1, Decimal('100'), Decimal('0')), (2, Decimal('50'), Decimal('0')), (3, Decimal('80'), Decimal('0'))]
+        result = list(allocate_fifo(Decimal('120'), rows))
+        self.assertEqual([paid for _, _, paid in result], [Decimal('100'), Decimal('20'), Decimal('0')])
+
+    def test_reports_current_paid_for_change_detection(self):
+        rows = [(1, Decimal('100'), Decimal('100')), (2, Decimal('50'), Decimal('10'))]
+        result = list(allocate_fifo(Decimal('110'), rows))
+        self.assertEqual(result, [(1, Decimal('100'), Decimal('100')), (2, Decimal('10'), Decimal('10'))])
+
+
+class DistributePaymentsTest(BillingTestMixin, TestCase):
+    def test_payment_allocates_fifo_and_sets_status(self):
+        self.add_lines(3)
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('150'), payment_method='Cash', created_by=self.user)
+
+        self.invoice.refresh_from_db()
+        paid = list(self.invoice.items.order_by('created_at', 'id').values_list('paid_amount', flat=True))
+        self.assertEqual(paid, [Decimal('100'), Decimal('50'), Decimal('0')])
+        self.assertEqual(self.invoice.paid_amount, Decimal('150'))
+        self.assertEqual(self.invoice.status, 'Partial')
+
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('150'), payment_method='M-Pesa', created_by=self.user)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.status, 'Paid')
+        self.assertFalse(self.invoice.items.filter(paid_amount__lt=Decimal('100')).exists())
+
+    def test_query_count_does_not_grow_with_lines(self):
+        self.add_lines(1000)
+        payment = Payment(invoice=self.invoice, amount=Decimal('55000'), payment_method='M-Pesa', created_by=self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            payment.save()
+        # insert + sum + item read + batched update(s) + totals sum + invoice save
+        self.assertLess(len(ctx.captured_queries), 15)
+        self.assertEqual(self.invoice.items.filter(paid_amount=Decimal('100')).count(), 550)
+
+
+class DeferredTotalsTest(BillingTestMixin, TestCase):
+    def test_add_items_bulk_creates_and_recalculates_once(self):
+        lines = [InvoiceItem(name=f'Drug {i}', quantity=2, unit_price=Decimal('50')) for i in range(20)]
+        with CaptureQueriesContext(connection) as ctx:
+            self.invoice.add_items(lines)
+        self.assertLess(len(ctx.captured_queries), 5)
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.items.count(), 20)
+        self.assertEqual(self.invoice.total_amount, Decimal('2000'))
+        self.assertEqual(self.invoice.status, 'Pending')
+
+    def test_deferred_block_coalesces_item_saves(self):
+        with deferred_invoice_totals():
+            for i in range(5):
+                InvoiceItem.objects.create(invoice=self.invoice, name=f'Swab {i}', quantity=1, unit_price=Decimal('10'))
+            with deferred_invoice_totals():
+                InvoiceItem.objects.create(invoice=self.invoice, name='Gauze', quantity=1, unit_price=Decimal('30'))
+            self.assertEqual(Invoice.objects.get(pk=self.invoice.pk).total_amount, Decimal('0'))
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.total_amount, Decimal('80'))
+
+
+class DailyRevenueTest(BillingTestMixin, TestCase):
+    def test_rollup_follows_payment_create_edit_and_delete(self):
+        self.add_lines(5)
+        first = Payment.objects.create(invoice=self.invoice, amount=Decimal('100'), payment_method='Cash', created_by=self.user)
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('150'), payment_method='Cash', created_by=self.user)
+        mpesa = Payment.objects.create(invoice=self.invoice, amount=Decimal('50'), payment_method='M-Pesa', created_by=self.user)
+
+        cash = DailyRevenue.objects.get(payment_method='Cash', cashier=self.user, date=timezone.localdate())
+        self.assertEqual((cash.total, cash.count), (Decimal('250'), 2))
+
+        mpesa.payment_method = 'Cash'
+        mpesa.save()
+        first.delete()
+        cash.refresh_from_db()
+        self.assertEqual((cash.total, cash.count), (Decimal('200'), 2))
+        self.assertEqual(DailyRevenue.objects.get(payment_method='M-Pesa').total, Decimal('0'))
+
+    def test_rebuild_command_matches_incremental_rollup(self):
+        self.add_lines(5)
+        for method in ('Cash', 'M-Pesa', 'Cash'):
+            Payment.objects.create(invoice=self.invoice, amount=Decimal('40'), payment_method=method, created_by=self.user)
+        incremental = set(DailyRevenue.objects.values_list('date', 'payment_method', 'cashier_id', 'total', 'count'))
+
+        call_command('rebuild_daily_revenue', stdout=StringIO())
+        rebuilt = set(DailyRevenue.objects.values_list('date', 'payment_method', 'cashier_id', 'total', 'count'))
+        self.assertEqual(incremental, rebuilt)
+
+    def test_payments_without_a_cashier_share_one_bucket(self):
+        self.add_lines(5)
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('60'), payment_method='Cash')
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('40'), payment_method='Cash', created_by=self.user)
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('30'), payment_method='Cash')
+
+        # The deleted cashier's takings join the unattributed bucket instead of duplicating it
+        self.user.delete()
+        self.invoice.refresh_from_db()
+        bucket = DailyRevenue.objects.get(payment_method='Cash')
+        self.assertEqual((bucket.cashier, bucket.total, bucket.count), (None, Decimal('130'), 3))
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('20'), payment_method='Cash')
+        Payment.objects.filter(amount=Decimal('60')).get().delete()
+        bucket.refresh_from_db()
+        self.assertEqual((bucket.total, bucket.count), (Decimal('90'), 3))
+
+        incremental = set(DailyRevenue.objects.values_list('date', 'payment_method', 'cashier_id', 'total', 'count'))
+        call_command('rebuild_daily_revenue', stdout=StringIO())
+        self.assertEqual(set(DailyRevenue.objects.values_list('date', 'payment_method', 'cashier_id', 'total', 'count')), incremental)
+
+
+class StoredBalanceTest(BillingTestMixin, TestCase):
+    def test_balance_due_tracks_totals_adjustment_and_payments(self):
+        self.add_lines(3)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.balance_due, Decimal('300'))
+
+        self.invoice.insurance_adjustment = Decimal('50')
+        self.invoice.save()
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('100'), payment_method='Cash', created_by=self.user)
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.balance_due, Decimal('150'))
+        self.assertEqual(self.invoice.balance_due, self.invoice.balance)
+
+    def test_recalculating_totals_touches_updated_at(self):
+        stale = timezone.now() - timezone.timedelta(days=1)
+        Invoice.objects.filter(pk=self.invoice.pk).update(updated_at=stale)
+        self.add_lines(1)
+        self.invoice.refresh_from_db()
+        self.assertGreater(self.invoice.updated_at, stale)
+
+    def test_sync_command_repairs_drift(self):
+        self.add_lines(2)
+        Invoice.objects.filter(pk=self.invoice.pk).update(balance_due=0)
+        call_command('sync_invoice_balances', stdout=StringIO())
+        self.assertEqual(Invoice.objects.get(pk=self.invoice.pk).balance_due, Decimal('200'))
+
+
+class FinancialExportTest(BillingTestMixin, TestCase):
+    def test_export_command_writes_every_payment_in_range(self):
+        self.add_lines(100)
+        for i in range(60):
+            Payment.objects.create(invoice=self.invoice, amount=Decimal('100'), payment_method='Cash', created_by=self.user)
+
+        out = StringIO()
+        today = timezone.localdate().isoformat()
+        call_command('export_financials', '--from', today, '--to', today, stdout=out)
+        report = out.getvalue()
+
+        self.assertEqual(report.count(',Cash,100.00,CASH001'), 60)
+        self.assertIn(f'INV-{self.invoice.id},John Doe,IN-PATIENT,Partial', report)
+        self.assertIn('Total Revenue,6000', report)
+
+
+class ProcessDailyChargesTest(BillingTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create_superuser(id_number='SYSTEM', password='password', role='Admin')
+        inpatient = Departments.objects.create(name='Inpatient')
+        self.service = Service.objects.create(name='General Ward Bed', department=inpatient, price=Decimal('1500'))
+        ward = Ward.objects.create(name='Ward A', ward_type='General', base_charge_per_day=1500)
+        bed = Bed.objects.create(bed_number='A1', ward=ward)
+        self.admission = Admission.objects.create(
+            patient=self.patient, visit=self.visit, bed=bed, provisional_diagnosis='Malaria'
+        )
+        Admission.objects.filter(pk=self.admission.pk).update(admitted_at=timezone.now() - timezone.timedelta(days=5))
+
+    def test_catch_up_is_set_based_and_idempotent(self):
+        # One day already charged by an earlier run
+        ServiceAdmissionLink.objects.create(
+            admission=self.admission, service=self.service,
+            date_provided=timezone.now() - timezone.timedelta(days=2)
+        )
+
+        call_command('process_daily_charges', '--dry-run', stdout=StringIO())
+        self.assertEqual(ServiceAdmissionLink.objects.count(), 1)
+
+        call_command('process_daily_charges', stdout=StringIO())
+        self.assertEqual(ServiceAdmissionLink.objects.filter(admission=self.admission).count(), 6)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.items.count(), 5)
+        self.assertEqual(self.invoice.total_amount, Decimal('7500'))
+
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('process_daily_charges', stdout=StringIO())
+        self.assertEqual(ServiceAdmissionLink.objects.count(), 6)
+        self.assertLess(len(ctx.captured_queries), 10)
+
+
+class DischargeSyncTest(BillingTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.department = Departments.objects.create(name='Procedures')
+        self.dressing = Service.objects.create(name='Wound Dressing', department=self.department, price=Decimal('800'))
+        self.xray = Service.objects.create(name='Chest X-Ray', department=self.department, price=Decimal('2500'))
+        ward = Ward.objects.create(name='Ward B', ward_type='General', base_charge_per_day=1000)
+        self.admission = Admission.objects.create(
+            patient=self.patient, visit=self.visit, bed=Bed.objects.create(bed_number='B1', ward=ward),
+            provisional_diagnosis='Fracture'
+        )
+        ServiceAdmissionLink.objects.create(admission=self.admission, service=self.dressing, quantity=2)
+
+    def sync(self):
+        return sync_discharge_invoice(self.invoice, self.admission.services.all(), 3, Decimal('1000'))
+
+    def test_sync_is_idempotent_and_skips_work_until_new_services(self):
+        self.assertEqual(self.sync(), 2)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.total_amount, Decimal('4600'))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.sync(), 0)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        ServiceAdmissionLink.objects.create(admission=self.admission, service=self.xray)
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(self.sync(), 0)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.items.count(), 3)
+        self.assertEqual(self.invoice.total_amount, Decimal('7100'))
+
+    def test_deleted_line_is_restored_on_next_sync(self):
+        self.sync()
+        self.invoice.items.get(service=self.dressing).delete()
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(self.sync(), 0)
+        self.assertTrue(self.invoice.items.filter(service=self.dressing).exists())
+
+
+class ClaimBatchTest(BillingTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create_superuser(id_number='SYSTEM', password='password', role='Admin')
+        self.sha_invoices = []
+        for price in ('1000', '3000', '800'):
+            visit = Visit.objects.create(patient=self.patient, visit_type='OUT-PATIENT', visit_mode='Walk In', payment_method='SHA')
+            invoice = Invoice.objects.create(patient=self.patient, visit=visit, created_by=self.user)
+            invoice.add_items([
+                InvoiceItem(name='Consultation', quantity=1, unit_price=Decimal(price) / 2),
+                InvoiceItem(name='Drugs', quantity=1, unit_price=Decimal(price) / 2),
+            ])
+            self.sha_invoices.append(invoice)
+        Payment.objects.create(invoice=self.sha_invoices[2], amount=Decimal('300'), payment_method='Cash', created_by=self.user)
+
+    def build(self, *extra):
+        today = timezone.localdate().isoformat()
+        call_command('build_claim_batch', '--from', today, '--to', today, '--type', 'opd', '--cap', '2000',
+                     *extra, stdout=StringIO(), stderr=StringIO())
+
+    def test_crashed_run_resumes_from_checkpoint(self):
+        from accounts.management.commands import build_claim_batch
+        original, calls = build_claim_batch.Command.claim_chunk, []
+
+        def crash_on_second_chunk(command, *args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('connection lost')
+            return original(command, *args)
+
+        with mock.patch.object(build_claim_batch.Command, 'claim_chunk', crash_on_second_chunk):
+            with self.assertRaises(RuntimeError):
+                self.build('--chunk-size', '1')
+        batch = ClaimBatch.objects.get()
+        self.assertEqual((batch.status, batch.invoice_count), ('Running', 1))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'claims.csv')
+            self.build('--chunk-size', '1', '--output', output)
+            with open(output) as f:
+                lines = f.read().splitlines()
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.invoice_count, batch.claimed_total), ('Completed', 3, Decimal('3500')))
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(Payment.objects.filter(payment_method='Insurance').count(), 3)
+        self.assertFalse(self.invoice.payments.exists())
+
+        capped = Invoice.objects.get(pk=self.sha_invoices[1].pk)
+        self.assertEqual((capped.status, capped.insurance_adjustment, capped.balance_due), ('Paid', Decimal('1000'), Decimal('0')))
+        self.assertEqual(list(capped.items.order_by('id').values_list('paid_amount', flat=True)), [Decimal('1500'), Decimal('500')])
+        self.assertEqual(Invoice.objects.get(pk=self.sha_invoices[2].pk).paid_amount, Decimal('800'))
+        self.assertEqual(DailyRevenue.objects.get(payment_method='Insurance').total, Decimal('3500'))
+
+    def test_claimed_visits_are_pushed_to_the_pharmacy_queue(self):
+        with mock.patch('accounts.management.commands.build_claim_batch.notify_pharmacy_queue') as notify:
+            self.build()
+        notify.assert_called_once_with([invoice.visit_id for invoice in self.sha_invoices])
+
+
+class FulfilmentStatusTest(BillingTestMixin, TestCase):
+    def test_annotation_matches_per_line_properties(self):
+        lab = Departments.objects.create(name='Lab')
+        test = Service.objects.create(name='Malaria Test', department=lab, price=Decimal('300'))
+        category = InventoryCategory.objects.create(name='Drugs')
+        drugs = [InventoryItem.objects.create(name=f'Drug {i}', category=category, dispensing_unit='Tablet') for i in range(4)]
+
+        with deferred_invoice_totals():
+            for drug in drugs:
+                InvoiceItem.objects.create(invoice=self.invoice, inventory_item=drug, name=drug.name, quantity=10, unit_price=Decimal('5'))
+            done = InvoiceItem.objects.create(invoice=self.invoice, service=test, name=test.name, unit_price=test.price)
+            pending = InvoiceItem.objects.create(invoice=self.invoice, service=test, name=test.name, unit_price=test.price)
+        DispensedItem.objects.create(item=drugs[0], patient=self.patient, visit=self.visit, quantity=10)
+        DispensedItem.objects.create(item=drugs[1], patient=self.patient, visit=self.visit, quantity=5)
+        LabResult.objects.create(patient=self.patient, service=test, invoice_item=done, status='Completed')
+        LabResult.objects.create(patient=self.patient, service=test, invoice_item=pending, status='Pending')
+
+        expected = {item.pk: (item.is_dispensed, item.is_completed_service) for item in self.invoice.items.all()}
+        with CaptureQueriesContext(connection) as ctx:
+            annotated = {
+                item.pk: (item.is_dispensed, item.is_completed_service)
+                for item in self.invoice.items.with_fulfilment_status()
+            }
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(annotated, expected)
+        self.assertEqual(sum(dispensed for dispensed, _ in annotated.values()), 1)
+        self.assertEqual(annotated[done.pk], (False, True))
+        self.assertEqual(annotated[pending.pk], (False, False))
+
+
+class ConcurrentPostingTest(BillingTestMixin, TransactionTestCase):
+    """Stress the posting path from several threads, each on its own connection"""
+    THREADS = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('Concurrent connections need a file-based SQLite test database (TEST NAME) or MySQL')
+        super().setUp()
+        self.add_lines(10)
+
+    def run_concurrently(self, targets):
+        errors, results = [], []
+        barrier = threading.Barrier(len(targets))
+
+        def worker(target):
+            try:
+                barrier.wait()
+                results.append(target())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def pay(self, amount, key=None):
+        invoice = Invoice.objects.get(pk=self.invoice.pk)
+        return post_payment(invoice, Decimal(amount), 'Cash', user=self.user, idempotency_key=key)
+
+    def test_parallel_payments_are_all_allocated(self):
+        self.run_concurrently([lambda: self.pay('100')] * self.THREADS)
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.paid_amount, Decimal('800'))
+        self.assertEqual(self.invoice.balance_due, Decimal('200'))
+        self.assertEqual(self.invoice.status, 'Partial')
+        self.assertEqual(self.invoice.items.aggregate(paid=Sum('paid_amount'))['paid'], Decimal('800'))
+        self.assertEqual(DailyRevenue.objects.get().count, self.THREADS)
+
+    def test_payments_and_new_lines_do_not_lose_updates(self):
+        def add_line():
+            invoice = Invoice.objects.get(pk=self.invoice.pk)
+            InvoiceItem.objects.create(invoice=invoice, name='Nightly bed charge', quantity=1, unit_price=Decimal('50'))
+
+        self.run_concurrently([lambda: self.pay('100'), add_line] * (self.THREADS // 2))
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.total_amount, Decimal('1200'))
+        self.assertEqual(self.invoice.paid_amount, Decimal('400'))
+        self.assertEqual(self.invoice.balance_due, Decimal('800'))
+
+    def test_repeated_idempotency_key_posts_once(self):
+        results = self.run_concurrently([lambda: self.pay('250', key='receipt-42')] * self.THREADS)
+
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual({payment.pk for payment, _ in results}, {Payment.objects.get().pk})
+        self.assertEqual([created for _, created in results].count(True), 1)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.paid_amount, Decimal('250'))
+
+    def test_idempotency_key_is_not_reused_across_invoices(self):
+        payment, _ = self.pay('250', key='receipt-42')
+        visit = Visit.objects.create(patient=self.patient, visit_type='OUT-PATIENT', visit_mode='Walk In')
+        other = Invoice.objects.create(patient=self.patient, visit=visit, created_by=self.user)
+        with self.assertRaises(ValueError):
+            post_payment(other, Decimal('250'), 'Cash', user=self.user, idempotency_key='receipt-42')
+        with self.assertRaises(ValueError):
+            self.pay('300', key='receipt-42')
+        self.assertEqual(list(Payment.objects.all()), [payment])
+        other.refresh_from_db()
+        self.assertEqual(other.paid_amount, Decimal('0'))
@@ -1,5 +1,8 @@
-from .models import Invoice
-from django.db import transaction
+from .models import Invoice, InvoiceItem, Payment
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Max, Q
+from decimal import Decimal
+from django.utils import timezone
 
 def get_or_create_invoice(visit=None, deceased=None, user=None):
     """
@@ -29,3 +32,232 @@ def get_or_create_invoice(visit=None, deceased=None, user=None):
             )
             
     return invoice
+
+
+def post_payment(invoice, amount, payment_method, user=None, reference=None, notes=None, idempotency_key=None):
+    """
+    Posts a payment against an invoice in one short transaction under the
+    invoice row lock. A repeated idempotency key (e.g. a double-clicked
+    submit) returns the payment already posted instead of a second one; a
+    key reused for another invoice or amount raises ValueError.
+    Returns (payment, created).
+    """
+    try:
+        with transaction.atomic():
+            invoice.lock()
+            if idempotency_key:
+                existing = Payment.objects.filter(idempotency_key=idempotency_key).first()
+                if existing:
+                    return _replayed_payment(existing, invoice, amount), False
+            payment = Payment.objects.create(
+                invoice=invoice,
+                amount=amount,
+                payment_method=payment_method,
+                transaction_reference=reference,
+                notes=notes,
+                created_by=user,
+                idempotency_key=idempotency_key or None
+            )
+            return payment, True
+    except IntegrityError:
+        # Same key posted concurrently against another invoice row lock
+        if not idempotency_key:
+            raise
+        return _replayed_payment(Payment.objects.get(idempotency_key=idempotency_key), invoice, amount), False
+
+
+def _replayed_payment(payment, invoice, amount):
+    """The payment a repeated idempotency key posted, if it was for the same invoice and amount"""
+    if payment.invoice_id != invoice.pk or payment.amount != Decimal(str(amount)):
+        raise ValueError(
+            f"Idempotency key {payment.idempotency_key} was already used for a payment of "
+            f"{payment.amount} on INV-{payment.invoice_id}."
+        )
+    return payment
+
+
+# Visit splits shared by the insurance manager and the claim batch builder
+SHA_VISIT_CATEGORIES = {
+    'opd': Q(visit__visit_type='OUT-PATIENT'),
+    'ipd': Q(visit__visit_type='IN-PATIENT', visit__labor_delivery__isnull=True),
+    'maternity': Q(visit__visit_type='IN-PATIENT', visit__labor_delivery__isnull=False),
+}
+
+
+def sha_claimable_invoices(category=None):
+    """Unpaid or partially paid SHA invoices with a balance left to claim"""
+    invoices = Invoice.objects.filter(
+        status__in=['Pending', 'Partial'],
+        visit__payment_method='SHA',
+        balance_due__gt=Decimal('0.01')
+    )
+    if category in SHA_VISIT_CATEGORIES:
+        invoices = invoices.filter(SHA_VISIT_CATEGORIES[category])
+    return invoices
+
+
+STAY_KEYWORDS = ['daily', 'bed', 'ward', 'accommodation', 'stay']
+
+
+def discharge_sync_mark(*sources):
+    """Watermark (row count and highest id) of the querysets a discharge invoice is built from"""
+    parts = []
+    for source in sources:
+        agg = source.order_by().aggregate(count=Count('id'), last=Max('id'))
+        parts.append(f"{agg['count']}:{agg['last'] or 0}")
+    return '|'.join(parts)
+
+
+def sync_discharge_invoice(invoice, admission_services, stay_days, daily_rate, administered_meds=None):
+    """
+    Brings a discharge invoice up to date with the stay, performed services
+    and administered medications. Missing lines are worked out in memory,
+    inserted in one batch and the totals recalculated once. The watermark of
+    the sources is stored on the invoice, so repeat calls do nothing until a
+    new service or medication arrives or a line is deleted from the invoice.
+    Returns the number of lines added.
+    """
+    sources = [admission_services] if administered_meds is None else [admission_services, administered_meds]
+    mark = discharge_sync_mark(*sources)
+    if invoice.discharge_sync_mark == mark:
+        return 0
+
+    with transaction.atomic():
+        # Re-check under the invoice lock so two cashiers opening the page
+        # at once cannot both insert the same lines
+        current = Invoice.objects.select_for_update().values_list('discharge_sync_mark', flat=True).get(pk=invoice.pk)
+        if current == mark:
+            invoice.discharge_sync_mark = mark
+            return 0
+
+        existing = list(invoice.items.values_list('service_id', 'service__department__name', 'name'))
+        existing_service_ids = {service_id for service_id, _, _ in existing if service_id}
+        existing_names = {name for _, _, name in existing}
+
+        new_lines = []
+
+        # 1. Accommodation/stay charges, unless any line already looks like one
+        has_stay_charges = any(
+            department == 'Inpatient' or any(keyword in name.lower() for keyword in STAY_KEYWORDS)
+            for _, department, name in existing
+        )
+        if not has_stay_charges:
+            new_lines.append(InvoiceItem(
+                name=f"Accommodation Charges ({stay_days} Days @ {daily_rate})",
+                unit_price=daily_rate,
+                quantity=stay_days
+            ))
+
+        # 2. Performed services
+        for adm_service in admission_services.select_related('service'):
+            if adm_service.service_id not in existing_service_ids:
+                new_lines.append(InvoiceItem(
+                    service=adm_service.service,
+                    name=adm_service.service.name,
+                    unit_price=adm_service.service.price,
+                    quantity=adm_service.quantity
+                ))
+
+        # 3. Administered medications, one line per administration
+        for med in (administered_meds.select_related('item') if administered_meds is not None else []):
+            med_entry_name = f"Medication: {med.item.name} ({med.dosage}) - #{med.id}"
+            if med_entry_name not in existing_names:
+                new_lines.append(InvoiceItem(
+                    inventory_item=med.item,
+                    name=med_entry_name,
+                    unit_price=med.item.selling_price,
+                    quantity=1
+                ))
+
+        if new_lines:
+            invoice.add_items(new_lines)
+        Invoice.objects.filter(pk=invoice.pk).update(discharge_sync_mark=mark)
+        invoice.discharge_sync_mark = mark
+
+    return len(new_lines)
+
+
+class Echo:
+    """File-like object that returns what is written, so csv.writer can feed a streaming response"""
+    def write(self, value):
+        return value
+
+
+def _party_name(invoice):
+    if invoice is None:
+        return ''
+    if invoice.patient:
+        return invoice.patient.full_name
+    if invoice.deceased:
+        return f"{invoice.deceased.full_name} (Deceased)"
+    return ''
+
+
+def financial_report_rows(payments, invoices, expenses, total_revenue, total_expenses, payment_methods, chunk_size=2000):
+    """
+    Yields the rows of the FMS financial report. Payments, invoices and
+    expenses are read in chunks with their relations joined, so memory stays
+    flat regardless of the date range.
+    """
+    yield ['FMS FINANCIAL REPORT']
+    yield ['Generated:', timezone.now().strftime('%Y-%m-%d %H:%M')]
+    yield []
+
+    yield ['SUMMARY']
+    yield ['Total Revenue', total_revenue]
+    yield ['Total Expenses', total_expenses]
+    yield ['Net Profit', total_revenue - total_expenses]
+    yield []
+
+    yield ['PAYMENT RECONCILIATION']
+    for pm in payment_methods:
+        yield [pm['payment_method'], pm['total'], f"{pm['count']} txns"]
+    yield []
+
+    yield ['TRANSACTIONS']
+    yield ['Date', 'Receipt #', 'Invoice #', 'Patient', 'Method', 'Amount', 'Cashier']
+    payments = payments.select_related(
+        'invoice__patient', 'invoice__deceased', 'created_by'
+    ).order_by('-payment_date', '-id')
+    for p in payments.iterator(chunk_size=chunk_size):
+        yield [
+            timezone.localtime(p.payment_date).strftime('%Y-%m-%d %H:%M'),
+            p.transaction_reference or f"PAY-{p.id}",
+            f"INV-{p.invoice_id}",
+            _party_name(p.invoice),
+            p.payment_method,
+            p.amount,
+            p.created_by.id_number if p.created_by else 'System'
+        ]
+    yield []
+
+    yield ['INVOICES']
+    yield ['Date', 'Invoice #', 'Patient', 'Visit Type', 'Status', 'Total', 'Insurance Adj.', 'Paid', 'Balance']
+    invoices = invoices.select_related('patient', 'deceased', 'visit').order_by('-created_at', '-id')
+    for inv in invoices.iterator(chunk_size=chunk_size):
+        yield [
+            timezone.localtime(inv.created_at).strftime('%Y-%m-%d %H:%M'),
+            f"INV-{inv.id}",
+            _party_name(inv),
+            inv.visit.visit_type if inv.visit else ('MORGUE' if inv.deceased_id else ''),
+            inv.status,
+            inv.total_amount,
+            inv.insurance_adjustment,
+            inv.paid_amount,
+            inv.balance_due,
+        ]
+    yield []
+
+    yield ['EXPENSES']
+    yield ['Date', 'Category', 'Description', 'Method', 'Reference', 'Amount', 'Recorded By']
+    expenses = expenses.select_related('category', 'recorded_by').order_by('-date', '-id')
+    for e in expenses.iterator(chunk_size=chunk_size):
+        yield [
+            e.date.strftime('%Y-%m-%d'),
+            e.category.name,
+            e.description,
+            e.payment_method,
+            e.reference_number or '',
+            e.amount,
+            e.recorded_by.id_number if e.recorded_by else 'System'
+        ]
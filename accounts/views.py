@@ -1,17 +1,20 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
-from .utils import get_or_create_invoice
+from .utils import (
+    get_or_create_invoice, post_payment, sync_discharge_invoice, financial_report_rows, Echo,
+    sha_claimable_invoices, SHA_VISIT_CATEGORIES
+)
 from django.db.models import Sum, Count, Q, F
 from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta, datetime, time
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from decimal import Decimal
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from .models import (
     Invoice, Payment, Service, Expense, InventoryPurchase, 
-    ExpenseCategory, SupplierInvoice, SupplierPayment, InvoiceItem
+    ExpenseCategory, SupplierInvoice, SupplierPayment, InvoiceItem, DailyRevenue
 )
 from .forms import (
     ExpenseForm, InventoryPurchaseForm, ExpenseCategoryForm, 
@@ -41,13 +44,15 @@ def accountant_dashboard(request):
     to_date = request.GET.get('to_date')
     
     # Date ranges for analytics
-    today = timezone.now().date()
+    today = timezone.localdate()
     start_of_week = today - timedelta(days=today.weekday())
     start_of_month = today.replace(day=1)
     
     # Base querysets
     invoices = Invoice.objects.all()
     payments = Payment.objects.all()
+    # Revenue figures come from the daily rollup (O(days) rows, not O(payments))
+    revenue = DailyRevenue.objects.all()
     
     # New Expense system
     general_expenses = Expense.objects.all()
@@ -60,6 +65,7 @@ def accountant_dashboard(request):
             from_date = timezone.datetime.strptime(from_date, '%Y-%m-%d').date()
             invoices = invoices.filter(created_at__date__gte=from_date)
             payments = payments.filter(payment_date__date__gte=from_date)
+            revenue = revenue.filter(date__gte=from_date)
             general_expenses = general_expenses.filter(date__gte=from_date)
             inventory_purchases = inventory_purchases.filter(date__gte=from_date)
             supplier_invoices = supplier_invoices.filter(date__gte=from_date)
@@ -71,6 +77,7 @@ def accountant_dashboard(request):
             to_date = timezone.datetime.strptime(to_date, '%Y-%m-%d').date()
             invoices = invoices.filter(created_at__date__lte=to_date)
             payments = payments.filter(payment_date__date__lte=to_date)
+            revenue = revenue.filter(date__lte=to_date)
             general_expenses = general_expenses.filter(date__lte=to_date)
             inventory_purchases = inventory_purchases.filter(date__lte=to_date)
             supplier_invoices = supplier_invoices.filter(date__lte=to_date)
@@ -78,7 +85,7 @@ def accountant_dashboard(request):
             to_date = None
     
     # --- 1. Revenue Metrics ---
-    total_revenue = payments.aggregate(Sum('amount'))['amount__sum'] or 0
+    total_revenue = revenue.aggregate(Sum('total'))['total__sum'] or 0
     total_general_expenses = general_expenses.aggregate(Sum('amount'))['amount__sum'] or 0
     total_inventory_purchases = inventory_purchases.aggregate(Sum('total_amount'))['total_amount__sum'] or 0
     
@@ -92,18 +99,16 @@ def accountant_dashboard(request):
 
     # Weekly/Monthly Revenue (only if no custom filter)
     if not from_date and not to_date:
-        start_of_week_dt = timezone.make_aware(datetime.combine(start_of_week, time.min))
-        start_of_month_dt = timezone.make_aware(datetime.combine(start_of_month, time.min))
-        weekly_revenue = Payment.objects.filter(payment_date__gte=start_of_week_dt).aggregate(Sum('amount'))['amount__sum'] or 0
-        monthly_revenue = Payment.objects.filter(payment_date__gte=start_of_month_dt).aggregate(Sum('amount'))['amount__sum'] or 0
+        weekly_revenue = DailyRevenue.objects.filter(date__gte=start_of_week).aggregate(Sum('total'))['total__sum'] or 0
+        monthly_revenue = DailyRevenue.objects.filter(date__gte=start_of_month).aggregate(Sum('total'))['total__sum'] or 0
     else:
         weekly_revenue = 0
         monthly_revenue = 0
 
     # --- 2. Payment Method Reconciliation ---
-    payment_methods = payments.values('payment_method').annotate(
-        total=Sum('amount'),
-        count=Count('id')
+    payment_methods = revenue.values('payment_method').annotate(
+        total=Sum('total'),
+        count=Sum('count')
     ).order_by('-total')
 
     # --- 3. In-Patient vs Out-Patient Revenue ---
@@ -112,43 +117,42 @@ def accountant_dashboard(request):
     ).order_by('-total')
 
     # --- 4. Aging Debtors (Unpaid Invoices) ---
+    # Bucketed in one conditional aggregation over the stored balance column
     unpaid_invoices = invoices.filter(status__in=['Pending', 'Partial', 'Draft'])
+    week_cutoff = timezone.make_aware(datetime.combine(today - timedelta(days=7), time.min))
+    month_cutoff = timezone.make_aware(datetime.combine(today - timedelta(days=30), time.min))
+    aging = unpaid_invoices.aggregate(
+        recent=Sum('balance_due', filter=Q(created_at__gte=week_cutoff)),
+        mid=Sum('balance_due', filter=Q(created_at__lt=week_cutoff, created_at__gte=month_cutoff)),
+        old=Sum('balance_due', filter=Q(created_at__lt=month_cutoff)),
+    )
     aging_debtors = {
-        '0-7 Days': 0,
-        '8-30 Days': 0,
-        '30+ Days': 0
+        '0-7 Days': float(aging['recent'] or 0),
+        '8-30 Days': float(aging['mid'] or 0),
+        '30+ Days': float(aging['old'] or 0)
     }
-    
-    for inv in unpaid_invoices:
-        age = (today - inv.created_at.date()).days
-        balance = inv.balance
-        if age <= 7:
-            aging_debtors['0-7 Days'] += float(balance)
-        elif age <= 30:
-            aging_debtors['8-30 Days'] += float(balance)
-        else:
-            aging_debtors['30+ Days'] += float(balance)
 
     # --- 5. Cashier Accountability ---
-    cashier_stats = payments.values(
-        'created_by__id_number'
+    cashier_stats = revenue.values(
+        'cashier__id_number', 'cashier__first_name'
     ).annotate(
-        total=Sum('amount'),
-        count=Count('id')
+        total=Sum('total'),
+        count=Sum('count')
     ).order_by('-total')
 
     # --- Chart Data Preparation ---
     
     # Revenue Trend (Daily or Monthly)
+    daily_totals = dict(
+        DailyRevenue.objects.filter(date__range=(today - timedelta(days=30), today - timedelta(days=1)))
+        .values_list('date').annotate(day_total=Sum('total')).order_by()
+    )
     daily_revenue_data = []
     daily_labels = []
     for i in range(30, 0, -1):
         date = today - timedelta(days=i)
         daily_labels.append(date.strftime('%b %d'))
-        sod = timezone.make_aware(datetime.combine(date, time.min))
-        eod = timezone.make_aware(datetime.combine(date, time.max))
-        day_rev = Payment.objects.filter(payment_date__range=(sod, eod)).aggregate(Sum('amount'))['amount__sum'] or 0
-        daily_revenue_data.append(float(day_rev))
+        daily_revenue_data.append(float(daily_totals.get(date, 0)))
         
     # Service Type Breakdown (Revenue by Service Category)
     service_breakdown = invoices.filter(items__service__isnull=False).values(
@@ -165,7 +169,7 @@ def accountant_dashboard(request):
 
     # Handle Export
     if request.GET.get('export') == 'csv':
-        return export_accountant_csv(payments, invoices, total_revenue, total_expenses, payment_methods)
+        return export_accountant_csv(payments, invoices, general_expenses, total_revenue, total_expenses, payment_methods)
 
     context = {
         'total_revenue': total_revenue,
@@ -207,14 +211,7 @@ def insurance_manager(request):
     search_sha = request.GET.get('search_sha', '')
     
     # Base filter for unpaid or partially paid invoices with actual balance > 0
-    unpaid_invoices = Invoice.objects.filter(
-        status__in=['Pending', 'Partial'],
-        visit__payment_method='SHA'
-    ).annotate(
-        balance_check=F('total_amount') - F('insurance_adjustment') - F('paid_amount')
-    ).filter(
-        balance_check__gt=0.01
-    ).select_related('patient', 'visit', 'deceased').order_by('-created_at')
+    unpaid_invoices = sha_claimable_invoices().select_related('patient', 'visit', 'deceased').order_by('-created_at')
     
     def apply_robust_search(queryset, query):
         if not query:
@@ -238,9 +235,9 @@ def insurance_manager(request):
     unpaid_invoices = apply_robust_search(unpaid_invoices, search_query)
 
     # Grouping by visit type
-    opd_invoices = unpaid_invoices.filter(visit__visit_type='OUT-PATIENT')
-    ipd_invoices = unpaid_invoices.filter(visit__visit_type='IN-PATIENT', visit__labor_delivery__isnull=True)
-    maternity_invoices = unpaid_invoices.filter(visit__visit_type='IN-PATIENT', visit__labor_delivery__isnull=False)
+    opd_invoices = unpaid_invoices.filter(SHA_VISIT_CATEGORIES['opd'])
+    ipd_invoices = unpaid_invoices.filter(SHA_VISIT_CATEGORIES['ipd'])
+    maternity_invoices = unpaid_invoices.filter(SHA_VISIT_CATEGORIES['maternity'])
 
     # Apply section-specific searches
     opd_invoices = apply_robust_search(opd_invoices, search_opd)
@@ -405,38 +402,12 @@ def process_insurance_claim(request):
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
-def export_accountant_csv(payments, invoices, total_revenue, total_expenses, payment_methods):
-    response = HttpResponse(content_type='text/csv')
+def export_accountant_csv(payments, invoices, expenses, total_revenue, total_expenses, payment_methods):
+    """Streams the full financial report for the selected range as CSV"""
+    writer = csv.writer(Echo())
+    rows = financial_report_rows(payments, invoices, expenses, total_revenue, total_expenses, payment_methods)
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename="fms_report_{timezone.now().strftime("%Y%m%d")}.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow(['FMS FINANCIAL REPORT'])
-    writer.writerow(['Generated:', timezone.now().strftime('%Y-%m-%d %H:%M')])
-    writer.writerow([])
-    
-    writer.writerow(['SUMMARY'])
-    writer.writerow(['Total Revenue', total_revenue])
-    writer.writerow(['Total Expenses', total_expenses])
-    writer.writerow(['Net Profit', total_revenue - total_expenses])
-    writer.writerow([])
-    
-    writer.writerow(['PAYMENT RECONCILIATION'])
-    for pm in payment_methods:
-        writer.writerow([pm['payment_method'], pm['total'], f"{pm['count']} txns"])
-    writer.writerow([])
-
-    writer.writerow(['RECENT TRANSACTIONS'])
-    writer.writerow(['Date', 'Receipt #', 'Patient', 'Method', 'Amount', 'Cashier'])
-    for p in payments.order_by('-payment_date')[:50]:
-        writer.writerow([
-            p.payment_date.strftime('%Y-%m-%d %H:%M'),
-            p.transaction_reference or f"PAY-{p.id}",
-            p.invoice.patient.full_name,
-            p.payment_method,
-            p.amount,
-            p.created_by.id_number if p.created_by else 'System'
-        ])
-        
     return response
 
 @login_required
@@ -466,8 +437,12 @@ def invoice_detail(request, pk):
         if Admission.objects.filter(visit=invoice.visit, status='Admitted', delivery__isnull=False).exists():
             is_delivery = True
             
+    # Fulfilment flags come annotated, so the item table is one query
+    items = invoice.items.with_fulfilment_status().order_by('created_at', 'id')
+
     context = {
         'invoice': invoice,
+        'items': items,
         'can_authorize': can_authorize,
         'admission_type': admission_type,
         'can_record_payment': is_receptionist(request.user),
@@ -485,6 +460,7 @@ def record_payment(request, pk):
     try:
         if request.content_type == 'application/json':
             data = json.loads(request.body)
+            idempotency_key = data.get('idempotency_key')
             if 'payments' in data:
                 payments_to_create = data['payments']
             else:
@@ -494,25 +470,32 @@ def record_payment(request, pk):
                     'reference': data.get('reference')
                 }]
         else:
+            idempotency_key = request.POST.get('idempotency_key')
             payments_to_create = [{
                 'amount': request.POST.get('amount'),
                 'method': request.POST.get('payment_method'),
                 'reference': request.POST.get('reference')
             }]
+        idempotency_key = idempotency_key or request.headers.get('X-Idempotency-Key')
 
         created_payments = []
         with transaction.atomic():
-            for p_data in payments_to_create:
+            for index, p_data in enumerate(payments_to_create):
                 amount_val = p_data.get('amount')
                 if not amount_val or float(amount_val) <= 0:
                     continue
-                    
-                payment = Payment.objects.create(
-                    invoice=invoice,
+                
+                # Each part of a split payment gets its own key
+                key = idempotency_key
+                if key and len(payments_to_create) > 1:
+                    key = f"{key}:{index}"
+                payment, _ = post_payment(
+                    invoice,
                     amount=amount_val,
                     payment_method=p_data.get('method') or p_data.get('payment_method'),
-                    transaction_reference=p_data.get('reference'),
-                    created_by=request.user
+                    reference=p_data.get('reference'),
+                    user=request.user,
+                    idempotency_key=key
                 )
                 created_payments.append(payment)
         
@@ -543,7 +526,7 @@ def print_receipt(request, payment_id):
     covered_items = []
     current_cumulative_item_amount = Decimal('0')
     
-    for item in invoice.items.all().order_by('created_at'):
+    for item in invoice.items.all().order_by('created_at', 'id'):
         item_start = current_cumulative_item_amount
         item_end = current_cumulative_item_amount + item.amount
         
@@ -1010,7 +993,7 @@ def discharge_billing_detail(request, admission_type, admission_id):
         stay_total = stay_days * daily_rate
         
         # Get all services linked to this admission
-        admission_services = admission.services.all().select_related('service')
+        admission_services = admission.services.all()
         
     elif admission_type == 'morgue':
         admission = get_object_or_404(MorgueAdmission, pk=admission_id)
@@ -1025,7 +1008,7 @@ def discharge_billing_detail(request, admission_type, admission_id):
         daily_rate = mortuary_service.price if mortuary_service else 500 # Default if not found
         stay_total = stay_days * daily_rate
         
-        admission_services = deceased.performed_services.all().select_related('service')
+        admission_services = deceased.performed_services.all()
     else:
         return redirect('accounts:discharge_dashboard')
 
@@ -1053,60 +1036,11 @@ def discharge_billing_detail(request, admission_type, admission_id):
             else: invoice.notes = f'DISCHARGE BILLING - Morgue Admission ID: {admission.id}'
             invoice.save()
 
-    # REFACTORED SYNC LOGIC: Ensure all services and meds are on the invoice
-    existing_items = invoice.items.all()
-    existing_service_ids = set(existing_items.filter(service__isnull=False).values_list('service_id', flat=True))
-    existing_inventory_ids = set(existing_items.filter(inventory_item__isnull=False).values_list('inventory_item_id', flat=True))
-    existing_names = set(existing_items.values_list('name', flat=True))
-
-    # 1. Sync Accommodation/Stay Charges if not already present
-    # Check for any item that looks like a stay charge (Daily, Bed, Ward, Accommodation)
-    has_stay_charges = existing_items.filter(service__department__name='Inpatient').exists() or any(
-        keyword in name.lower() 
-        for keyword in ['daily', 'bed', 'ward', 'accommodation', 'stay'] 
-        for name in existing_names
-    )
-    
-    if not has_stay_charges:
-        stay_service_name = f"Accommodation Charges ({stay_days} Days @ {daily_rate})"
-        InvoiceItem.objects.create(
-            invoice=invoice,
-            name=stay_service_name,
-            unit_price=daily_rate,
-            quantity=stay_days
-        )
-    
-    # 2. Sync Performed Services (ServiceAdmissionLink)
-    for adm_service in admission_services:
-        if adm_service.service.id not in existing_service_ids:
-            InvoiceItem.objects.create(
-                invoice=invoice,
-                service=adm_service.service,
-                name=adm_service.service.name,
-                unit_price=adm_service.service.price,
-                quantity=adm_service.quantity
-            )
-            
-    # 3. Sync Administered Medications (IPD only)
+    # Diff the stay, services and meds against the invoice; a no-op until new ones arrive
+    administered_meds = None
     if admission_type == 'ipd':
-        administered_meds = MedicationChart.objects.filter(
-            admission=admission, 
-            is_administered=True
-        ).select_related('item')
-        
-        for med in administered_meds:
-            # Create a unique name to track specific medication administration instances
-            med_entry_name = f"Medication: {med.item.name} ({med.dosage}) - #{med.id}"
-            if med_entry_name not in existing_names:
-                InvoiceItem.objects.create(
-                    invoice=invoice,
-                    inventory_item=med.item,
-                    name=med_entry_name,
-                    unit_price=med.item.selling_price,
-                    quantity=1
-                )
-
-    invoice.update_totals()
+        administered_meds = MedicationChart.objects.filter(admission=admission, is_administered=True)
+    sync_discharge_invoice(invoice, admission_services, stay_days, daily_rate, administered_meds)
             
     return redirect('accounts:invoice_detail', pk=invoice.id)
 
@@ -1397,7 +1331,7 @@ def manage_visit_invoices(request, visit_id):
     
     items = []
     if invoice:
-        items = invoice.items.all().order_by('-created_at')
+        items = invoice.items.with_fulfilment_status().order_by('-created_at')
     
     context = {
         'visit': visit,
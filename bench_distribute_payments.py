@@ -0,0 +1,62 @@
+import os
+import time
+import django
+from decimal import Decimal
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hms.settings')
+django.setup()
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from home.models import Patient, Visit
+from accounts.models import Invoice, InvoiceItem, Payment
+from django.contrib.auth import get_user_model
+
+LINES = 1000
+
+
+class Rollback(Exception):
+    pass
+
+
+def bench_distribute_payments():
+    print(f"--- Benchmarking FIFO allocation on a {LINES}-line invoice ---")
+    User = get_user_model()
+
+    try:
+        with transaction.atomic():
+            user, _ = User.objects.get_or_create(id_number='bench_cashier', defaults={'role': 'Receptionist'})
+            patient = Patient.objects.create(
+                first_name='Bench', last_name='Allocation',
+                gender='M', date_of_birth=timezone.now().date(),
+                location='Bench'
+            )
+            visit = Visit.objects.create(patient=patient, visit_type='IN-PATIENT', visit_mode='Walk In')
+            invoice = Invoice.objects.create(patient=patient, visit=visit, created_by=user)
+            InvoiceItem.objects.bulk_create([
+                InvoiceItem(invoice=invoice, name=f"Bed Charge - Day {i}", quantity=1,
+                            unit_price=Decimal('1500'), amount=Decimal('1500'))
+                for i in range(LINES)
+            ])
+            invoice.update_totals()
+
+            # Three instalments: partial, partial, settle in full
+            for amount in (Decimal('250000'), Decimal('750000'), invoice.balance - Decimal('1000000')):
+                payment = Payment(invoice=invoice, amount=amount, payment_method='M-Pesa', created_by=user)
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    payment.save()
+                    elapsed = (time.perf_counter() - start) * 1000
+                invoice.refresh_from_db()
+                print(f"Payment {amount:>12}: {len(ctx.captured_queries):>3} queries, {elapsed:8.1f} ms -> {invoice.status}")
+
+            unpaid = invoice.items.exclude(paid_amount=Decimal('1500')).count()
+            print(f"Lines not fully allocated after settlement: {unpaid}")
+            raise Rollback
+    except Rollback:
+        print("Benchmark data rolled back.")
+
+
+if __name__ == "__main__":
+    bench_distribute_payments()
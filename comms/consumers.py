@@ -1,8 +1,11 @@
 import json
 from django.conf import settings
-from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, AsyncWebsocketConsumer
 import redis.asyncio as redis
 
+from .utils import PHARMACY_QUEUE_GROUP, PHARMACY_QUEUE_ROLES, render_queue_card
+
 # Redis key TTL for active call (1 hour) so stale calls don't persist forever
 ACTIVE_CALL_TTL = 3600
 
@@ -114,3 +117,56 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     async def signaling_message(self, event):
         await self.send(text_data=json.dumps(event))
+
+
+class PharmacyQueueConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Live dispensing queue for a pharmacy dashboard. The page reports the
+    visit cards it shows; on every committed change to a visit's pending
+    items the card is re-rendered and pushed as an add, update or remove.
+    The queues are hospital-wide, so every pharmacy's page sees the same cards.
+    """
+    QUEUES = ('pharmacy', 'ipd')
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.queue = self.scope["url_route"]["kwargs"]["queue"]
+        if (
+            not self.user.is_authenticated
+            or (self.user.role not in PHARMACY_QUEUE_ROLES and not self.user.is_superuser)
+            or self.queue not in self.QUEUES
+        ):
+            await self.close()
+            return
+
+        self.visible = set()
+        self.queue_group = PHARMACY_QUEUE_GROUP
+        await self.channel_layer.group_add(self.queue_group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'queue_group'):
+            await self.channel_layer.group_discard(self.queue_group, self.channel_name)
+
+    async def receive_json(self, content):
+        # The cards currently on the page, sent on (re)connect
+        if content.get("type") == "visible":
+            self.visible = {
+                int(visit_id) for visit_id in content.get("visit_ids", [])
+                if str(visit_id).isdigit()
+            }
+
+    async def pharmacy_queue_changed(self, event):
+        for visit_id in event["visit_ids"]:
+            card = await database_sync_to_async(render_queue_card)(self.queue, visit_id, self.user)
+            if card:
+                await self.send_json({
+                    "type": "update" if visit_id in self.visible else "add",
+                    "visit_id": visit_id,
+                    "section": card["section"],
+                    "html": card["html"],
+                })
+                self.visible.add(visit_id)
+            elif visit_id in self.visible:
+                await self.send_json({"type": "remove", "visit_id": visit_id})
+                self.visible.discard(visit_id)
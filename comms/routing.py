@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     path('ws/call/', consumers.CallConsumer.as_asgi()),
+    path('ws/pharmacy-queue/<str:queue>/', consumers.PharmacyQueueConsumer.as_asgi()),
 ]
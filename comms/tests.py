@@ -1,3 +1,150 @@
-from django.test import TestCase
+import json
+from datetime import date
 
-# Create your tests here.
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import Invoice, InvoiceItem
+from home.models import Departments, Patient, Prescription, PrescriptionItem, Visit
+from inventory.models import InventoryCategory, InventoryItem, StockRecord
+from users.models import User
+from .routing import websocket_urlpatterns
+
+
+class SocketCommunicator(ApplicationCommunicator):
+    """
+    A WebSocket client for the routed consumers. channels.testing would do,
+    but it imports the daphne server, which this project does not run.
+    """
+    def __init__(self, path, user):
+        super().__init__(URLRouter(websocket_urlpatterns), {
+            'type': 'websocket', 'path': path, 'headers': [], 'query_string': b'', 'subprotocols': [], 'user': user,
+        })
+
+    async def connect(self):
+        await self.send_input({'type': 'websocket.connect'})
+        response = await self.receive_output(5)
+        return response['type'] == 'websocket.accept'
+
+    async def send_json_to(self, content):
+        await self.send_input({'type': 'websocket.receive', 'text': json.dumps(content)})
+
+    async def receive_json_from(self, timeout=5):
+        response = await self.receive_output(timeout)
+        return json.loads(response['text'])
+
+    async def disconnect(self):
+        await self.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await self.wait(1)
+
+
+# Queue messages are published on commit, so these run outside a test transaction
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PharmacyQueueConsumerTest(TransactionTestCase):
+    def setUp(self):
+        self.pharmacy = Departments.objects.create(name='Pharmacy')
+        self.pharmacist = User.objects.create_user(id_number='PH001', password='x', role='Pharmacist')
+        category = InventoryCategory.objects.create(name='Pharmaceuticals')
+        self.item = InventoryItem.objects.create(name='Paracetamol 500mg', category=category, dispensing_unit='Tablet')
+        StockRecord.objects.create(item=self.item, batch_number='B1', quantity=50, current_location=self.pharmacy)
+        patient = Patient.objects.create(first_name='Jane', last_name='Doe', date_of_birth=date(1990, 1, 1), location='Town', gender='F')
+        self.visit = Visit.objects.create(patient=patient, visit_type='OUT-PATIENT', visit_mode='Walk In')
+        self.invoice = Invoice.objects.create(patient=patient, visit=self.visit)
+
+    async def connect(self, user, queue='pharmacy'):
+        communicator = SocketCommunicator(f'/ws/pharmacy-queue/{queue}/', user)
+        return communicator, await communicator.connect()
+
+    @database_sync_to_async
+    def prescribe(self, quantity=10):
+        with transaction.atomic():
+            prescription = Prescription.objects.create(
+                patient=self.visit.patient, visit=self.visit, invoice=self.invoice, diagnosis='Fever'
+            )
+            PrescriptionItem.objects.create(prescription=prescription, medication=self.item, quantity=quantity)
+            InvoiceItem.objects.create(invoice=self.invoice, inventory_item=self.item, name=self.item.name, quantity=quantity, unit_price=5)
+
+    @database_sync_to_async
+    def pay(self):
+        self.invoice.refresh_from_db()
+        self.invoice.update_totals(paid_amount=self.invoice.total_amount)
+
+    @database_sync_to_async
+    def dispense_all(self):
+        self.client.force_login(self.pharmacist)
+        return self.client.post(reverse('home:dispense_all_visit_items', args=[self.visit.id])).json()
+
+    async def test_queue_follows_prescribing_payment_and_dispensing(self):
+        communicator, connected = await self.connect(self.pharmacist)
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'visible', 'visit_ids': []})
+
+        await self.prescribe()
+        message = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((message['type'], message['visit_id'], message['section']), ('add', self.visit.id, 'opd'))
+        self.assertIn('Paracetamol 500mg', message['html'])
+        self.assertIn('Invoice must be paid before dispensing', message['html'])
+
+        await self.pay()
+        message = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(message['type'], 'update')
+        self.assertNotIn('Invoice must be paid before dispensing', message['html'])
+
+        result = await self.dispense_all()
+        self.assertTrue(result['success'], result)
+        message = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(message, {'type': 'remove', 'visit_id': self.visit.id})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_rolled_back_changes_are_not_published(self):
+        communicator, connected = await self.connect(self.pharmacist)
+        self.assertTrue(connected)
+
+        @database_sync_to_async
+        def prescribe_and_roll_back():
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                prescription = Prescription.objects.create(patient=self.visit.patient, visit=self.visit)
+                PrescriptionItem.objects.create(prescription=prescription, medication=self.item, quantity=4)
+                raise RuntimeError
+
+        await prescribe_and_roll_back()
+        self.assertTrue(await communicator.receive_nothing(timeout=0.5))
+
+        # A later commit on the same thread is still published
+        await self.prescribe()
+        message = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(message['type'], 'add')
+        await communicator.disconnect()
+
+    async def test_changes_after_a_rolled_back_savepoint_are_published(self):
+        communicator, connected = await self.connect(self.pharmacist)
+        self.assertTrue(connected)
+
+        @database_sync_to_async
+        def prescribe_after_failed_attempt():
+            with transaction.atomic():
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    prescription = Prescription.objects.create(patient=self.visit.patient, visit=self.visit)
+                    PrescriptionItem.objects.create(prescription=prescription, medication=self.item, quantity=4)
+                    raise RuntimeError
+                prescription = Prescription.objects.create(patient=self.visit.patient, visit=self.visit)
+                PrescriptionItem.objects.create(prescription=prescription, medication=self.item, quantity=2)
+
+        await prescribe_after_failed_attempt()
+        message = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((message['type'], message['visit_id']), ('add', self.visit.id))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_only_pharmacy_staff_can_watch_a_pharmacy_queue(self):
+        doctor = await database_sync_to_async(User.objects.create_user)(id_number='DR001', password='x', role='Doctor')
+        communicator, connected = await self.connect(doctor)
+        self.assertFalse(connected)
+
+        communicator, connected = await self.connect(self.pharmacist, queue='lab')
+        self.assertFalse(connected)
@@ -0,0 +1,90 @@
+import logging
+import threading
+import weakref
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Who may watch the dispensing queues, and the channel layer group their sockets join
+PHARMACY_QUEUE_ROLES = ('Pharmacist', 'Nurse', 'Admin')
+PHARMACY_QUEUE_GROUP = 'pharmacy_queue'
+
+# The pending batch of the current transaction, per thread
+_queue_batch = threading.local()
+
+
+class _QueueBatch:
+    """Visits whose queue cards changed in one transaction"""
+    def __init__(self):
+        self.visit_ids = set()
+
+    def __call__(self):
+        _publish_queue_changes(self.visit_ids)
+
+
+def notify_pharmacy_queue(visit_ids):
+    """
+    Tell open pharmacy queues that these visits' pending items changed.
+    Visits are collected for the rest of the transaction and published once
+    it commits, so a rolled back dispense sends nothing and a bulk one sends
+    a single message.
+    """
+    visit_ids = {visit_id for visit_id in visit_ids if visit_id}
+    if not visit_ids:
+        return
+    # Only the on_commit callback holds the batch, so a rollback that drops
+    # the callback also ends the batch and the next change starts a new one
+    ref = getattr(_queue_batch, 'ref', None)
+    batch = ref() if ref is not None else None
+    if batch is None:
+        batch = _QueueBatch()
+        batch.visit_ids.update(visit_ids)
+        _queue_batch.ref = weakref.ref(batch)
+        transaction.on_commit(batch)
+    else:
+        batch.visit_ids.update(visit_ids)
+
+
+def _publish_queue_changes(visit_ids):
+    _queue_batch.ref = None
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    message = {'type': 'pharmacy_queue.changed', 'visit_ids': sorted(visit_ids)}
+    try:
+        async_to_sync(channel_layer.group_send)(PHARMACY_QUEUE_GROUP, message)
+    except Exception:
+        # The write has committed; a queue that misses this catches up on reload
+        logger.warning("Could not publish pharmacy queue changes for visits %s", message['visit_ids'], exc_info=True)
+
+
+def render_queue_card(queue, visit_id, user):
+    """
+    One visit's card as a dashboard renders it: {'section', 'html'}, or None
+    when nothing is pending for it. `queue` is 'pharmacy' (today's OPD and
+    take-home queues) or 'ipd' (admitted patients' fulfilment queue).
+    """
+    if queue == 'pharmacy':
+        from home.views import pharmacy_queue_groups
+
+        groups = pharmacy_queue_groups(timezone.localdate(), visit_ids=[visit_id])
+        for section in ('opd', 'ipd'):
+            for group in groups[f'{section}_groups']:
+                html = render_to_string('home/partials/pharmacy_queue_group.html', {'group': group, 'queue': section})
+                return {'section': section, 'html': html}
+        return None
+
+    from inventory.views import ipd_queue_groups
+
+    groups = ipd_queue_groups(visit_ids=[visit_id], include_consumables=user.role in ['Pharmacist', 'Admin'])
+    group = groups.get(visit_id)
+    if group is None:
+        return None
+    html = render_to_string('inventory/partials/ipd_queue_group.html', {'visit_id': visit_id, 'group': group, 'user': user})
+    return {'section': 'ipd', 'html': html}
@@ -112,15 +112,41 @@ TEMPLATES = [
 WSGI_APPLICATION = 'hms.wsgi.application'
 ASGI_APPLICATION = 'hms.asgi.application'
 
-# Channel Layers (using Redis for production/real-time signaling)
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+# Channel Layers (using Redis for production/real-time signaling).
+# CHANNEL_LAYER=memory keeps everything in one process, for tests and
+# single-worker development without a Redis server.
+if os.getenv('CHANNEL_LAYER') == 'memory':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
         },
-    },
-}
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                "hosts": [('127.0.0.1', 6379)],
+            },
+        },
+    }
+
+# Cache. Version keys and cached reports must be seen by every worker, so
+# deployments with more than one process set CACHE_URL to a shared Redis
+# (e.g. redis://127.0.0.1:6379/1); without it each process caches locally.
+if os.getenv('CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('CACHE_URL'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
 
 
 # Database
@@ -145,6 +171,17 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Take the write lock when a transaction begins, so concurrent
+                # postings queue (select_for_update is a no-op on SQLite)
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+            # A file, not the default in-memory database, so the concurrent
+            # posting tests can open a connection per thread
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
         }
     }
 
@@ -0,0 +1,67 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from home.models import Patient, PatientSearchToken
+from home.utils import index_patients, patient_search_tokens
+
+CHUNK_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the patient search tokens with the patient records they are built from and optionally '
+        'rebuilds drifted patients (also backfills the index on first deployment)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Rebuild the tokens of drifted patients')
+
+    def handle(self, *args, **options):
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            # Walk the patients in id order, one chunk per transaction
+            with transaction.atomic():
+                patients = list(
+                    Patient.objects.filter(pk__gt=last_id).order_by('pk')
+                    .values('id', 'first_name', 'last_name', 'id_number', 'phone')[:CHUNK_SIZE]
+                )
+                if not patients:
+                    break
+                last_id = patients[-1]['id']
+
+                stored = defaultdict(set)
+                for patient_id, kind, token in PatientSearchToken.objects.filter(
+                    patient_id__in=[patient['id'] for patient in patients]
+                ).values_list('patient_id', 'kind', 'token'):
+                    stored[patient_id].add((kind, token))
+
+                stale = [
+                    patient for patient in patients
+                    if stored[patient['id']] != patient_search_tokens(
+                        patient['first_name'], patient['last_name'], patient['id_number'], patient['phone']
+                    )
+                ]
+                checked += len(patients)
+                drifted += len(stale)
+                if stale and options['repair']:
+                    index_patients(stale)
+
+        # Tokens of patients deleted without their cascade (e.g. raw SQL)
+        orphans = PatientSearchToken.objects.exclude(patient_id__in=Patient.objects.values('pk'))
+        orphan_count = orphans.count()
+        if orphan_count and options['repair']:
+            orphans.delete()
+
+        if not drifted and not orphan_count:
+            self.stdout.write(self.style.SUCCESS(f"All {checked} patients' search tokens match their records."))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Rebuilt the search tokens of {drifted} patient(s) and removed {orphan_count} orphaned token(s)."
+            ))
+        else:
+            self.stdout.write(self.style.ERROR(
+                f"{drifted} patient(s) have drifted search tokens and {orphan_count} token(s) are orphaned. "
+                f"Run with --repair to fix them."
+            ))
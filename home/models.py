@@ -47,6 +47,34 @@ class Patient(models.Model):
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+
+class PatientSearchToken(models.Model):
+    """
+    One normalized word a patient can be found by (see home.utils.search_patients):
+    a name word, its phonetic key, the ID number or a phone number suffix.
+    Kept in step with the patient by the save signal below.
+    """
+    NAME = 'name'
+    SOUND = 'sound'
+    ID_NUMBER = 'id'
+    PHONE = 'phone'
+    KIND_CHOICES = [
+        (NAME, 'Name'),
+        (SOUND, 'Sounds like'),
+        (ID_NUMBER, 'ID number'),
+        (PHONE, 'Phone suffix'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='search_tokens')
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    token = models.CharField(max_length=40)
+
+    class Meta:
+        indexes = [models.Index(fields=['kind', 'token', 'patient'], name='patient_search_token_idx')]
+
+    def __str__(self):
+        return f"{self.kind}:{self.token} -> {self.patient_id}"
+
 class Visit(models.Model):
     PAYMENT_METHOD_CHOICES = [
         ('CASH', 'Cash'),
@@ -299,6 +327,9 @@ class Prescription(models.Model):
         ordering = ['-prescribed_at']
         verbose_name = "Prescription"
         verbose_name_plural = "Prescriptions"
+        indexes = [
+            models.Index(fields=['prescribed_at'], name='prescription_prescribed_idx'),
+        ]
     
     @property
     def total_amount(self):
@@ -419,3 +450,14 @@ class TBScreening(models.Model):
 
     def __str__(self):
         return f"TB Screening for {self.visit.patient.full_name}"
+
+
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+@receiver(post_save, sender=Patient)
+def index_patient_for_search(sender, instance, raw=False, **kwargs):
+    """Rewrite the patient's search tokens after every save (the tokens are deleted with the patient)"""
+    if not raw:
+        from .utils import index_patients
+        index_patients([instance])
@@ -5,7 +5,7 @@ from django.utils import timezone
 from django.db.models import Q, Sum, Count
 from datetime import timedelta
 from .models import Prescription, PrescriptionItem
-from inventory.models import InventoryItem, StockRecord, InventoryRequest
+from inventory.models import InventoryItem, StockRecord, InventoryRequest, stock_movement
 from home.models import Departments
 
 
@@ -148,7 +148,8 @@ def dispense_medication(request, item_id):
         
         # Reduce stock
         available_stock.quantity -= prescription_item.quantity
-        available_stock.save()
+        with stock_movement('Dispense', f'Dispensed to {prescription_item.prescription.patient.full_name}', request.user):
+            available_stock.save()
         
         # Create stock adjustment record
         from inventory.models import StockAdjustment
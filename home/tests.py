@@ -1,3 +1,64 @@
+from datetime import date
+from io import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
+
+from users.models import User
+from .models import Patient, PatientSearchToken
+from .utils import name_sound, normalize_phone, search_patients
+
+
+class PatientSearchTest(TestCase):
+    def patient(self, first_name, last_name, id_number=None, phone=None):
+        return Patient.objects.create(
+            first_name=first_name, last_name=last_name, id_number=id_number, phone=phone,
+            date_of_birth=date(1990, 1, 1), location='Nairobi', gender='F',
+        )
+
+    def test_spelling_variants_share_a_phonetic_key(self):
+        for a, b in [('Otieno', 'Otiyeno'), ('Chebet', 'Jebet'), ('Wanjiru', 'Wanjiro'), ('Odhiambo', 'Odiambo'),
+                     ('Nyambura', 'Nyambula'), ('Wekesa', 'Wekessa'), ('Wafula', 'Wafulah'), ('Mwangi', 'Mwangy')]:
+            self.assertEqual(name_sound(a.lower()), name_sound(b.lower()), (a, b))
+        self.assertNotEqual(name_sound('kamau'), name_sound('kimani'))
+        self.assertEqual(normalize_phone('+254 712 345678'), normalize_phone('0712345678'))
+
+    def test_ranked_search(self):
+        exact = self.patient('Akinyi', 'Otieno', id_number='30123456', phone='0712345678')
+        prefix = self.patient('Akinyi', 'Otienoh')
+        sounds = self.patient('Akinyi', 'Otiyeno')
+        self.patient('Wanjiru', 'Otieno')
+
+        self.assertEqual(search_patients('akinyi otieno'), [exact, prefix, sounds])
+        self.assertEqual(search_patients('Otieno Akinyi', limit=1), [exact])
+        # Every word has to match something
+        self.assertEqual(search_patients('akinyi kamau'), [])
+        self.assertEqual(search_patients('5678'), [exact])
+        self.assertEqual(search_patients('+254712345678'), [exact])
+        self.assertEqual(search_patients('301234'), [exact])
+        self.assertEqual(search_patients(str(sounds.pk))[0], sounds)
+
+    def test_tokens_follow_edits_and_verify_command_repairs(self):
+        patient = self.patient('Chebet', 'Kiprono', phone='0722000111')
+        patient.last_name = 'Rotich'
+        patient.save()
+        self.assertEqual(search_patients('kiprono'), [])
+        self.assertEqual(search_patients('jebet rotich'), [patient])
+
+        PatientSearchToken.objects.filter(patient=patient).delete()
+        out = StringIO()
+        call_command('verify_patient_search_index', stdout=out)
+        self.assertIn('1 patient(s) have drifted search tokens', out.getvalue())
+        call_command('verify_patient_search_index', '--repair', stdout=StringIO())
+        self.assertEqual(search_patients('0111'), [patient])
+
+    def test_views_use_the_index(self):
+        patient = self.patient('Njeri', 'Kamau', id_number='22334455')
+        self.patient('Kamau', 'Mwangi')
+        self.client.force_login(User.objects.create_user(id_number='REC1', password='x', role='Receptionist'))
 
-# Create your tests here.
+        results = self.client.get(reverse('patient_search_api'), {'q': 'njeri kamau'}).json()['results']
+        self.assertEqual([row['id'] for row in results], [patient.id])
+        response = self.client.get(reverse('home:patient_list'), {'search': 'kamau'})
+        self.assertEqual(len(response.context['patients']), 2)
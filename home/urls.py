@@ -45,6 +45,7 @@ urlpatterns = [
     # Pharmacy URLs
     path('pharmacy/dashboard/', views.pharmacy_dashboard, name='pharmacy_dashboard'),
     path('pharmacy/dispense-all/<int:visit_id>/', views.dispense_all_visit_items, name='dispense_all_visit_items'),
+    path('pharmacy/dispense-batch/', views.dispense_visits_batch, name='dispense_visits_batch'),
     
     # Health Records
     path('health-records/', views.health_records_view, name='health_records'),
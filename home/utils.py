@@ -0,0 +1,186 @@
+import re
+import unicodedata
+
+from django.db.models import Case, F, IntegerField, Max, Q, Value, When
+
+# Most results a patient search returns
+PATIENT_SEARCH_LIMIT = 20
+
+# Relevance of a query term matching a patient through each kind of token
+SCORE_PK = 200
+SCORE_NAME_EXACT = 100
+SCORE_ID_EXACT = 80
+SCORE_NAME_PREFIX = 50
+SCORE_SOUNDS_LIKE = 40
+SCORE_ID_PREFIX = 30
+SCORE_PHONE = 30
+
+# Prefix matching starts at this many characters; shorter terms must match a whole token
+MIN_PREFIX_LENGTH = 3
+# Shortest phone suffix indexed (and the shortest digit run searched as a phone number)
+MIN_PHONE_SUFFIX = 4
+
+# Spelling variants seen in Kenyan names, folded before vowels are grouped:
+# Luo dh/th (Odhiambo/Odiambo), Kalenjin ch/j (Chebet/Jebet), Bantu r/l
+# (Nyambura/Nyambula), English spellings (Philip/Filip, Catherine/Katherine)
+PHONETIC_RULES = [
+    (re.compile(r"ng'"), 'ng'),
+    (re.compile(r'dh'), 'd'),
+    (re.compile(r'th'), 't'),
+    (re.compile(r'sh'), 's'),
+    (re.compile(r'ch|tch'), 'j'),
+    (re.compile(r'ph'), 'f'),
+    (re.compile(r'gh'), 'g'),
+    (re.compile(r'ck|c|q'), 'k'),
+    (re.compile(r'x'), 'ks'),
+    (re.compile(r'l'), 'r'),
+    (re.compile(r'v'), 'f'),
+    (re.compile(r'z'), 's'),
+    (re.compile(r'(?<=.)h'), ''),
+]
+# Vowel and glide groups: Wanjiru/Wanjiro, Kamau/Kamaw, Mwangi/Mwangy
+PHONETIC_VOWELS = str.maketrans({'e': 'i', 'y': 'i', 'o': 'u', 'w': 'u'})
+
+
+def fold_name(text):
+    """Lowercase ASCII letters of a name, accents removed ("Njoki-Wairimu" -> ["njoki", "wairimu"])"""
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return re.findall(r"[a-z]+(?:'[a-z]+)?", text)
+
+
+def name_sound(word):
+    """
+    Phonetic key of one folded name word. Spelling variants common in
+    Kenyan names share a key: Otieno/Otiyeno, Chebet/Jebet, Wafula/Wafulah.
+    """
+    for pattern, replacement in PHONETIC_RULES:
+        word = pattern.sub(replacement, word)
+    word = word.replace("'", '').translate(PHONETIC_VOWELS)
+    # Doubled letters (Wekesa/Wekessa) and vowel runs (Otieno/Otiyeno) count once
+    return re.sub(r'(.)\1+', r'\1', word)
+
+
+def normalize_phone(phone):
+    """Subscriber digits of a phone number: 0712 345678 and +254712345678 both give 712345678"""
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 12 and digits.startswith('254'):
+        return digits[3:]
+    if len(digits) == 10 and digits.startswith('0'):
+        return digits[1:]
+    return digits
+
+
+def normalize_id_number(id_number):
+    return re.sub(r'[^a-z0-9]', '', (id_number or '').lower())
+
+
+def patient_search_tokens(first_name, last_name, id_number, phone):
+    """
+    The (kind, token) pairs a patient is found by: each name word and its
+    phonetic key, the ID number, and every phone suffix of at least
+    MIN_PHONE_SUFFIX digits (so any tail of the number matches).
+    """
+    from .models import PatientSearchToken
+
+    tokens = set()
+    for word in fold_name(first_name) + fold_name(last_name):
+        word = word.replace("'", '')
+        tokens.add((PatientSearchToken.NAME, word[:40]))
+        tokens.add((PatientSearchToken.SOUND, name_sound(word)[:40]))
+    id_number = normalize_id_number(id_number)
+    if id_number:
+        tokens.add((PatientSearchToken.ID_NUMBER, id_number[:40]))
+    phone = normalize_phone(phone)
+    for start in range(len(phone) - MIN_PHONE_SUFFIX + 1):
+        tokens.add((PatientSearchToken.PHONE, phone[start:]))
+    return tokens
+
+
+def index_patients(patients):
+    """Rewrite the search tokens of saved patients (model instances or id/name/number/phone dicts)"""
+    from .models import PatientSearchToken
+
+    rows = []
+    for patient in patients:
+        if isinstance(patient, dict):
+            patient_id, fields = patient['id'], (patient['first_name'], patient['last_name'], patient['id_number'], patient['phone'])
+        else:
+            patient_id, fields = patient.pk, (patient.first_name, patient.last_name, patient.id_number, patient.phone)
+        rows += [
+            PatientSearchToken(patient_id=patient_id, kind=kind, token=token)
+            for kind, token in patient_search_tokens(*fields)
+        ]
+    patient_ids = {row.patient_id for row in rows} | {
+        patient['id'] if isinstance(patient, dict) else patient.pk for patient in patients
+    }
+    PatientSearchToken.objects.filter(patient_id__in=patient_ids).delete()
+    PatientSearchToken.objects.bulk_create(rows, batch_size=1000)
+
+
+def _token_range(kind, prefix):
+    # A range rather than startswith so every backend walks the (kind, token) index
+    return Q(kind=kind, token__gte=prefix, token__lt=prefix + '\uffff')
+
+
+def _term_matches(term):
+    """(condition, score) pairs for one query term, best first"""
+    from .models import PatientSearchToken
+
+    matches = []
+    if term.isdigit():
+        matches.append((Q(patient_id=int(term)), SCORE_PK))
+    words = fold_name(term)
+    if words:
+        # "Njoki-Wairimu" is looked up by its longest word
+        word = max(words, key=len).replace("'", '')
+        matches.append((Q(kind=PatientSearchToken.NAME, token=word), SCORE_NAME_EXACT))
+        if len(word) >= MIN_PREFIX_LENGTH:
+            matches.append((_token_range(PatientSearchToken.NAME, word), SCORE_NAME_PREFIX))
+        matches.append((Q(kind=PatientSearchToken.SOUND, token=name_sound(word)), SCORE_SOUNDS_LIKE))
+    id_number = normalize_id_number(term)
+    if id_number:
+        matches.append((Q(kind=PatientSearchToken.ID_NUMBER, token=id_number), SCORE_ID_EXACT))
+        if len(id_number) >= MIN_PREFIX_LENGTH:
+            matches.append((_token_range(PatientSearchToken.ID_NUMBER, id_number), SCORE_ID_PREFIX))
+    phone = normalize_phone(term)
+    if len(phone) >= MIN_PHONE_SUFFIX and re.fullmatch(r'[\d\s+()-]+', term):
+        # A prefix of some suffix is any run of digits in the number
+        matches.append((_token_range(PatientSearchToken.PHONE, phone), SCORE_PHONE))
+    return matches
+
+
+def search_patients(query, limit=PATIENT_SEARCH_LIMIT):
+    """
+    Patients matching every word of `query`, most relevant first, at most
+    `limit` of them. A word matches a name word exactly or by prefix, a name
+    that sounds alike, an ID number or any run of phone digits, or the
+    patient number itself; a patient's score is the sum of each word's best
+    match. Matching, ranking and the limit all run in one indexed query
+    over PatientSearchToken.
+    """
+    from .models import Patient, PatientSearchToken
+
+    terms = [matches for matches in map(_term_matches, (query or '').split()) if matches]
+    if not terms:
+        return []
+
+    any_match = Q()
+    scores = {}
+    for index, matches in enumerate(terms):
+        for condition, _ in matches:
+            any_match |= condition
+        scores[f'term_{index}'] = Max(Case(
+            *[When(condition, then=Value(score)) for condition, score in matches],
+            default=Value(0), output_field=IntegerField(),
+        ))
+
+    ranked = (
+        PatientSearchToken.objects.filter(any_match)
+        .values('patient_id')
+        .annotate(**scores)
+        .filter(**{f'{name}__gt': 0 for name in scores})
+    )
+    ranked = ranked.annotate(score=sum((F(name) for name in scores), Value(0)))
+    patient_ids = list(ranked.order_by('-score', 'patient_id').values_list('patient_id', flat=True)[:limit])
+    patients = Patient.objects.in_bulk(patient_ids)
+    return [patients[patient_id] for patient_id in patient_ids if patient_id in patients]
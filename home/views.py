@@ -11,17 +11,27 @@ from django.utils import timezone
 from django.views.decorators.http import require_http_methods
 from django.core.paginator import Paginator
 import json
+import logging
 from datetime import timedelta, datetime, time
 from .models import Patient, Visit, TriageEntry, EmergencyContact, Consultation, PatientQue, ConsultationNotes, Departments, Prescription, PrescriptionItem, Referral, Appointments, Symptoms, Impression, Diagnosis, ProcedureCompletion
-from accounts.models import Invoice, InvoiceItem, Service, Payment
+from accounts.models import Invoice, InvoiceItem, Service, Payment, deferred_invoice_totals
 from accounts.utils import get_or_create_invoice
 from lab.models import LabResult
 from lab.forms import AmbulanceRouteForm
 from inpatient.models import Admission
 from morgue.models import MorgueAdmission
 from .forms import EmergencyContactForm, PatientForm, ReferralForm, AppointmentForm
+from .utils import search_patients
 from django.db.models import Q
 from inventory.models import DispensedItem, InventoryRequest
+
+logger = logging.getLogger(__name__)
+
+
+# Most ranked matches the patient list shows for a search
+PATIENT_LIST_SEARCH_LIMIT = 50
+
+
 class PatientListView(LoginRequiredMixin, ListView):
     model = Patient
     template_name = 'home/patient_list.html'
@@ -31,64 +41,8 @@ class PatientListView(LoginRequiredMixin, ListView):
         queryset = Patient.objects.all().order_by('-created_at')
         search_query = self.request.GET.get('search')
         if search_query:
-            # Split search query into individual terms
-            search_terms = search_query.strip().split()
-            
-            # Start with base queryset
-            base_queryset = Patient.objects.all()
-            
-            # Build Q objects for each search term
-            term_q_objects = []
-            for term in search_terms:
-                if term.strip():
-                    term_q = Q() | Q(id_number__icontains=term) | Q(first_name__icontains=term) | Q(last_name__icontains=term) | Q(phone__icontains=term)
-                    
-                    # Check if term is a number for ID lookup
-                    if term.isdigit():
-                        term_q = term_q | Q(pk=int(term))
-                    
-                    term_q_objects.append(term_q)
-            
-            # Combine all term queries with AND (all terms must match somewhere)
-            combined_q = Q()
-            for term_q in term_q_objects:
-                combined_q = combined_q & term_q
-            
-            queryset = base_queryset.filter(combined_q)
-            
-            # Rank results by relevance
-            # Higher priority for exact matches in first_name or last_name
-            # Then partial matches, then other fields
-            ranked_patients = []
-            for patient in queryset:
-                relevance_score = 0
-                
-                for term in search_terms:
-                    term_lower = term.lower()
-                    
-                    # Exact match in first_name or last_name gets highest score
-                    if patient.first_name.lower() == term_lower or patient.last_name.lower() == term_lower:
-                        relevance_score += 100
-                    # Starts with gets high score
-                    elif patient.first_name.lower().startswith(term_lower) or patient.last_name.lower().startswith(term_lower):
-                        relevance_score += 50
-                    # Contains gets medium score
-                    elif term_lower in patient.first_name.lower() or term_lower in patient.last_name.lower():
-                        relevance_score += 25
-                    # ID or phone match gets lower score
-                    elif term_lower in str(patient.id_number).lower() or term_lower in str(patient.phone).lower():
-                        relevance_score += 10
-                    # PK match gets highest score
-                    elif term.isdigit() and patient.pk == int(term):
-                        relevance_score += 200
-                
-                ranked_patients.append((relevance_score, patient))
-            
-            # Sort by relevance score (descending) then by creation date
-            ranked_patients.sort(key=lambda x: (-x[0], x[1].created_at))
-            
-            # Extract just the patient objects
-            queryset = [patient for score, patient in ranked_patients]
+            # Best matches first, from the patient search index
+            queryset = search_patients(search_query, limit=PATIENT_LIST_SEARCH_LIMIT)
         return queryset
     
     def get_context_data(self, **kwargs):
@@ -910,9 +864,7 @@ def reception_dashboard(request):
     if user_role == 'Receptionist' or user_role == 'Admin':
         # Receptionist (and Admin) sees invoices
         # Get patient service invoices with search functionality
-        invoices = Invoice.objects.annotate(
-            balance_due=F('total_amount') - F('insurance_adjustment') - F('paid_amount')
-        ).filter(
+        invoices = Invoice.objects.filter(
             Q(status__in=['Pending', 'Partial', 'Draft']) & 
             (Q(visit__visit_type='OUT-PATIENT') | Q(visit__visit_type='IN-PATIENT', visit__admissions__isnull=True)) &
             Q(balance_due__gt=0)
@@ -933,9 +885,7 @@ def reception_dashboard(request):
         invoices = invoices.order_by('-created_at')
         
         # Get unpaid invoices count
-        unpaid_invoices = Invoice.objects.annotate(
-            balance_due=F('total_amount') - F('insurance_adjustment') - F('paid_amount')
-        ).filter(
+        unpaid_invoices = Invoice.objects.filter(
             Q(status__in=['Pending', 'Partial', 'Draft']) & 
             (Q(visit__visit_type='OUT-PATIENT') | Q(visit__visit_type='IN-PATIENT', visit__admissions__isnull=True)) &
             Q(balance_due__gt=0)
@@ -1734,19 +1684,20 @@ def create_prescription(request, visit_id):
                 prescription.invoice = invoice
                 prescription.save()
                 
-                for item in prescription_items:
-                    # Skip creating invoice items for free medications
-                    if item.medication.selling_price > 0:
-                        InvoiceItem.objects.create(
-                            invoice=invoice,
-                            inventory_item=item.medication,
-                            name=item.medication.name,
-                            unit_price=item.medication.selling_price,
-                            quantity=item.quantity
-                        )
+                # Skip creating invoice items for free medications
+                # (add_items bulk-inserts and updates invoice totals once)
+                invoice.add_items([
+                    InvoiceItem(
+                        inventory_item=item.medication,
+                        name=item.medication.name,
+                        unit_price=item.medication.selling_price,
+                        quantity=item.quantity
+                    )
+                    for item in prescription_items
+                    if item.medication.selling_price > 0
+                ])
                 
-                # Update invoice totals and handle free prescriptions
-                invoice.update_totals()
+                # Handle free prescriptions
                 if invoice.total_amount == 0 and invoice.status != 'Paid':
                     invoice.status = 'Paid'
                     invoice.save()
@@ -1774,22 +1725,23 @@ def create_prescription(request, visit_id):
     
     # Prepare stock logic
     from django.db.models import Sum, Q 
-    from inventory.models import StockRecord
+    from inventory.models import StockLevel
 
     # Determine eligible departments for stock check (Pharmacy only for outpatient, include Mini Pharmacy for inpatient)
     departments = ['Pharmacy'] 
     if visit.visit_type == 'IN-PATIENT':
         departments.append('Mini Pharmacy')
     
+    # Stock of every item across the eligible departments in one query
+    stock_totals = dict(
+        StockLevel.objects.filter(location__name__in=departments)
+        .values('item_id').annotate(total=Sum('quantity')).values_list('item_id', 'total')
+    )
+
     med_metadata = {}
     for item in medications:
         details = getattr(item, 'medication', None)
-        
-        # Calculate stock
-        total_stock = StockRecord.objects.filter(
-            item=item,
-            current_location__name__in=departments
-        ).aggregate(quantity__sum=Sum('quantity'))['quantity__sum'] or 0
+        total_stock = stock_totals.get(item.id, 0)
 
         med_metadata[item.id] = {
             'name': item.name,
@@ -1816,7 +1768,7 @@ def create_prescription(request, visit_id):
     return render(request, 'home/create_prescription.html', context)
 
 def _get_normalized_history(visit, patient):
-    from inventory.models import DispensedItem
+    from inventory.models import DispensedItem, VisitFulfilment
     from accounts.models import InvoiceItem
     from inpatient.models import MedicationChart, InpatientConsumable
     
@@ -1843,16 +1795,10 @@ def _get_normalized_history(visit, patient):
         is_dispensed=False
     ).select_related('item', 'prescribed_by').order_by('-prescribed_at')
         
-    # 4. Combine and Normalize with De-duplication
+    # 4. Combine and Normalize
     history = []
     
-    # Track dispensed items to suppress corresponding requests
-    # Frequency map: (item_id, quantity) -> count
-    dispensed_counts = {}
     for d in d_items:
-        key = (d.item.id, d.quantity)
-        dispensed_counts[key] = dispensed_counts.get(key, 0) + 1
-        
         history.append({
             'item_name': d.item.name,
             'quantity': d.quantity,
@@ -1861,52 +1807,30 @@ def _get_normalized_history(visit, patient):
             'status': 'Dispensed',
             'status_class': 'bg-emerald-50 text-emerald-700'
         })
-        
-    # Add billed items (Requests) - Suppress if already dispensed
-    for b in billed_items:
-        key = (b.inventory_item.id, b.quantity)
-        if dispensed_counts.get(key, 0) > 0:
-            dispensed_counts[key] -= 1
-            continue
-            
-        # Use b.name because it might contain "(from Dept)" info
-        history.append({
-            'item_name': b.name if b.name else b.inventory_item.name,
-            'quantity': b.quantity,
-            'at': b.created_at,
-            'by': b.invoice.created_by if b.invoice else b.created_by,
-            'status': 'Requested',
-            'status_class': 'bg-amber-50 text-amber-700'
-        })
 
-    # Add IPD Meds
-    for m in ipd_meds:
-        key = (m.item.id, m.quantity)
-        if dispensed_counts.get(key, 0) > 0:
-            dispensed_counts[key] -= 1
-            continue
-
-        history.append({
-            'item_name': m.item.name,
-            'quantity': m.quantity,
-            'at': m.prescribed_at,
-            'by': m.prescribed_by,
-            'status': 'Requested',
-            'status_class': 'bg-amber-50 text-amber-700'
-        })
+    # Requests only show for the units the fulfilment ledger still owes,
+    # against the newest requests first (dispensing is FIFO)
+    owed = dict(VisitFulfilment.objects.filter(visit=visit).pending().values_list('item_id', 'pending_quantity'))
+    requests = [
+        # Use b.name because it might contain "(from Dept)" info
+        (b.inventory_item_id, b.name if b.name else b.inventory_item.name, b.quantity, b.created_at,
+         b.invoice.created_by if b.invoice else b.created_by)
+        for b in billed_items
+    ]
+    requests += [(m.item_id, m.item.name, m.quantity, m.prescribed_at, m.prescribed_by) for m in ipd_meds]
+    requests += [(c.item_id, c.item.name, c.quantity, c.prescribed_at, c.prescribed_by) for c in ipd_consumables]
+    requests.sort(key=lambda r: r[3], reverse=True)
 
-    # Add IPD Consumables
-    for c in ipd_consumables:
-        key = (c.item.id, c.quantity)
-        if dispensed_counts.get(key, 0) > 0:
-            dispensed_counts[key] -= 1
+    for item_id, item_name, quantity, at, by in requests:
+        units = min(quantity, owed.get(item_id, 0))
+        if units <= 0:
             continue
-
+        owed[item_id] -= units
         history.append({
-            'item_name': c.item.name,
-            'quantity': c.quantity,
-            'at': c.prescribed_at,
-            'by': c.prescribed_by,
+            'item_name': item_name,
+            'quantity': units,
+            'at': at,
+            'by': by,
             'status': 'Requested',
             'status_class': 'bg-amber-50 text-amber-700'
         })
@@ -2103,7 +2027,7 @@ def edit_prescription(request, prescription_id):
 
                     # 2. Cleanup: Remove InvoiceItems that no longer have a PrescriptionItem
                     # Only remove medication items that are NOT dispensed.
-                    invoice_meds = invoice.items.filter(inventory_item__isnull=False)
+                    invoice_meds = invoice.items.filter(inventory_item__isnull=False).with_fulfilment_status().select_related('inventory_item__medication')
                     for i_item in invoice_meds:
                         # Check if this inventory item is a medication (drug)
                         if hasattr(i_item.inventory_item, 'medication'):
@@ -2142,20 +2066,23 @@ def edit_prescription(request, prescription_id):
         medications = InventoryItem.objects.all().select_related('category')
     
     from django.db.models import Sum
-    from inventory.models import StockRecord
+    from inventory.models import StockLevel
 
     # Determine eligible departments for stock check (Pharmacy only for outpatient, include Mini Pharmacy for inpatient)
     departments = ['Pharmacy']
     if prescription.visit and prescription.visit.visit_type == 'IN-PATIENT':
         departments.append('Mini Pharmacy')
     
+    # Stock of every item across the eligible departments in one query
+    stock_totals = dict(
+        StockLevel.objects.filter(location__name__in=departments)
+        .values('item_id').annotate(total=Sum('quantity')).values_list('item_id', 'total')
+    )
+
     med_metadata = {}
     for item in medications:
         details = getattr(item, 'medication', None)
-        total_stock = StockRecord.objects.filter(
-            item=item,
-            current_location__name__in=departments
-        ).aggregate(quantity__sum=Sum('quantity'))['quantity__sum'] or 0
+        total_stock = stock_totals.get(item.id, 0)
 
         med_metadata[item.id] = {
             'name': item.name,
@@ -2207,126 +2134,96 @@ from django.utils import timezone
 from django.db.models import Q, Sum, Count
 from datetime import timedelta
 from .models import Prescription, PrescriptionItem
-from inventory.models import InventoryItem, StockRecord, InventoryRequest
+from inventory.models import InventoryItem, StockRecord, StockLevel, ExpiringBatch, InventoryRequest
 from home.models import Departments
 
 
-@login_required
-def pharmacy_dashboard(request):
-    """Pharmacy dashboard showing OPD and IPD prescriptions, consumables, stock, and requests"""
-    # Role-based access control
-    if request.user.role not in ['Pharmacist', 'Nurse', 'Admin']:
-        messages.error(request, "Access denied. Only pharmacists, nurses and admins can access the pharmacy dashboard.")
-        return redirect('home:reception_dashboard')
-
-    # Always use the main Pharmacy department for this dashboard
-    pharmacy_dept, created = Departments.objects.get_or_create(
-        name='Pharmacy',
-        defaults={'abbreviation': 'PHR'}
-    )
-
-    # Date filter
+def pharmacy_queue_groups(filter_date, search_query='', visit_ids=None):
+    """
+    The pharmacy dashboard's dispensing queue for one day: undispensed
+    prescription items and still-owed consumables grouped per visit into
+    OPD and IPD (take-home) groups. `visit_ids` limits it to some visits,
+    which is how the live queue re-renders a single card.
+    """
     from datetime import datetime, time
-    filter_date_str = request.GET.get('date')
-    if filter_date_str:
-        try:
-            filter_date = datetime.strptime(filter_date_str, '%Y-%m-%d').date()
-        except ValueError:
-            filter_date = timezone.localdate()
-    else:
-        filter_date = timezone.localdate()
 
+    # Half-open [start, next day start) window in local time: both ends are
+    # made aware separately so the range is correct across offset changes, and
+    # the comparison runs against the indexed datetime column on SQLite and MySQL
     start_of_day = timezone.make_aware(datetime.combine(filter_date, time.min))
-    end_of_day = timezone.make_aware(datetime.combine(filter_date, time.max))
+    end_of_day = timezone.make_aware(datetime.combine(filter_date + timedelta(days=1), time.min))
 
-    # Search functionality
-    search_query = request.GET.get('search', '')
-    stock_search = request.GET.get('stock_search', '')
-    dispensed_search = request.GET.get('dispensed_search', '')
-    request_search = request.GET.get('request_search', '')
-
-    # Get ALL pending prescriptions and filter in Python to avoid DB-specific date issues
-    pending_items_all = PrescriptionItem.objects.filter(dispensed=False).select_related(
+    # Pending prescriptions for the selected day only
+    pending_items_qs = PrescriptionItem.objects.filter(
+        dispensed=False,
+        prescription__prescribed_at__gte=start_of_day,
+        prescription__prescribed_at__lt=end_of_day,
+    )
+    if visit_ids is not None:
+        pending_items_qs = pending_items_qs.filter(prescription__visit_id__in=visit_ids)
+    if search_query:
+        pending_items_qs = pending_items_qs.filter(
+            Q(prescription__patient__first_name__icontains=search_query) |
+            Q(prescription__patient__last_name__icontains=search_query) |
+            Q(medication__name__icontains=search_query)
+        )
+    pending_items = list(pending_items_qs.select_related(
         'prescription__patient',
         'prescription__prescribed_by',
         'prescription__invoice',
         'prescription__visit',
         'medication'
-    ).order_by('-prescription__prescribed_at')
-    
-    # Python-side filtering for reliability
-    pending_items = [
-        item for item in pending_items_all 
-        if item.prescription and item.prescription.prescribed_at and timezone.localdate(item.prescription.prescribed_at) == filter_date
-    ]
+    ).order_by('-prescription__prescribed_at'))
 
-    # Get ALL pending consumables and filter in Python
+    # Pending consumables billed on the selected day
     from accounts.models import Invoice, InvoiceItem
     from inpatient.models import Admission
 
-    pending_consumables_all = InvoiceItem.objects.filter(
+    pending_consumables_qs = InvoiceItem.objects.filter(
         inventory_item__isnull=False,
-        invoice__status__in=['Draft', 'Pending', 'Paid', 'Partial']
-    ).select_related(
+        invoice__status__in=['Draft', 'Pending', 'Paid', 'Partial'],
+        created_at__gte=start_of_day,
+        created_at__lt=end_of_day,
+    )
+    if visit_ids is not None:
+        pending_consumables_qs = pending_consumables_qs.filter(invoice__visit_id__in=visit_ids)
+    if search_query:
+        # A (visit, item) pair always matches or misses as a whole, so
+        # filtering before the netting below does not change it
+        pending_consumables_qs = pending_consumables_qs.filter(
+            Q(invoice__patient__first_name__icontains=search_query) |
+            Q(invoice__patient__last_name__icontains=search_query) |
+            Q(inventory_item__name__icontains=search_query)
+        )
+    pending_consumables_list_raw = list(pending_consumables_qs.select_related(
         'invoice__patient',
         'invoice__visit',
         'inventory_item',
-    ).order_by('-created_at')
-    
-    pending_consumables_list_raw = [
-        ci for ci in pending_consumables_all
-        if ci.created_at and timezone.localdate(ci.created_at) == filter_date
-    ]
+    ).order_by('-created_at'))
 
-    # Group DispensedItem quantities to calculate net pending
-    from django.db.models import Sum
-    dispensed_map = {}
-    dispensed_qs = DispensedItem.objects.filter(
-        dispensed_at__range=(start_of_day, end_of_day)
-    ).values('visit_id', 'item_id').annotate(total_qty=Sum('quantity'))
-    
-    for d in dispensed_qs:
-        dispensed_map[(d['visit_id'], d['item_id'])] = d['total_qty']
+    # Units still owed per (visit, item) beyond open orders, from the fulfilment
+    # ledger; they belong to the newest invoice lines (dispensing is FIFO)
+    from inventory.utils import consumables_owed
+    owed = consumables_owed({ci.invoice.visit_id for ci in pending_consumables_list_raw})
 
-    pending_consumable_list = []
-    pool_usage = dispensed_map.copy()
+    # Skip IPD consumables only if the patient is currently admitted (handled by IPD dashboard)
+    # However, at discharge, the status is 'Discharged', so they should show up here.
+    admitted_visit_ids = set(Admission.objects.filter(
+        visit_id__in={visit_id for visit_id, _ in owed},
+        status='Admitted',
+    ).values_list('visit_id', flat=True))
 
+    pending_consumable_list = []
     for ci in pending_consumables_list_raw:
-        visit_id = ci.invoice.visit_id
-        item_id = ci.inventory_item_id
-        qty_invoiced = ci.quantity
-        
-        already_dispensed = pool_usage.get((visit_id, item_id), 0)
-        
-        if already_dispensed >= qty_invoiced:
-            pool_usage[(visit_id, item_id)] = already_dispensed - qty_invoiced
+        key = (ci.invoice.visit_id, ci.inventory_item_id)
+        units = min(ci.quantity, owed.get(key, 0))
+        if units <= 0:
             continue
-        elif already_dispensed > 0:
-            ci.quantity -= already_dispensed
-            pool_usage[(visit_id, item_id)] = 0
-
-        # Skip IPD consumables only if the patient is currently admitted (handled by IPD dashboard)
-        # However, at discharge, the status is 'Discharged', so they should show up here.
-        is_admitted = Admission.objects.filter(visit=ci.invoice.visit, status='Admitted').exists()
-        if not is_admitted:
+        owed[key] -= units
+        ci.quantity = units
+        if ci.invoice.visit_id not in admitted_visit_ids:
             pending_consumable_list.append(ci)
 
-    if search_query and search_query.strip():
-        search_query = search_query.lower().strip()
-        pending_items = [
-            item for item in pending_items
-            if search_query in (item.prescription.patient.first_name or '').lower()
-            or search_query in (item.prescription.patient.last_name or '').lower()
-            or search_query in (item.medication.name or '').lower()
-        ]
-        # Filter pending consumable list
-        pending_consumable_list = [
-            ci for ci in pending_consumable_list
-            if search_query.lower() in (ci.invoice.patient.first_name or '').lower()
-            or search_query.lower() in (ci.invoice.patient.last_name or '').lower()
-            or search_query.lower() in (ci.inventory_item.name or '').lower()
-        ]
-
     # ---- Build grouped data: separate OPD and IPD ----
     from collections import defaultdict
     from collections import OrderedDict
@@ -2377,20 +2274,12 @@ def pharmacy_dashboard(request):
         is_ipd = str(visit.visit_type).upper() == 'IN-PATIENT'
         group = ipd_visit_groups[visit.id] if is_ipd else opd_visit_groups[visit.id]
         
-        # Avoid duplicates
-        is_duplicate = False
-        for p_item in group['prescriptions']:
-            if p_item.medication_id == ci.inventory_item_id and p_item.quantity == ci.quantity:
-                is_duplicate = True
-                break
-        
-        if not is_duplicate:
-            group['patient'] = ci.invoice.patient
-            group['visit'] = visit
-            group['consumables'].append(ci)
-            if not group['invoice']:
-                group['invoice'] = ci.invoice
-                group['invoice_status'] = ci.invoice.status
+        group['patient'] = ci.invoice.patient
+        group['visit'] = visit
+        group['consumables'].append(ci)
+        if not group['invoice']:
+            group['invoice'] = ci.invoice
+            group['invoice_status'] = ci.invoice.status
 
 
     # Convert to list and sort
@@ -2404,6 +2293,55 @@ def pharmacy_dashboard(request):
     opd_groups = sort_groups(opd_visit_groups)
     ipd_groups = sort_groups(ipd_visit_groups)
 
+    return {
+        'opd_groups': opd_groups,
+        'ipd_groups': ipd_groups,
+        'pending_items': pending_items,
+        'pending_consumables': pending_consumable_list,
+    }
+
+
+@login_required
+def pharmacy_dashboard(request):
+    """Pharmacy dashboard showing OPD and IPD prescriptions, consumables, stock, and requests"""
+    # Role-based access control
+    if request.user.role not in ['Pharmacist', 'Nurse', 'Admin']:
+        messages.error(request, "Access denied. Only pharmacists, nurses and admins can access the pharmacy dashboard.")
+        return redirect('home:reception_dashboard')
+
+    # Always use the main Pharmacy department for this dashboard
+    pharmacy_dept, created = Departments.objects.get_or_create(
+        name='Pharmacy',
+        defaults={'abbreviation': 'PHR'}
+    )
+
+    # Date filter
+    from datetime import datetime, time
+    filter_date_str = request.GET.get('date')
+    if filter_date_str:
+        try:
+            filter_date = datetime.strptime(filter_date_str, '%Y-%m-%d').date()
+        except ValueError:
+            filter_date = timezone.localdate()
+    else:
+        filter_date = timezone.localdate()
+
+    start_of_day = timezone.make_aware(datetime.combine(filter_date, time.min))
+    end_of_day = timezone.make_aware(datetime.combine(filter_date + timedelta(days=1), time.min))
+
+    # Search functionality
+    search_query = request.GET.get('search', '')
+    stock_search = request.GET.get('stock_search', '')
+    dispensed_search = request.GET.get('dispensed_search', '')
+    request_search = request.GET.get('request_search', '')
+    search_query = search_query.strip()
+
+    queue = pharmacy_queue_groups(filter_date, search_query)
+    opd_groups = queue['opd_groups']
+    ipd_groups = queue['ipd_groups']
+    pending_items = queue['pending_items']
+    pending_consumable_list = queue['pending_consumables']
+
     # Get recently dispensed items (last 30 days)
     thirty_days_ago = timezone.now() - timedelta(days=30)
     dispensed_items = DispensedItem.objects.filter(
@@ -2437,23 +2375,25 @@ def pharmacy_dashboard(request):
 
     # Identify low stock items (below reorder level)
     low_stock_items = []
-    expiring_soon_items = []
     today = timezone.localdate()
     thirty_days_later = today + timedelta(days=30)
 
+    # Expiring batches come from the nightly expiry table (materialize_expiring_stock)
+    expiring_soon_items = list(
+        ExpiringBatch.objects.filter(location=pharmacy_dept, expiry_date__lte=thirty_days_later)
+        .select_related('item')
+    )
+
+    # Item balances at the pharmacy in one lookup instead of one SUM per batch
+    pharmacy_levels = StockLevel.quantities(pharmacy_dept)
+
     for stock in pharmacy_stock:
-        total_qty = StockRecord.objects.filter(
-            current_location=pharmacy_dept,
-            item=stock.item
-        ).aggregate(total=Sum('quantity'))['total'] or 0
+        total_qty = pharmacy_levels.get(stock.item_id, 0)
 
         if total_qty <= stock.item.reorder_level:
             if stock not in low_stock_items:
                 low_stock_items.append(stock)
 
-        if stock.expiry_date and stock.expiry_date <= thirty_days_later:
-            expiring_soon_items.append(stock)
-
     # Get inventory requests for pharmacy
     inventory_requests_all = InventoryRequest.objects.filter(
         location=pharmacy_dept
@@ -2477,7 +2417,8 @@ def pharmacy_dashboard(request):
         'low_stock_count': len(low_stock_items),
         'pending_requests': pending_requests_count,
         'dispensed_today': DispensedItem.objects.filter(
-            dispensed_at__range=(start_of_day, end_of_day)
+            dispensed_at__gte=start_of_day,
+            dispensed_at__lt=end_of_day,
         ).count(),
     }
 
@@ -2496,9 +2437,12 @@ def pharmacy_dashboard(request):
         'dispensed_search': dispensed_search,
         'request_search': request_search,
         'filter_date': filter_date,
+        # Today's unfiltered queue is kept current over the pharmacy queue socket
+        'live_queue': filter_date == timezone.localdate() and not search_query,
         'debug_info': {
-            'total_pending_all_dates': pending_items_all.count(),
-            'after_python_date_filter': len(pending_items),
+            'window_start': start_of_day,
+            'window_end': end_of_day,
+            'pending_items_count': len(pending_items),
             'consumables_count': len(pending_consumable_list),
             'filter_date': filter_date,
             'tz_now': timezone.now(),
@@ -2511,389 +2455,338 @@ def pharmacy_dashboard(request):
     return render(request, 'home/pharmacy_dashboard.html', context)
 
 
-@login_required
-@transaction.atomic
-@require_http_methods(["POST"])
-def dispense_all_visit_items(request, visit_id):
+def dispense_visits(visits, user):
     """
-    Dispense ALL pending items (medications + consumables) for a visit.
+    Dispense ALL pending items (medications + consumables) for one or more visits.
     - OPD: requires invoice to be Paid before dispensing.
     - IPD: dispenses immediately, creates invoice items at dispense time.
+    Pending lines and unpaid invoices are read with one query per kind for
+    all visits, and stock is allocated in a single locking pass. Returns
+    {visit_id: result} with the JSON body the single-visit endpoint answers.
+    Must run inside a transaction; a dispense that cannot be billed raises,
+    so the caller rolls it back rather than leave it unbilled.
     """
-    from accounts.models import Invoice, InvoiceItem
-    from inventory.models import StockAdjustment, DispensedItem
-    from inpatient.models import Admission
-
-    try:
-        visit = get_object_or_404(Visit, pk=visit_id)
+    from collections import defaultdict
+    from inventory.models import InventoryItem, VisitFulfilment
+    from inventory.utils import StockDemand, allocate_stock, consumables_owed
+    from inpatient.models import InpatientConsumable, MedicationChart
+
+    visit_ids = [visit.id for visit in visits]
+
+    # Always use Pharmacy department for stock deduction
+    pharmacy_dept = Departments.objects.get(name='Pharmacy')
+
+    # Determine which visits are IPD
+    admitted = set(Admission.objects.filter(
+        visit_id__in=visit_ids, status='Admitted'
+    ).values_list('visit_id', flat=True))
+
+    # ---- Gather pending items ----
+    # 1. Prescription medications (PrescriptionItem)
+    pending_meds = defaultdict(list)
+    for med in PrescriptionItem.objects.filter(
+        prescription__visit_id__in=visit_ids,
+        dispensed=False,
+    ).select_related('medication', 'prescription__invoice', 'prescription__patient'):
+        pending_meds[med.prescription.visit_id].append(med)
+
+    # 2. Pending consumables
+    # Scenario A: InpatientConsumable (Modern IPD deferred billing)
+    pending_ipd_consumable_reqs = defaultdict(list)
+    for req in InpatientConsumable.objects.filter(
+        admission__visit_id__in=visit_ids,
+        is_dispensed=False
+    ).select_related('item', 'admission'):
+        pending_ipd_consumable_reqs[req.admission.visit_id].append(req)
+
+    # Scenario B: billed consumables and direct-billed meds with no open order,
+    # straight from the visits' fulfilment ledger
+    owed = consumables_owed(visit_ids)
+    owed_items = InventoryItem.objects.in_bulk([item_id for _, item_id in owed])
+    pending_consumables = defaultdict(list)
+    for (visit_id, item_id), units in owed.items():
+        pending_consumables[visit_id].append((owed_items[item_id], units))
+
+    # 3. IPD: MedicationChart items
+    pending_charts = defaultdict(list)
+    for med_item in MedicationChart.objects.filter(
+        admission__visit_id__in=admitted,
+        is_dispensed=False,
+    ).select_related('item', 'admission__patient'):
+        pending_charts[med_item.admission.visit_id].append(med_item)
+
+    # ---- OPD: Check payment of every related invoice, for all visits at once ----
+    unpaid = defaultdict(list)
+    for visit_id, invoice_id in Invoice.objects.filter(
+        visit_id__in=[visit_id for visit_id in visit_ids if visit_id not in admitted]
+    ).exclude(status__in=['Cancelled', 'Paid']).order_by('id').values_list('visit_id', 'id'):
+        unpaid[visit_id].append(invoice_id)
+
+    results = {}
+    errors = defaultdict(list)
+    lines = []  # (visit, StockDemand)
+    for visit in visits:
+        is_ipd = visit.id in admitted
         patient = visit.patient
-        
-        # Role-based validation
-        if request.user.role not in ['Pharmacist', 'Nurse']:
-            return JsonResponse({'success': False, 'error': 'Unauthorized role.'})
-            
-        # Determine if IPD or OPD
-        is_ipd = Admission.objects.filter(visit=visit, status='Admitted').exists()
-        
+
         # Enforce role-based strictness
-        if is_ipd and request.user.role not in ['Nurse', 'Pharmacist', 'Admin']:
-            return JsonResponse({'success': False, 'error': 'Only pharmacists and nurses can dispense IPD medications.'})
-        if not is_ipd and request.user.role not in ['Pharmacist', 'Admin']:
-            return JsonResponse({'success': False, 'error': 'Only pharmacists can dispense OPD medications.'})
-
-        # Always use Pharmacy department for stock deduction
-        pharmacy_dept = Departments.objects.get(name='Pharmacy')
-
-        # ---- Gather pending items ----
-        # 1. Prescription medications (PrescriptionItem)
-        pending_meds = PrescriptionItem.objects.filter(
-            prescription__visit=visit,
-            dispensed=False,
-        ).select_related('medication', 'prescription__invoice', 'prescription__patient')
-
-        # 2. Pending consumables
-        # Scenario A: InpatientConsumable (Modern IPD deferred billing)
-        from inpatient.models import Admission, InpatientConsumable
-        pending_ipd_consumable_reqs = InpatientConsumable.objects.filter(
-            admission__visit=visit,
-            is_dispensed=False
-        ).select_related('item', 'admission')
-
-        # Scenario B: InvoiceItems marked as Consumable or Direct-Billed Meds (not from prescription)
-        pending_consumable_items = InvoiceItem.objects.filter(
-            invoice__visit=visit,
-            inventory_item__isnull=False,
-        ).select_related('inventory_item', 'invoice')
-
-        # Robust De-duplication for Consumables:
-        # Calculate total quantity already dispensed for each item in this visit
-        from django.db.models import Sum
-        dispensed_totals = {
-            item_id: total_qty for item_id, total_qty in 
-            DispensedItem.objects.filter(visit=visit).values_list('item_id').annotate(total=Sum('quantity'))
-        }
+        if is_ipd and user.role not in ['Nurse', 'Pharmacist', 'Admin']:
+            results[visit.id] = {'success': False, 'error': 'Only pharmacists and nurses can dispense IPD medications.'}
+            continue
+        if not is_ipd and user.role not in ['Pharmacist', 'Admin']:
+            results[visit.id] = {'success': False, 'error': 'Only pharmacists can dispense OPD medications.'}
+            continue
 
-        pending_consumables = []
-        # Track what we've already accounted for in this loop to handle multiple InvoiceItems for same item
-        accounted_for_dispensed = dispensed_totals.copy()
+        total_pending = (
+            len(pending_meds[visit.id]) + len(pending_consumables[visit.id]) + len(pending_ipd_consumable_reqs[visit.id])
+        )
+        if total_pending == 0:
+            results[visit.id] = {'success': False, 'error': 'No pending items found for this visit.'}
+            continue
 
-        for ci in pending_consumable_items:
-            item_id = ci.inventory_item_id
-            qty_needed = ci.quantity
-            
-            # 1. Skip if already covered by a prescription item (to prevent double billing/dispensing)
-            if any(pm.medication_id == item_id and pm.quantity == qty_needed for pm in pending_meds):
-                continue
-            
-            # 2. Check if this specific quantity has already been dispensed
-            already_dispensed = accounted_for_dispensed.get(item_id, 0)
-            if already_dispensed >= qty_needed:
-                # This item was already dispensed, subtract from pool and skip
-                accounted_for_dispensed[item_id] -= qty_needed
+        if unpaid[visit.id]:
+            inv_ids = ', '.join([f'INV-{invoice_id}' for invoice_id in unpaid[visit.id]])
+            results[visit.id] = {'success': False, 'error': f'Payment required. Unpaid invoices: {inv_ids}'}
+            continue
+
+        # ---- Collect every line; all visits are taken out of stock (FEFO) in one pass ----
+        demands = [
+            StockDemand(med.medication, med.quantity, pharmacy_dept,
+                        f'Dispensed to {patient.full_name} (Visit {visit.id})', source=med)
+            for med in pending_meds[visit.id]
+        ]
+        demands += [
+            StockDemand(item, units, pharmacy_dept,
+                        f'Consumable dispensed to {patient.full_name} (Visit {visit.id})')
+            for item, units in pending_consumables[visit.id]
+        ]
+        pending_ipd_meds = []
+        for med_item in pending_charts[visit.id]:
+            if med_item.quantity == 0:
+                errors[visit.id].append(f'Zero quantity for {med_item.item.name}')
                 continue
-            elif already_dispensed > 0:
-                # Partially dispensed? Adjust quantity to only dispense the remainder
-                ci.quantity -= already_dispensed
-                accounted_for_dispensed[item_id] = 0
-                
-            pending_consumables.append(ci)
+            pending_ipd_meds.append(med_item)
+        demands += [
+            StockDemand(med_item.item, med_item.quantity, pharmacy_dept,
+                        f'IPD Dispensed to {patient.full_name} (Visit {visit.id})', source=med_item)
+            for med_item in pending_ipd_meds
+        ]
+        demands += [
+            StockDemand(req.item, req.quantity, pharmacy_dept,
+                        f'Consumable dispensed to {patient.full_name} (Visit {visit.id})', source=req)
+            for req in pending_ipd_consumable_reqs[visit.id]
+        ]
+        lines += [(visit, demand) for demand in demands]
 
-        total_pending = pending_meds.count() + len(pending_consumables) + pending_ipd_consumable_reqs.count()
-        if total_pending == 0:
-            return JsonResponse({
-                'success': False,
-                'error': 'No pending items found for this visit.'
-            })
+    allocate_stock([demand for _, demand in lines], user)
 
-        # ---- OPD: Check payment ----
-        if not is_ipd:
-            # Check all related invoices are paid
-            invoices = Invoice.objects.filter(visit=visit).exclude(status='Cancelled')
-            unpaid = invoices.exclude(status='Paid')
-            if unpaid.exists():
-                inv_ids = ', '.join([f'INV-{inv.id}' for inv in unpaid])
-                return JsonResponse({
-                    'success': False,
-                    'error': f'Payment required. Unpaid invoices: {inv_ids}'
-                })
+    now = timezone.now()
+    dispensed = []
+    ipd_lines = defaultdict(list)
+    for visit, demand in lines:
+        if not demand.fulfilled:
+            errors[visit.id].append(f'Insufficient stock for {demand.item.name} (need {demand.quantity}, have {demand.available})')
+            continue
+        dispensed.append((visit, demand))
+        source = demand.source
+        # IPD medications and consumable requests are billed at dispense time
+        if isinstance(source, MedicationChart) and demand.item.selling_price > 0:
+            ipd_lines[visit.id].append(InvoiceItem(
+                inventory_item=demand.item,
+                name=f"{demand.item.name} (IPD Dispense)",
+                quantity=demand.quantity,
+                unit_price=demand.item.selling_price,
+            ))
+        elif isinstance(source, InpatientConsumable) and demand.item.selling_price > 0:
+            ipd_lines[visit.id].append(InvoiceItem(
+                inventory_item=demand.item,
+                name=f"{demand.item.name} (Consumable)",
+                quantity=demand.quantity,
+                unit_price=demand.item.selling_price,
+            ))
+
+    # Mark the sources dispensed, one UPDATE per kind
+    def dispensed_ids(kind):
+        return [d.source.pk for _, d in dispensed if isinstance(d.source, kind)]
+
+    PrescriptionItem.objects.filter(pk__in=dispensed_ids(PrescriptionItem)).update(
+        dispensed=True, dispensed_at=now, dispensed_by=user
+    )
+    for kind in (MedicationChart, InpatientConsumable):
+        # update() skips the ledger receivers, and dispensing changes what a
+        # deactivated chart asks for: swap its old contribution for the new one
+        ids = dispensed_ids(kind)
+        if not ids:
+            continue
+        before = VisitFulfilment.contributions(kind, ids)
+        kind.objects.filter(pk__in=ids).update(is_dispensed=True, dispensed_at=now, dispensed_by=user)
+        VisitFulfilment.record_contributions(before, sign=-1)
+        VisitFulfilment.record_contributions(VisitFulfilment.contributions(kind, ids))
+
+    DispensedItem.objects.bulk_create([
+        DispensedItem(
+            item=d.item,
+            patient=visit.patient,
+            visit=visit,
+            quantity=d.quantity,
+            dispensed_by=user,
+            department=pharmacy_dept,
+        )
+        for visit, d in dispensed
+    ])
+    VisitFulfilment.record('dispensed', [(visit.id, d.item.id, d.quantity) for visit, d in dispensed])
 
-        dispensed_count = 0
-        errors = []
-
-        # ---- Dispense medications ----
-        for med in pending_meds:
-            # Check stock (FEFO)
-            stock_records = StockRecord.objects.filter(
-                current_location=pharmacy_dept,
-                item=med.medication,
-                quantity__gt=0
-            ).order_by('expiry_date').select_for_update()
-
-            total_available = sum(r.quantity for r in stock_records)
-            if total_available < med.quantity:
-                errors.append(f'Insufficient stock for {med.medication.name} (need {med.quantity}, have {total_available})')
-                continue
+    for visit in visits:
+        if not ipd_lines[visit.id]:
+            continue
+        invoice = get_or_create_invoice(visit=visit, user=user)
+        note = f"IPD Billing for Visit {visit.id}"
+        if note not in (invoice.notes or ''):
+            invoice.notes = f"{invoice.notes}\n{note}" if invoice.notes else note
+            invoice.save(update_fields=['notes'])
+        invoice.add_items(ipd_lines[visit.id])
+
+    dispensed_counts = defaultdict(int)
+    for visit, _ in dispensed:
+        dispensed_counts[visit.id] += 1
+
+    for visit in visits:
+        if visit.id in results:
+            continue
+        dispensed_count = dispensed_counts[visit.id]
+        visit_errors = errors[visit.id]
 
-            # Deduct stock FEFO
-            remaining = med.quantity
-            for record in stock_records:
-                if remaining <= 0:
-                    break
-                take = min(record.quantity, remaining)
-                record.quantity -= take
-                record.save()
-                StockAdjustment.objects.create(
-                    item=med.medication,
-                    quantity=-take,
-                    adjustment_type='Usage',
-                    reason=f'Dispensed to {patient.full_name} (Visit {visit.id})',
-                    adjusted_by=request.user,
-                    adjusted_from=pharmacy_dept,
-                )
-                remaining -= take
+        if dispensed_count == 0:
+            results[visit.id] = {
+                'success': False,
+                'error': '; '.join(visit_errors) if visit_errors else 'No items could be dispensed'
+            }
+            continue
 
-            # Mark as dispensed
-            med.dispensed = True
-            med.dispensed_at = timezone.now()
-            med.dispensed_by = request.user
-            med.save()
+        message = f'Successfully dispensed {dispensed_count} items.'
+        if visit_errors:
+            message += f' Warnings: {"; ".join(visit_errors)}'
 
-            DispensedItem.objects.create(
-                item=med.medication,
-                patient=patient,
-                visit=visit,
-                quantity=med.quantity,
-                dispensed_by=request.user,
-                department=pharmacy_dept,
-            )
-            dispensed_count += 1
-
-        # ---- Dispense consumables ----
-        for ci in pending_consumables:
-            item = ci.inventory_item
-            qty = ci.quantity
-
-            # Check stock (FEFO)
-            stock_records = StockRecord.objects.filter(
-                current_location=pharmacy_dept,
-                item=item,
-                quantity__gt=0
-            ).order_by('expiry_date').select_for_update()
-
-            total_available = sum(r.quantity for r in stock_records)
-            if total_available < qty:
-                errors.append(f'Insufficient stock for {item.name} (need {qty}, have {total_available})')
-                continue
+        results[visit.id] = {
+            'success': True,
+            'message': message,
+            'dispensed_count': dispensed_count
+        }
 
-            # Deduct stock FEFO
-            remaining = qty
-            for record in stock_records:
-                if remaining <= 0:
-                    break
-                take = min(record.quantity, remaining)
-                record.quantity -= take
-                record.save()
-                StockAdjustment.objects.create(
-                    item=item,
-                    quantity=-take,
-                    adjustment_type='Usage',
-                    reason=f'Consumable dispensed to {patient.full_name} (Visit {visit.id})',
-                    adjusted_by=request.user,
-                    adjusted_from=pharmacy_dept,
-                )
-                remaining -= take
+    return {visit.id: results[visit.id] for visit in visits}
 
-            DispensedItem.objects.create(
-                item=item,
-                patient=patient,
-                visit=visit,
-                quantity=qty,
-                dispensed_by=request.user,
-                department=pharmacy_dept,
-            )
-            dispensed_count += 1
-
-        # ---- IPD: Also dispense MedicationChart items ----
-        if is_ipd:
-            pending_ipd_meds = MedicationChart.objects.filter(
-                admission__visit=visit,
-                is_dispensed=False,
-            ).select_related('item', 'admission__patient')
-
-            for med_item in pending_ipd_meds:
-                qty_to_dispense = med_item.quantity
-                if qty_to_dispense == 0:
-                    errors.append(f'Zero quantity for {med_item.item.name}')
-                    continue
-
-                stock_records = StockRecord.objects.filter(
-                    current_location=pharmacy_dept,
-                    item=med_item.item,
-                    quantity__gt=0
-                ).order_by('expiry_date').select_for_update()
-
-                total_available = sum(r.quantity for r in stock_records)
-                if total_available < qty_to_dispense:
-                    errors.append(f'Insufficient stock for {med_item.item.name} (need {qty_to_dispense}, have {total_available})')
-                    continue
-
-                # Deduct stock FEFO
-                remaining = qty_to_dispense
-                for record in stock_records:
-                    if remaining <= 0:
-                        break
-                    take = min(record.quantity, remaining)
-                    record.quantity -= take
-                    record.save()
-                    StockAdjustment.objects.create(
-                        item=med_item.item,
-                        quantity=-take,
-                        adjustment_type='Usage',
-                        reason=f'IPD Dispensed to {patient.full_name} (Visit {visit.id})',
-                        adjusted_by=request.user,
-                        adjusted_from=pharmacy_dept,
-                    )
-                    remaining -= take
-
-                # Mark as dispensed
-                med_item.is_dispensed = True
-                med_item.dispensed_at = timezone.now()
-                med_item.dispensed_by = request.user
-                if med_item.quantity == 0:
-                    med_item.quantity = qty_to_dispense
-                med_item.save()
-
-                DispensedItem.objects.create(
-                    item=med_item.item,
-                    patient=patient,
-                    visit=visit,
-                    quantity=qty_to_dispense,
-                    dispensed_by=request.user,
-                    department=pharmacy_dept,
-                )
 
-                # Add to IPD Invoice
-                try:
-                    invoice = Invoice.objects.filter(
-                        visit=visit,
-                        status__in=['Draft', 'Pending'],
-                    ).first()
-                    invoice = get_or_create_invoice(visit=visit, user=request.user)
-                    if invoice.notes:
-                        invoice.notes += f"\nIPD Billing for Visit {visit.id}"
-                    else:
-                        invoice.notes = f"IPD Billing for Visit {visit.id}"
-                    invoice.save()
-                    if med_item.item.selling_price > 0:
-                        InvoiceItem.objects.create(
-                            invoice=invoice,
-                            inventory_item=med_item.item,
-                            name=f"{med_item.item.name} (IPD Dispense)",
-                            quantity=qty_to_dispense,
-                            unit_price=med_item.item.selling_price,
-                        )
-                except Exception as inv_err:
-                    print(f"Invoicing failed for IPD med {med_item.id}: {str(inv_err)}")
-
-                dispensed_count += 1
-
-        # ---- Dispense InpatientConsumable requests (and bill them now) ----
-        for req in pending_ipd_consumable_reqs:
-            item = req.item
-            qty = req.quantity
-
-            # Check stock (FEFO)
-            stock_records = StockRecord.objects.filter(
-                current_location=pharmacy_dept,
-                item=item,
-                quantity__gt=0
-            ).order_by('expiry_date').select_for_update()
-
-            total_available = sum(r.quantity for r in stock_records)
-            if total_available < qty:
-                errors.append(f'Insufficient stock for {item.name} (need {qty}, have {total_available})')
-                continue
+@login_required
+@require_http_methods(["POST"])
+def dispense_all_visit_items(request, visit_id):
+    """
+    Dispense ALL pending items (medications + consumables) for a visit.
+    - OPD: requires invoice to be Paid before dispensing.
+    - IPD: dispenses immediately, creates invoice items at dispense time.
+    """
+    try:
+        visit = get_object_or_404(Visit.objects.select_related('patient'), pk=visit_id)
 
-            # Deduct stock FEFO
-            remaining = qty
-            for record in stock_records:
-                if remaining <= 0:
-                    break
-                take = min(record.quantity, remaining)
-                record.quantity -= take
-                record.save()
-                StockAdjustment.objects.create(
-                    item=item,
-                    quantity=-take,
-                    adjustment_type='Usage',
-                    reason=f'Consumable dispensed to {patient.full_name} (Visit {visit.id})',
-                    adjusted_by=request.user,
-                    adjusted_from=pharmacy_dept,
-                )
-                remaining -= take
+        # Role-based validation
+        if request.user.role not in ['Pharmacist', 'Nurse']:
+            return JsonResponse({'success': False, 'error': 'Unauthorized role.'})
 
-            # Create InvoiceItem (Billed now upon dispense)
-            try:
-                invoice = Invoice.objects.filter(
-                    visit=visit,
-                    status__in=['Draft', 'Pending'],
-                ).first()
-                invoice = get_or_create_invoice(visit=visit, user=request.user)
-                if invoice.notes:
-                    invoice.notes += f"\nConsumable billing for IPD dispense {visit.id}"
-                else:
-                    invoice.notes = f"Consumable billing for IPD dispense {visit.id}"
-                invoice.save()
+        # Errors leave the block, so nothing of a failed dispense is kept
+        with transaction.atomic(), deferred_invoice_totals():
+            return JsonResponse(dispense_visits([visit], request.user)[visit.id])
 
-                if item.selling_price > 0:
-                    InvoiceItem.objects.create(
-                        invoice=invoice,
-                        inventory_item=item,
-                        name=f"{item.name} (Consumable)",
-                        quantity=qty,
-                        unit_price=item.selling_price,
-                    )
-                    invoice.update_totals()
-            except Exception as inv_err:
-                print(f"Invoicing failed for consumable req {req.id}: {str(inv_err)}")
+    except Departments.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Pharmacy department not found'})
+    except Exception as e:
+        logger.exception("Dispensing visit %s failed", visit_id)
+        return JsonResponse({'success': False, 'error': str(e)})
 
-            # Mark request as dispensed
-            req.is_dispensed = True
-            req.dispensed_at = timezone.now()
-            req.dispensed_by = request.user
-            req.save()
 
-            DispensedItem.objects.create(
-                item=item,
-                patient=patient,
-                visit=visit,
-                quantity=qty,
-                dispensed_by=request.user,
-                department=pharmacy_dept,
-            )
-            dispensed_count += 1
+# Most visits one batch dispensing request may clear
+DISPENSE_BATCH_LIMIT = 100
 
-        if dispensed_count == 0:
-            return JsonResponse({
-                'success': False,
-                'error': '; '.join(errors) if errors else 'No items could be dispensed'
-            })
 
-        message = f'Successfully dispensed {dispensed_count} items.'
-        if errors:
-            message += f' Warnings: {"; ".join(errors)}'
+@login_required
+@require_http_methods(["POST"])
+def dispense_visits_batch(request):
+    """
+    Dispense all pending items for several visits in one request, e.g. a
+    run of paid OPD visits in the morning rush.
+    Body: {"idempotency_key": "<client generated>", "visit_ids": [...]}.
+    Answers per-visit results. Replaying a key returns the stored results
+    without dispensing again, so a double submission is harmless.
+    """
+    from django.db import IntegrityError
+    from inventory.models import DispenseBatch
 
+    try:
+        data = json.loads(request.body)
+        key = str(data.get('idempotency_key') or '').strip()
+        # Keep the first occurrence of each visit, in the order given
+        visit_ids = list(dict.fromkeys(int(visit_id) for visit_id in data.get('visit_ids') or []))
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({'success': False, 'error': 'Invalid request body.'}, status=400)
+
+    if not key or len(key) > 64:
+        return JsonResponse({'success': False, 'error': 'An idempotency key of up to 64 characters is required.'}, status=400)
+    if not visit_ids:
+        return JsonResponse({'success': False, 'error': 'No visits selected.'}, status=400)
+    if len(visit_ids) > DISPENSE_BATCH_LIMIT:
+        return JsonResponse({'success': False, 'error': f'At most {DISPENSE_BATCH_LIMIT} visits can be dispensed at once.'}, status=400)
+
+    def replay(batch):
+        if batch.dispensed_by_id != request.user.id or batch.visit_ids != visit_ids:
+            return JsonResponse({
+                'success': False,
+                'error': 'This idempotency key was already used for a different request.'
+            }, status=409)
         return JsonResponse({
-            'success': True,
-            'message': message,
-            'dispensed_count': dispensed_count
+            'success': any(result['success'] for result in batch.results.values()),
+            'replayed': True,
+            'results': batch.results,
         })
 
+    # A replay is answered from the stored batch: one indexed lookup, no locks
+    batch = DispenseBatch.objects.filter(idempotency_key=key).first()
+    if batch is not None:
+        return replay(batch)
+
+    # Role-based validation
+    if request.user.role not in ['Pharmacist', 'Nurse']:
+        return JsonResponse({'success': False, 'error': 'Unauthorized role.'})
+
+    try:
+        with transaction.atomic(), deferred_invoice_totals():
+            try:
+                # Claiming the key first makes a concurrent submission of it
+                # wait for this one and then replay its results
+                with transaction.atomic():
+                    batch = DispenseBatch.objects.create(
+                        idempotency_key=key, visit_ids=visit_ids, dispensed_by=request.user
+                    )
+            except IntegrityError:
+                return replay(DispenseBatch.objects.get(idempotency_key=key))
+
+            visits = Visit.objects.select_related('patient').in_bulk(visit_ids)
+            results = dispense_visits([visits[visit_id] for visit_id in visit_ids if visit_id in visits], request.user)
+            batch.results = {
+                str(visit_id): results.get(visit_id, {'success': False, 'error': 'Visit not found.'})
+                for visit_id in visit_ids
+            }
+            batch.save(update_fields=['results'])
+
     except Departments.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Pharmacy department not found'})
     except Exception as e:
+        logger.exception("Batch dispense %s failed", key)
         return JsonResponse({'success': False, 'error': str(e)})
 
+    return JsonResponse({
+        'success': any(result['success'] for result in batch.results.values()),
+        'replayed': False,
+        'results': batch.results,
+    })
+
 @login_required
 def appointments_dashboard(request):
     """
@@ -3494,9 +3387,7 @@ def patient_search_api(request):
     q = request.GET.get('q', '').strip()
     if len(q) < 2:
         return JsonResponse({'results': []})
-    patients = Patient.objects.filter(
-        Q(first_name__icontains=q) | Q(last_name__icontains=q) | Q(id_number__icontains=q)
-    )[:15]
+    patients = search_patients(q, limit=15)
     results = [{
         'id': p.id,
         'name': p.full_name,
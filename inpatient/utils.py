@@ -45,29 +45,28 @@ def handle_admission_transition(patient, new_visit, user, previous_invoice=None)
         from accounts.utils import get_or_create_invoice
         new_invoice = get_or_create_invoice(visit=new_visit, user=user)
         
-        items_transferred = 0
+        transferred_items = []
         for item in previous_invoice.items.all():
             # Only transfer unpaid items or the unpaid portion?
             # User said "zeroes its invoice", so we'll mirror the items
             if item.amount > item.paid_amount:
-                # Calculate unpaid portion
-                unpaid_amount = item.amount - item.paid_amount
-                
                 # In this system, we usually create a new item with the full price
                 # and mark the old one as "Paid" or "Canceled"
-                InvoiceItem.objects.create(
-                    invoice=new_invoice,
+                transferred_items.append(InvoiceItem(
                     service=item.service,
                     inventory_item=item.inventory_item,
                     name=item.name,
                     quantity=item.quantity,
                     unit_price=item.unit_price,
-                    amount=item.amount,
                     paid_amount=item.paid_amount, # Carry over what was already paid? 
                     # Usually we want the new invoice to show the total bill.
                     created_by=user
-                )
-                items_transferred += 1
+                ))
+        
+        # Bulk insert and recalculate the new invoice once
+        if transferred_items:
+            new_invoice.add_items(transferred_items)
+        items_transferred = len(transferred_items)
         
         # 4. Zero out/Cancel the previous invoice
         if items_transferred > 0:
@@ -389,7 +389,7 @@ def patient_case_folder(request, admission_id):
         }
 
     # 8. Consumables History (Unified UI list)
-    from inventory.models import DispensedItem
+    from inventory.models import DispensedItem, VisitFulfilment
     
     # Get all tracking records (Pending + Dispensed via new flow)
     consumable_reqs = InpatientConsumable.objects.filter(admission=admission).select_related('item', 'prescribed_by', 'dispensed_by')
@@ -409,17 +409,18 @@ def patient_case_folder(request, admission_id):
             'quantity': req.total_quantity
         })
         
-    # Deduplicate DispensedItems against InpatientConsumables
-    # If the combined requests account for the DispensedItem, we hide the DispensedItem.
-    consumed_dispensed_qty = {}
+    # Units dispensed on the visit (fulfilment ledger) beyond what the consumable
+    # requests above already show; list the newest dispenses that account for them
+    unlisted_qty = dict(VisitFulfilment.objects.filter(visit=admission.visit).values_list('item_id', 'dispensed'))
     for req in consumable_reqs:
-        if req.quantity_dispensed > 0:
-            consumed_dispensed_qty[req.item_id] = consumed_dispensed_qty.get(req.item_id, 0) + req.quantity_dispensed
+        shown = req.total_quantity if req.is_dispensed else req.quantity_dispensed
+        if req.item_id in unlisted_qty:
+            unlisted_qty[req.item_id] -= shown
 
     for ld in legacy_dispensed:
-        if consumed_dispensed_qty.get(ld.item_id, 0) >= ld.quantity:
-            consumed_dispensed_qty[ld.item_id] -= ld.quantity
+        if unlisted_qty.get(ld.item_id, 0) <= 0:
             continue
+        unlisted_qty[ld.item_id] -= ld.quantity
             
         dispensed_items_ui.append({
             'item_name': ld.item.name,
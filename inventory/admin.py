@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Supplier, InventoryCategory, InventoryItem, StockRecord, StockAdjustment, InventoryRequest
+from .models import Supplier, InventoryCategory, InventoryItem, StockRecord, StockLevel, StockMovement, StockSnapshot, ExpiringBatch, StockTake, StockTakeLine, StockAdjustment, InventoryRequest, VisitFulfilment, DispenseBatch
 
 @admin.register(Supplier)
 class SupplierAdmin(admin.ModelAdmin):
@@ -14,7 +14,7 @@ class InventoryCategoryAdmin(admin.ModelAdmin):
 class InventoryItemAdmin(admin.ModelAdmin):
     list_display = ('name', 'category', 'dispensing_unit', 'selling_price', 'is_dispensed_as_whole')
     list_filter = ('category',)
-    search_fields = ('name',)
+    search_fields = ('name', 'aliases')
 
 @admin.register(StockRecord)
 class StockRecordAdmin(admin.ModelAdmin):
@@ -22,6 +22,49 @@ class StockRecordAdmin(admin.ModelAdmin):
     list_filter = ('expiry_date', 'supplier', 'item__category')
     search_fields = ('batch_number', 'item__name')
 
+@admin.register(StockLevel)
+class StockLevelAdmin(admin.ModelAdmin):
+    list_display = ('item', 'location', 'quantity', 'updated_at')
+    list_filter = ('location',)
+    search_fields = ('item__name',)
+    readonly_fields = ('item', 'location', 'quantity', 'updated_at')
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'item', 'location', 'movement_type', 'quantity', 'balance_after', 'user')
+    list_filter = ('movement_type', 'location')
+    search_fields = ('item__name', 'reason')
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(StockSnapshot)
+class StockSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('taken_at', 'item', 'location', 'balance')
+    list_filter = ('location',)
+    search_fields = ('item__name',)
+    readonly_fields = ('item', 'location', 'movement', 'balance', 'taken_at')
+
+@admin.register(ExpiringBatch)
+class ExpiringBatchAdmin(admin.ModelAdmin):
+    list_display = ('item', 'batch_number', 'location', 'quantity', 'expiry_date', 'status', 'value_at_risk')
+    list_filter = ('status', 'location')
+    search_fields = ('item__name', 'batch_number')
+
+class StockTakeLineInline(admin.TabularInline):
+    model = StockTakeLine
+    extra = 0
+    raw_id_fields = ('item',)
+
+@admin.register(StockTake)
+class StockTakeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'location', 'status', 'started_at', 'started_by', 'posted_at', 'posted_by')
+    list_filter = ('status', 'location')
+    inlines = [StockTakeLineInline]
+
 @admin.register(StockAdjustment)
 class StockAdjustmentAdmin(admin.ModelAdmin):
     list_display = ('item', 'quantity', 'adjustment_type', 'adjusted_at', 'adjusted_by')
@@ -33,3 +76,15 @@ class InventoryRequestAdmin(admin.ModelAdmin):
     list_display = ('item', 'quantity', 'location', 'status', 'requested_at', 'requested_by')
     list_filter = ('status', 'requested_at', 'location')
     search_fields = ('item__name', 'requested_by__username')
+
+@admin.register(VisitFulfilment)
+class VisitFulfilmentAdmin(admin.ModelAdmin):
+    list_display = ('visit', 'item', 'requested', 'billed', 'dispensed')
+    search_fields = ('item__name', 'visit__patient__first_name', 'visit__patient__last_name')
+    readonly_fields = ('visit', 'item', 'requested', 'billed', 'dispensed')
+
+@admin.register(DispenseBatch)
+class DispenseBatchAdmin(admin.ModelAdmin):
+    list_display = ('idempotency_key', 'dispensed_by', 'created_at')
+    search_fields = ('idempotency_key',)
+    readonly_fields = ('idempotency_key', 'visit_ids', 'results', 'dispensed_by', 'created_at')
@@ -6,11 +6,12 @@ class InventoryItemForm(forms.ModelForm):
     class Meta:
         model = InventoryItem
         fields = [
-            'name', 'category', 'dispensing_unit', 
+            'name', 'aliases', 'category', 'dispensing_unit', 
             'is_dispensed_as_whole', 'selling_price'
         ]
         widgets = {
             'name': forms.TextInput(attrs={'placeholder': 'e.g. Paracetamol 500mg'}),
+            'aliases': forms.TextInput(attrs={'placeholder': 'e.g. Panadol, PCM'}),
             'dispensing_unit': forms.TextInput(attrs={'placeholder': 'e.g. Tablet, ml, Piece'}),
             'selling_price': forms.NumberInput(attrs={'step': '0.01', 'min': 0}),
         }
@@ -0,0 +1,54 @@
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from home.models import Departments
+from inventory.models import StockRecord, ExpiringBatch
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the expiring-stock table: every batch per location that has expired or expires within '
+        'the horizon, with its value at risk (schedule nightly)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Expiry horizon in days (default: 90)')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        today = timezone.localdate()
+        horizon = today + timedelta(days=options['days'])
+
+        batches = []
+        # One (current_location, expiry_date) index range scan per location
+        for location_id in Departments.objects.values_list('id', flat=True):
+            records = StockRecord.objects.filter(
+                current_location_id=location_id,
+                expiry_date__lte=horizon,
+                quantity__gt=0,
+            ).values_list('id', 'item_id', 'batch_number', 'quantity', 'expiry_date', 'purchase_price')
+            for record_id, item_id, batch_number, quantity, expiry_date, unit_cost in records:
+                batches.append(ExpiringBatch(
+                    stock_record_id=record_id,
+                    item_id=item_id,
+                    location_id=location_id,
+                    batch_number=batch_number,
+                    quantity=quantity,
+                    expiry_date=expiry_date,
+                    unit_cost=unit_cost,
+                    value_at_risk=(unit_cost or Decimal('0')) * quantity,
+                    status='Expired' if expiry_date < today else 'Expiring',
+                    computed_at=now,
+                ))
+
+        with transaction.atomic():
+            ExpiringBatch.objects.all().delete()
+            ExpiringBatch.objects.bulk_create(batches, batch_size=500)
+
+        expired = sum(1 for b in batches if b.status == 'Expired')
+        at_risk = sum((b.value_at_risk for b in batches), Decimal('0'))
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(batches)} batch(es) expired or expiring by {horizon} ({expired} expired), KES {at_risk:,.2f} at risk."
+        ))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from inventory.models import StockLevel, StockMovement, StockSnapshot
+
+
+class Command(BaseCommand):
+    help = (
+        'Checkpoints the stock movement ledger: snapshots the balance of every item and location that '
+        'moved since its last snapshot (schedule it, e.g. nightly). On first run it also opens the ledger '
+        'with the current stock levels.'
+    )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        with transaction.atomic():
+            # Balances that predate the ledger get an opening movement
+            tracked = set(StockMovement.objects.values_list('item_id', 'location_id').distinct())
+            opening = [
+                StockMovement(
+                    item_id=level.item_id,
+                    location_id=level.location_id,
+                    movement_type='Opening',
+                    quantity=level.quantity,
+                    balance_after=level.quantity,
+                    reason='Opening balance',
+                    created_at=now,
+                )
+                for level in StockLevel.objects.select_for_update().exclude(quantity=0)
+                if (level.item_id, level.location_id) not in tracked
+            ]
+            StockMovement.objects.bulk_create(opening, batch_size=500)
+
+            latest = {
+                (row['item_id'], row['location_id']): row['last']
+                for row in StockMovement.objects.values('item_id', 'location_id').annotate(last=Max('id')).order_by()
+            }
+            snapped = {
+                (row['item_id'], row['location_id']): row['last']
+                for row in StockSnapshot.objects.values('item_id', 'location_id').annotate(last=Max('movement_id')).order_by()
+            }
+            due = [movement_id for key, movement_id in latest.items() if snapped.get(key) != movement_id]
+
+            snapshots = []
+            for start in range(0, len(due), 500):
+                for movement in StockMovement.objects.filter(id__in=due[start:start + 500]):
+                    snapshots.append(StockSnapshot(
+                        item_id=movement.item_id,
+                        location_id=movement.location_id,
+                        movement=movement,
+                        balance=movement.balance_after,
+                        taken_at=now,
+                    ))
+            StockSnapshot.objects.bulk_create(snapshots, batch_size=500)
+
+        if opening:
+            self.stdout.write(f"Opened the ledger for {len(opening)} stock level(s).")
+        self.stdout.write(self.style.SUCCESS(f"Took {len(snapshots)} stock snapshot(s)."))
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from inventory.models import StockRecord, StockLevel, StockMovement
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the StockLevel balances with the StockRecord batches they summarise and optionally '
+        'repairs drift (also backfills the balances on first deployment)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Rewrite drifted balances from the stock records')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            expected = {
+                (row['item_id'], row['current_location_id']): row['total']
+                for row in StockRecord.objects.values('item_id', 'current_location_id')
+                .annotate(total=Sum('quantity')).order_by()
+            }
+            levels = {
+                (level.item_id, level.location_id): level
+                for level in StockLevel.objects.select_for_update()
+            }
+
+            drifted = []
+            for key in expected.keys() | levels.keys():
+                should_be = expected.get(key, 0)
+                level = levels.get(key)
+                recorded = level.quantity if level else 0
+                if recorded != should_be:
+                    drifted.append((key, recorded, should_be))
+
+            for (item_id, location_id), recorded, should_be in sorted(drifted):
+                self.stdout.write(self.style.WARNING(
+                    f"Item {item_id} at location {location_id}: level {recorded}, stock records {should_be}"
+                ))
+
+            if drifted and options['repair']:
+                missing, changed = [], []
+                for (item_id, location_id), _, should_be in drifted:
+                    level = levels.get((item_id, location_id))
+                    if level is None:
+                        missing.append(StockLevel(item_id=item_id, location_id=location_id, quantity=should_be))
+                    else:
+                        level.quantity = should_be
+                        level.updated_at = timezone.now()
+                        changed.append(level)
+                StockLevel.objects.bulk_create(missing, batch_size=500)
+                StockLevel.objects.bulk_update(changed, ['quantity', 'updated_at'], batch_size=500)
+                StockMovement.record(
+                    [(item_id, location_id, should_be - recorded, 'verify_stock_levels --repair')
+                     for (item_id, location_id), recorded, should_be in drifted],
+                    movement_type='Correction'
+                )
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(f"All {len(levels)} stock levels match their stock records."))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f"Repaired {len(drifted)} stock level(s)."))
+        else:
+            self.stdout.write(self.style.ERROR(f"{len(drifted)} stock level(s) drifted. Run with --repair to fix them."))
@@ -0,0 +1,70 @@
+from collections import defaultdict
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from inventory.models import FULFILMENT_SOURCES, VisitFulfilment
+
+COLUMNS = ('requested', 'billed', 'dispensed')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the VisitFulfilment ledger with the prescriptions, ward requests, invoice lines and '
+        'dispenses it summarises and optionally repairs drift (also backfills the ledger on first deployment)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Rewrite drifted rows from their sources')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            expected = defaultdict(lambda: dict.fromkeys(COLUMNS, 0))
+            for label, (column, visit_path, item_field, units) in FULFILMENT_SOURCES.items():
+                rows = (
+                    apps.get_model(label)._base_manager
+                    .filter(**{f'{visit_path}__isnull': False, f'{item_field}__isnull': False})
+                    .values_list(visit_path, item_field).annotate(total=Sum(units)).order_by()
+                )
+                for visit_id, item_id, total in rows:
+                    expected[(visit_id, item_id)][column] += total or 0
+            rows = {
+                (row.visit_id, row.item_id): row
+                for row in VisitFulfilment.objects.select_for_update()
+            }
+
+            drifted = []
+            for key in expected.keys() | rows.keys():
+                should_be = expected.get(key, dict.fromkeys(COLUMNS, 0))
+                row = rows.get(key)
+                recorded = {column: getattr(row, column) for column in COLUMNS} if row else dict.fromkeys(COLUMNS, 0)
+                if recorded != should_be:
+                    drifted.append((key, recorded, should_be))
+
+            for (visit_id, item_id), recorded, should_be in sorted(drifted):
+                self.stdout.write(self.style.WARNING(
+                    f"Visit {visit_id}, item {item_id}: ledger "
+                    f"{'/'.join(str(recorded[c]) for c in COLUMNS)}, sources "
+                    f"{'/'.join(str(should_be[c]) for c in COLUMNS)} (requested/billed/dispensed)"
+                ))
+
+            if drifted and options['repair']:
+                missing, changed = [], []
+                for (visit_id, item_id), _, should_be in drifted:
+                    row = rows.get((visit_id, item_id))
+                    if row is None:
+                        missing.append(VisitFulfilment(visit_id=visit_id, item_id=item_id, **should_be))
+                    else:
+                        for column in COLUMNS:
+                            setattr(row, column, should_be[column])
+                        changed.append(row)
+                VisitFulfilment.objects.bulk_create(missing, batch_size=500)
+                VisitFulfilment.objects.bulk_update(changed, list(COLUMNS), batch_size=500)
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(f"All {len(rows)} visit fulfilment rows match their sources."))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f"Repaired {len(drifted)} visit fulfilment row(s)."))
+        else:
+            self.stdout.write(self.style.ERROR(f"{len(drifted)} visit fulfilment row(s) drifted. Run with --repair to fix them."))
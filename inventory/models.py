@@ -1,5 +1,10 @@
-from django.db import models
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings
+from django.utils import timezone
 
 class Supplier(models.Model):
     name = models.CharField(max_length=200)
@@ -39,6 +44,7 @@ class InventoryItem(models.Model):
 
     
     name = models.CharField(max_length=200)
+    aliases = models.CharField(max_length=255, blank=True, default='', help_text="Other names it is searched by, comma separated (brand names, abbreviations)")
     category = models.ForeignKey(InventoryCategory, on_delete=models.CASCADE, related_name='items')
     
     # Dispensing Logic
@@ -100,9 +106,470 @@ class StockRecord(models.Model):
     purchase_ref = models.ForeignKey('accounts.InventoryPurchase', on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_records')
     current_location = models.ForeignKey('home.Departments', on_delete=models.CASCADE, related_name='stock_records')
 
+    class Meta:
+        indexes = [
+            # Expiry horizon scans per location (materialize_expiring_stock, FEFO)
+            models.Index(fields=['current_location', 'expiry_date']),
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            previous = None
+            if self.pk:
+                previous = StockRecord.objects.filter(pk=self.pk).values(
+                    'item_id', 'current_location_id', 'quantity'
+                ).first()
+            super().save(*args, **kwargs)
+
+            # Keep the per-location balance current (move the old figures out on edit)
+            movement_type = 'Receipt' if previous is None else None
+            if previous and (previous['item_id'], previous['current_location_id']) != (self.item_id, self.current_location_id):
+                StockLevel.adjust(previous['item_id'], previous['current_location_id'], -previous['quantity'], movement_type='Transfer Out')
+                previous, movement_type = None, 'Transfer In'
+            StockLevel.adjust(
+                self.item_id, self.current_location_id, self.quantity - (previous['quantity'] if previous else 0),
+                movement_type=movement_type
+            )
+
     def __str__(self):
         return f"{self.item.name} - Batch {self.batch_number} at {self.current_location}"
 
+
+class StockLevel(models.Model):
+    """
+    Stock on hand per item and location: the sum of its StockRecord batches.
+    Maintained by StockRecord.save and stock record deletion (queryset
+    update()/bulk_create() bypass it); check or repair with
+    `python manage.py verify_stock_levels`. Every change is logged to the
+    StockMovement ledger.
+    """
+    item = models.ForeignKey(InventoryItem, on_delete=models.CASCADE, related_name='stock_levels')
+    location = models.ForeignKey('home.Departments', on_delete=models.CASCADE, related_name='stock_levels')
+    quantity = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('item', 'location')
+
+    def __str__(self):
+        return f"{self.item.name} at {self.location}: {self.quantity}"
+
+    @classmethod
+    def adjust(cls, item_id, location_id, delta, create=True, movement_type=None):
+        """
+        Add (or with a negative delta, remove) stock from an item's balance at a
+        location. `movement_type` labels the ledger entry unless an enclosing
+        stock_movement() block does.
+        """
+        if not delta:
+            return
+        rows = cls.objects.filter(item_id=item_id, location_id=location_id)
+        if not rows.update(quantity=models.F('quantity') + delta, updated_at=timezone.now()):
+            if not create:
+                return
+            cls.objects.get_or_create(item_id=item_id, location_id=location_id)
+            rows.update(quantity=models.F('quantity') + delta, updated_at=timezone.now())
+        StockMovement.record([(item_id, location_id, delta, None)], default_type=movement_type)
+
+    @classmethod
+    def adjust_many(cls, changes, movement_type=None, user=None):
+        """
+        Apply [(item_id, location_id, delta, reason)] to the balances in one
+        UPDATE and log each change to the movement ledger (bulk stock writes
+        bypass StockRecord.save)
+        """
+        changes = [change for change in changes if change[2]]
+        deltas = {}
+        for item_id, location_id, delta, _ in changes:
+            deltas[(item_id, location_id)] = deltas.get((item_id, location_id), 0) + delta
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if deltas and cls._apply(deltas) < len(deltas):
+            # Balances not tracked yet: create them empty, then apply their deltas
+            existing = set(cls.objects.filter(cls._pairs(deltas)).values_list('item_id', 'location_id'))
+            missing = {key: delta for key, delta in deltas.items() if key not in existing}
+            cls.objects.bulk_create(
+                [cls(item_id=item_id, location_id=location_id) for item_id, location_id in missing],
+                batch_size=500, ignore_conflicts=True
+            )
+            cls._apply(missing)
+        StockMovement.record(changes, movement_type, user)
+
+    @staticmethod
+    def _pairs(keys):
+        pairs = models.Q()
+        for item_id, location_id in keys:
+            pairs |= models.Q(item_id=item_id, location_id=location_id)
+        return pairs
+
+    @classmethod
+    def _apply(cls, deltas):
+        """One UPDATE adding {(item_id, location_id): delta}; returns the rows matched"""
+        whens = [
+            models.When(item_id=item_id, location_id=location_id, then=models.Value(delta))
+            for (item_id, location_id), delta in deltas.items()
+        ]
+        return cls.objects.filter(cls._pairs(deltas)).update(
+            quantity=models.F('quantity') + models.Case(*whens, output_field=models.IntegerField()),
+            updated_at=timezone.now(),
+        )
+
+    @classmethod
+    def on_hand(cls, item, location):
+        """Balance of one item at one location"""
+        return cls.objects.filter(item=item, location=location).values_list('quantity', flat=True).first() or 0
+
+    @classmethod
+    def quantities(cls, location, items=None):
+        """{item_id: balance} at a location, optionally limited to some items"""
+        levels = cls.objects.filter(location=location)
+        if items is not None:
+            levels = levels.filter(item__in=items)
+        return dict(levels.values_list('item_id', 'quantity'))
+
+_movement_context = ContextVar('stock_movement_context', default={})
+
+
+@contextmanager
+def stock_movement(movement_type=None, reason='', user=None):
+    """
+    Label the stock movements written inside the block, e.g.
+    `with stock_movement('Transfer In', 'Transfer from Main Store', request.user): record.save()`
+    """
+    token = _movement_context.set({'movement_type': movement_type, 'reason': reason, 'user': user})
+    try:
+        yield
+    finally:
+        _movement_context.reset(token)
+
+
+class StockMovement(models.Model):
+    """
+    Append-only ledger of every change to a StockLevel with the balance it
+    left behind. Written by StockLevel.adjust()/adjust_many(); never updated
+    or deleted. StockSnapshot rows checkpoint it for point-in-time queries.
+    """
+    MOVEMENT_TYPES = [
+        ('Opening', 'Opening Balance'),
+        ('Receipt', 'Receipt'),
+        ('Transfer In', 'Transfer In'),
+        ('Transfer Out', 'Transfer Out'),
+        ('Dispense', 'Dispense'),
+        ('Usage', 'Usage'),
+        ('Adjustment', 'Adjustment'),
+        ('Removal', 'Removal'),
+        ('Correction', 'Correction'),
+    ]
+    item = models.ForeignKey(InventoryItem, on_delete=models.CASCADE, related_name='movements')
+    location = models.ForeignKey('home.Departments', on_delete=models.CASCADE, related_name='stock_movements')
+    movement_type = models.CharField(max_length=20, choices=MOVEMENT_TYPES)
+    quantity = models.IntegerField(help_text="Signed change: negative for stock leaving the location")
+    balance_after = models.IntegerField()
+    reason = models.TextField(blank=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['item', 'location', 'id']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.item.name} {self.movement_type} ({self.quantity:+}) at {self.location}: {self.balance_after}"
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError("Stock movements are append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Stock movements are append-only")
+
+    @classmethod
+    def record(cls, changes, movement_type=None, user=None, default_type=None):
+        """
+        Log [(item_id, location_id, delta, reason)] that were just applied to
+        StockLevel (inside the same transaction), in order. Type, reason and
+        user fall back to the enclosing stock_movement() block, then to
+        `default_type`.
+        """
+        changes = [change for change in changes if change[2]]
+        if not changes:
+            return []
+        context = _movement_context.get()
+        pairs = StockLevel._pairs({(item_id, location_id) for item_id, location_id, _, _ in changes})
+        balances = {
+            (item_id, location_id): quantity
+            for item_id, location_id, quantity in StockLevel.objects.filter(pairs).values_list('item_id', 'location_id', 'quantity')
+        }
+
+        # Walk back from the current balances so each line carries the balance right after it
+        now = timezone.now()
+        movements = []
+        for item_id, location_id, delta, reason in reversed(changes):
+            balance = balances.get((item_id, location_id), 0)
+            balances[(item_id, location_id)] = balance - delta
+            movements.append(cls(
+                item_id=item_id,
+                location_id=location_id,
+                movement_type=movement_type or context.get('movement_type') or default_type or 'Adjustment',
+                quantity=delta,
+                balance_after=balance,
+                reason=reason or context.get('reason') or '',
+                user=user or context.get('user'),
+                created_at=now,
+            ))
+        movements.reverse()
+        return cls.objects.bulk_create(movements, batch_size=500)
+
+    @classmethod
+    def balance_at(cls, item, location, when):
+        """
+        Stock of an item at a location as at `when`: the latest snapshot
+        taken by then plus the movements logged after it.
+        """
+        snapshot = StockSnapshot.objects.filter(item=item, location=location, taken_at__lte=when).order_by('-movement_id').first()
+        movements = cls.objects.filter(item=item, location=location, created_at__lte=when)
+        if snapshot:
+            movements = movements.filter(id__gt=snapshot.movement_id)
+        total = movements.aggregate(total=models.Sum('quantity'))['total'] or 0
+        return (snapshot.balance if snapshot else 0) + total
+
+
+class StockSnapshot(models.Model):
+    """Balance of an item at a location as of one ledger movement; see `python manage.py snapshot_stock_levels`"""
+    item = models.ForeignKey(InventoryItem, on_delete=models.CASCADE, related_name='stock_snapshots')
+    location = models.ForeignKey('home.Departments', on_delete=models.CASCADE, related_name='stock_snapshots')
+    movement = models.ForeignKey(StockMovement, on_delete=models.CASCADE, related_name='snapshots')
+    balance = models.IntegerField()
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['item', 'location', 'taken_at'])]
+
+    def __str__(self):
+        return f"{self.item.name} at {self.location}: {self.balance} ({self.taken_at:%Y-%m-%d %H:%M})"
+
+
+class ExpiringBatch(models.Model):
+    """
+    Batches expired or expiring within the horizon, per location, with the
+    value at risk at purchase price. Rebuilt nightly by
+    `python manage.py materialize_expiring_stock`; dashboards read this
+    instead of scanning stock records.
+    """
+    STATUS_CHOICES = [
+        ('Expired', 'Expired'),
+        ('Expiring', 'Expiring'),
+    ]
+    stock_record = models.OneToOneField(StockRecord, on_delete=models.CASCADE, related_name='expiry_alert')
+    item = models.ForeignKey(InventoryItem, on_delete=models.CASCADE, related_name='expiring_batches')
+    location = models.ForeignKey('home.Departments', on_delete=models.CASCADE, related_name='expiring_batches')
+    batch_number = models.CharField(max_length=100)
+    quantity = models.IntegerField()
+    expiry_date = models.DateField()
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    value_at_risk = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['expiry_date', 'item__name']
+        indexes = [models.Index(fields=['location', 'expiry_date'])]
+
+    def __str__(self):
+        return f"{self.item.name} {self.batch_number} at {self.location}: {self.quantity} ({self.status} {self.expiry_date})"
+
+
+class StockTake(models.Model):
+    """
+    A physical count of a whole location. Starting it snapshots the system
+    balance of every item there (and the ledger position), counts are entered
+    in bulk, and posting writes every variance as one correction. Stock is not
+    locked while counting: each line records the ledger position when it was
+    counted, and its variance is counted - (snapshot + movements between the
+    snapshot and the count), so stock dispensed before the shelf was counted
+    is not subtracted twice and stock moved after it is left alone.
+    """
+    STATUS_CHOICES = [
+        ('Counting', 'Counting'),
+        ('Posted', 'Posted'),
+        ('Cancelled', 'Cancelled'),
+    ]
+    location = models.ForeignKey('home.Departments', on_delete=models.CASCADE, related_name='stock_takes')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Counting')
+    snapshot_movement_id = models.BigIntegerField(default=0, help_text="Last ledger entry included in the snapshot")
+    started_at = models.DateTimeField(auto_now_add=True)
+    started_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='stock_takes_started')
+    posted_at = models.DateTimeField(null=True, blank=True)
+    posted_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_takes_posted')
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Stock take #{self.pk} of {self.location} ({self.status})"
+
+    @classmethod
+    def start(cls, location, user):
+        """Opens a stock take with a line per item held at `location`"""
+        with transaction.atomic():
+            # Hold the balances still while the snapshot and its ledger position are read
+            levels = list(
+                StockLevel.objects.select_for_update().filter(location=location)
+                .values_list('item_id', 'quantity').order_by()
+            )
+            latest = StockMovement.objects.filter(location=location).aggregate(latest=models.Max('id'))['latest']
+            take = cls.objects.create(location=location, started_by=user, snapshot_movement_id=latest or 0)
+            StockTakeLine.objects.bulk_create([
+                StockTakeLine(stock_take=take, item_id=item_id, system_quantity=quantity)
+                for item_id, quantity in levels if quantity
+            ], batch_size=500)
+        return take
+
+    def moved_since_snapshot(self):
+        """{item_id: net quantity} dispensed, received or transferred since the snapshot"""
+        return dict(
+            StockMovement.objects.filter(location=self.location, id__gt=self.snapshot_movement_id)
+            .values_list('item_id').annotate(total=models.Sum('quantity')).order_by()
+        )
+
+    def lines_with_movements(self):
+        """Lines annotated with `moved_before_count`: their item's net movement between the snapshot and the count"""
+        moved = StockMovement.objects.filter(
+            location=self.location, item=models.OuterRef('item'),
+            id__gt=self.snapshot_movement_id, id__lte=models.OuterRef('counted_at_movement_id'),
+        ).order_by().values('item').annotate(total=models.Sum('quantity')).values('total')
+        return self.lines.annotate(moved_before_count=Coalesce(models.Subquery(moved), 0))
+
+    def record_counts(self, counts):
+        """
+        Saves {item_id: counted quantity}; items outside the snapshot are added
+        with a system quantity of 0. Each new count records the ledger position
+        it was taken at.
+        """
+        with transaction.atomic():
+            # Wait for in-flight movements of the counted items so the position covers them
+            list(
+                StockLevel.objects.select_for_update().filter(location=self.location, item_id__in=list(counts))
+                .values_list('pk', flat=True)
+            )
+            position = StockMovement.objects.filter(location=self.location).aggregate(latest=models.Max('id'))['latest'] or 0
+            lines = {line.item_id: line for line in self.lines.all()}
+            changed, added = [], []
+            for item_id, counted in counts.items():
+                line = lines.get(item_id)
+                if line is None:
+                    added.append(StockTakeLine(
+                        stock_take=self, item_id=item_id, system_quantity=0,
+                        counted_quantity=counted, counted_at_movement_id=position,
+                    ))
+                elif line.counted_quantity != counted:
+                    line.counted_quantity = counted
+                    line.counted_at_movement_id = position
+                    changed.append(line)
+            StockTakeLine.objects.bulk_update(changed, ['counted_quantity', 'counted_at_movement_id'], batch_size=500)
+            StockTakeLine.objects.bulk_create(added, batch_size=500)
+        return len(changed) + len(added)
+
+    def post(self, user):
+        """
+        Applies every counted variance in one transaction: batches are locked
+        in one query and adjusted in memory (losses earliest expiry first,
+        surpluses onto the latest batch), then written in bulk with one
+        StockAdjustment per variance. Returns the adjustments.
+        """
+        with transaction.atomic():
+            take = StockTake.objects.select_for_update().get(pk=self.pk)
+            if take.status != 'Counting':
+                raise ValueError(f"Stock take #{take.pk} is already {take.status.lower()}.")
+
+            lines = [
+                line for line in self.lines_with_movements().select_related('item')
+                if line.counted_quantity is not None and line.variance
+            ]
+            batches = defaultdict(list)
+            locked = StockRecord.objects.select_for_update().filter(
+                current_location=self.location, item_id__in=[line.item_id for line in lines]
+            ).order_by('expiry_date', 'received_date', 'id')
+            for record in locked:
+                batches[record.item_id].append(record)
+
+            touched, created, changes, adjustments = {}, [], [], []
+            for line in lines:
+                records = batches[line.item_id]
+                # Never take more than is left after dispensing during the count
+                delta = max(line.variance, -sum(max(r.quantity, 0) for r in records))
+                line.posted_quantity = delta
+                if not delta:
+                    continue
+                if delta < 0:
+                    remaining = -delta
+                    for record in records:
+                        take_out = min(max(record.quantity, 0), remaining)
+                        if take_out:
+                            record.quantity -= take_out
+                            touched[record.pk] = record
+                            remaining -= take_out
+                elif records:
+                    records[-1].quantity += delta
+                    touched[records[-1].pk] = records[-1]
+                else:
+                    created.append(StockRecord(
+                        item=line.item, batch_number=f"STOCK-TAKE-{self.pk}",
+                        quantity=delta, current_location=self.location,
+                    ))
+
+                reason = (
+                    f"Stock take #{self.pk}: counted {line.counted_quantity}, "
+                    f"system {line.system_quantity} at snapshot, {line.moved_before_count:+} moved before the count"
+                )
+                changes.append((line.item_id, self.location.id, delta, reason))
+                adjustments.append(StockAdjustment(
+                    item=line.item, quantity=delta, adjustment_type='Correction',
+                    reason=reason, adjusted_by=user, adjusted_from=self.location,
+                ))
+
+            StockRecord.objects.bulk_update(list(touched.values()), ['quantity'], batch_size=500)
+            StockRecord.objects.bulk_create(created, batch_size=500)
+            StockLevel.adjust_many(changes, 'Correction', user)
+            StockAdjustment.objects.bulk_create(adjustments, batch_size=500)
+            StockTakeLine.objects.bulk_update(lines, ['posted_quantity'], batch_size=500)
+
+            self.status = 'Posted'
+            self.posted_by = user
+            self.posted_at = timezone.now()
+            self.save(update_fields=['status', 'posted_by', 'posted_at'])
+        return adjustments
+
+
+class StockTakeLine(models.Model):
+    stock_take = models.ForeignKey(StockTake, on_delete=models.CASCADE, related_name='lines')
+    item = models.ForeignKey(InventoryItem, on_delete=models.CASCADE, related_name='stock_take_lines')
+    system_quantity = models.IntegerField(help_text="Balance at the snapshot")
+    counted_quantity = models.IntegerField(null=True, blank=True)
+    counted_at_movement_id = models.BigIntegerField(null=True, blank=True, help_text="Last ledger entry before the count")
+    posted_quantity = models.IntegerField(null=True, blank=True, help_text="Correction applied when posted")
+
+    class Meta:
+        unique_together = ('stock_take', 'item')
+
+    def __str__(self):
+        return f"{self.item.name}: system {self.system_quantity}, counted {self.counted_quantity}"
+
+    @property
+    def expected_quantity(self):
+        """Balance when the shelf was counted; needs StockTake.lines_with_movements()"""
+        return self.system_quantity + self.moved_before_count
+
+    @property
+    def variance(self):
+        if self.counted_quantity is None:
+            return None
+        return self.counted_quantity - self.expected_quantity
+
+
 class StockAdjustment(models.Model):
     ADJUSTMENT_TYPES = [
         ('Usage', 'Usage'),
@@ -119,6 +586,9 @@ class StockAdjustment(models.Model):
     adjusted_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     adjusted_from = models.ForeignKey('home.Departments', on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [models.Index(fields=['adjustment_type', 'adjusted_at'])]
+
     def __str__(self):
         return f"{self.item.name} - {self.adjustment_type} ({self.quantity}) from {self.adjusted_from}"
 
@@ -154,6 +624,200 @@ class DispensedItem(models.Model):
     
     class Meta:
         ordering = ['-dispensed_at']
+        indexes = [models.Index(fields=['dispensed_at'])]
 
     def __str__(self):
-        return f"{self.item.name} x{self.quantity} to {self.patient}"
\ No newline at end of file
+        return f"{self.item.name} x{self.quantity} to {self.patient}"
+
+
+class DispenseBatch(models.Model):
+    """
+    One batch dispensing request, stored under the idempotency key its client
+    generated. Replaying the key answers with the stored per-visit results
+    instead of dispensing again.
+    """
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    visit_ids = models.JSONField(default=list)
+    results = models.JSONField(default=dict, help_text="Per-visit outcome, keyed by visit id")
+    dispensed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='dispense_batches')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Dispense batch {self.idempotency_key} ({len(self.visit_ids)} visits)"
+
+
+# What each source row contributes to the visit fulfilment ledger:
+# model -> (ledger column, path to the visit, item field, units counted)
+FULFILMENT_SOURCES = {
+    'home.PrescriptionItem': ('requested', 'prescription__visit_id', 'medication_id', Coalesce('quantity', 0)),
+    # Charts deactivated at discharge before being dispensed no longer ask for anything
+    'inpatient.MedicationChart': ('requested', 'admission__visit_id', 'item_id', models.Case(
+        models.When(models.Q(is_active=True) | models.Q(is_dispensed=True), then=models.F('quantity')),
+        default=0,
+    )),
+    # total_quantity is capped to what was handed over when a patient leaves
+    'inpatient.InpatientConsumable': ('requested', 'admission__visit_id', 'item_id', models.F('total_quantity')),
+    'accounts.InvoiceItem': ('billed', 'invoice__visit_id', 'inventory_item_id', models.F('quantity')),
+    'inventory.DispensedItem': ('dispensed', 'visit_id', 'item_id', models.F('quantity')),
+}
+
+
+class VisitFulfilmentQuerySet(models.QuerySet):
+    def pending(self):
+        """Rows with units still owed, annotated with pending_quantity"""
+        return self.annotate(
+            pending_quantity=Greatest('requested', 'billed') - models.F('dispensed')
+        ).filter(pending_quantity__gt=0)
+
+
+class VisitFulfilment(models.Model):
+    """
+    Units of an item requested (prescriptions, medication charts, ward
+    consumable requests), billed and dispensed on a visit, so pending work is
+    one indexed read per visit. Maintained in the same transaction as each
+    event by the receivers at the bottom of this module; Invoice.add_items
+    and bulk dispensing, which bypass save(), call record() themselves.
+    Check or backfill with `python manage.py verify_visit_fulfilment`.
+    """
+    visit = models.ForeignKey('home.Visit', on_delete=models.CASCADE, related_name='fulfilments')
+    item = models.ForeignKey(InventoryItem, on_delete=models.CASCADE, related_name='visit_fulfilments')
+    requested = models.IntegerField(default=0)
+    billed = models.IntegerField(default=0)
+    dispensed = models.IntegerField(default=0)
+
+    objects = VisitFulfilmentQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('visit', 'item')
+
+    def __str__(self):
+        return f"{self.item.name} on visit {self.visit_id}: {self.dispensed}/{max(self.requested, self.billed)}"
+
+    @property
+    def pending(self):
+        """Units still owed: whichever of requested and billed is larger, less what was dispensed"""
+        return max(max(self.requested, self.billed) - self.dispensed, 0)
+
+    @classmethod
+    def record(cls, field, changes):
+        """
+        Add [(visit_id, item_id, delta)] to one column ('requested', 'billed'
+        or 'dispensed') in one UPDATE. Rows are created for positive deltas
+        only, so removing a source whose visit is being deleted adds nothing.
+        """
+        deltas = defaultdict(int)
+        for visit_id, item_id, delta in changes:
+            if visit_id and item_id:
+                deltas[(visit_id, item_id)] += delta
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if deltas and cls._apply(field, deltas) < len(deltas):
+            existing = set(cls.objects.filter(cls._pairs(deltas)).values_list('visit_id', 'item_id'))
+            missing = {key: delta for key, delta in deltas.items() if key not in existing and delta > 0}
+            cls.objects.bulk_create(
+                [cls(visit_id=visit_id, item_id=item_id) for visit_id, item_id in missing],
+                batch_size=500, ignore_conflicts=True
+            )
+            cls._apply(field, missing)
+        if deltas:
+            from comms.utils import notify_pharmacy_queue
+            notify_pharmacy_queue(visit_id for visit_id, _ in deltas)
+
+    @staticmethod
+    def _pairs(keys):
+        pairs = models.Q()
+        for visit_id, item_id in keys:
+            pairs |= models.Q(visit_id=visit_id, item_id=item_id)
+        return pairs
+
+    @classmethod
+    def _apply(cls, field, deltas):
+        """One UPDATE adding {(visit_id, item_id): delta} to a column; returns the rows matched"""
+        if not deltas:
+            return 0
+        whens = [
+            models.When(visit_id=visit_id, item_id=item_id, then=models.Value(delta))
+            for (visit_id, item_id), delta in deltas.items()
+        ]
+        return cls.objects.filter(cls._pairs(deltas)).update(
+            **{field: models.F(field) + models.Case(*whens, output_field=models.IntegerField())}
+        )
+
+    @classmethod
+    def contributions(cls, model, rows):
+        """[(column, visit_id, item_id, units)] for source rows (a queryset or pks) of a FULFILMENT_SOURCES model"""
+        column, visit_path, item_field, units = FULFILMENT_SOURCES[model._meta.label]
+        if not isinstance(rows, models.QuerySet):
+            rows = model._base_manager.filter(pk__in=rows)
+        return [
+            (column, visit_id, item_id, quantity)
+            for visit_id, item_id, quantity in rows.values_list(visit_path, item_field, units)
+        ]
+
+    @classmethod
+    def record_contributions(cls, contributions, sign=1):
+        """Add (or with sign=-1, take out) what contributions() returned"""
+        by_column = defaultdict(list)
+        for column, visit_id, item_id, quantity in contributions:
+            by_column[column].append((visit_id, item_id, sign * (quantity or 0)))
+        for column, changes in by_column.items():
+            cls.record(column, changes)
+
+
+from django.db.models.signals import pre_delete, pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+@receiver(pre_delete, sender=StockRecord)
+def remove_stock_record_from_level(sender, instance, **kwargs):
+    """Take a deleted batch (incl. cascades and queryset deletes) out of its location balance"""
+    current = StockRecord.objects.filter(pk=instance.pk).values('item_id', 'current_location_id', 'quantity').first()
+    if current:
+        StockLevel.adjust(current['item_id'], current['current_location_id'], -current['quantity'], create=False, movement_type='Removal')
+
+
+@receiver([post_save, post_delete], sender=InventoryItem)
+@receiver([post_save, post_delete], sender=Medication)
+def invalidate_inventory_search_index(sender, **kwargs):
+    """Names, aliases or prices changed: search indexes are rebuilt on their next search"""
+    from .utils import bump_search_index_version
+    bump_search_index_version()
+
+
+@receiver(pre_save, sender='home.PrescriptionItem')
+@receiver(pre_save, sender='inpatient.MedicationChart')
+@receiver(pre_save, sender='inpatient.InpatientConsumable')
+@receiver(pre_save, sender='accounts.InvoiceItem')
+@receiver(pre_save, sender=DispensedItem)
+def remember_fulfilment_before_save(sender, instance, raw=False, **kwargs):
+    """Keep what an edited row counted for, so post_save can move it to the new figures"""
+    if not raw and not instance._state.adding and instance.pk:
+        instance._fulfilment_before = VisitFulfilment.contributions(sender, [instance.pk])
+
+
+@receiver(post_save, sender='home.PrescriptionItem')
+@receiver(post_save, sender='inpatient.MedicationChart')
+@receiver(post_save, sender='inpatient.InpatientConsumable')
+@receiver(post_save, sender='accounts.InvoiceItem')
+@receiver(post_save, sender=DispensedItem)
+def record_fulfilment_on_save(sender, instance, raw=False, **kwargs):
+    """Add a new or edited request, invoice line or dispense to its visit's fulfilment ledger"""
+    if raw:
+        return
+    before = instance.__dict__.pop('_fulfilment_before', [])
+    after = VisitFulfilment.contributions(sender, [instance.pk])
+    if before != after:
+        VisitFulfilment.record_contributions(before, sign=-1)
+        VisitFulfilment.record_contributions(after)
+    # Progress on an open order (e.g. a partial IPD dispense) moves no ledger
+    # column but still changes the queue card
+    from comms.utils import notify_pharmacy_queue
+    notify_pharmacy_queue(visit_id for _, visit_id, _, _ in before + after)
+
+
+@receiver(pre_delete, sender='home.PrescriptionItem')
+@receiver(pre_delete, sender='inpatient.MedicationChart')
+@receiver(pre_delete, sender='inpatient.InpatientConsumable')
+@receiver(pre_delete, sender='accounts.InvoiceItem')
+@receiver(pre_delete, sender=DispensedItem)
+def remove_fulfilment_on_delete(sender, instance, **kwargs):
+    """Take a deleted row (incl. cascades and queryset deletes) out of its visit's fulfilment ledger"""
+    VisitFulfilment.record_contributions(VisitFulfilment.contributions(sender, [instance.pk]), sign=-1)
@@ -1,3 +1,797 @@
-from django.test import TestCase
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import Invoice, InvoiceItem, InventoryPurchase
+from home.models import Departments, Patient, Prescription, PrescriptionItem, Visit
+from inpatient.models import Admission, InpatientConsumable, MedicationChart
+from users.models import User
+from .models import (
+    Supplier, InventoryCategory, InventoryItem, StockRecord, StockLevel, StockMovement, StockSnapshot, StockAdjustment,
+    ExpiringBatch, InventoryRequest, DispensedItem, DispenseBatch, Medication, StockTake, VisitFulfilment, stock_movement,
+)
+from .utils import (
+    StockDemand, allocate_stock, import_grn_lines, reorder_suggestions, draft_restock_requests, duplicate_candidates,
+    normalize_item_name, inventory_search_index, read_stock_counts, consumables_owed, daily_consumption,
+)
+
+
+# Cache tests run against a process-local cache whatever CACHE_URL says
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class InventoryTestMixin:
+    def setUp(self):
+        self.store = Departments.objects.create(name='Main Store')
+        self.pharmacy = Departments.objects.create(name='Pharmacy')
+        self.category = InventoryCategory.objects.create(name='Pharmaceuticals')
+        self.item = InventoryItem.objects.create(name='Paracetamol 500mg', category=self.category, dispensing_unit='Tablet')
+
+    def receive(self, quantity, location=None, batch='B1', **extra):
+        return StockRecord.objects.create(
+            item=self.item, batch_number=batch, quantity=quantity,
+            current_location=location or self.store, **extra
+        )
+
+
+class StockLevelTest(InventoryTestMixin, TestCase):
+    def test_level_follows_receipt_dispense_transfer_and_delete(self):
+        first = self.receive(100)
+        second = self.receive(50, batch='B2')
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 150)
+
+        # Dispense from a batch
+        first.quantity -= 30
+        first.save()
+        # Move a whole batch to the pharmacy
+        second.current_location = self.pharmacy
+        second.save()
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 70)
+        self.assertEqual(StockLevel.quantities(self.pharmacy), {self.item.id: 50})
+
+        StockRecord.objects.filter(pk=second.pk).delete()
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 0)
+
+    def test_stale_instance_save_does_not_double_count(self):
+        record = self.receive(100)
+        stale = StockRecord.objects.get(pk=record.pk)
+        record.quantity = 60
+        record.save()
+        stale.quantity = 90
+        stale.save()
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 90)
+
+    def test_verify_command_detects_and_repairs_drift(self):
+        self.receive(40)
+        self.receive(10, location=self.pharmacy)
+        # Writes that bypass StockRecord.save
+        StockRecord.objects.filter(current_location=self.store).update(quantity=25)
+        StockLevel.objects.filter(location=self.pharmacy).delete()
+
+        out = StringIO()
+        call_command('verify_stock_levels', stdout=out)
+        self.assertIn('2 stock level(s) drifted', out.getvalue())
+
+        call_command('verify_stock_levels', '--repair', stdout=StringIO())
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 25)
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 10)
+
+        out = StringIO()
+        call_command('verify_stock_levels', stdout=out)
+        self.assertIn('match their stock records', out.getvalue())
+
+
+class AllocateStockTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='PH001', password='x', role='Pharmacist')
+        self.other = InventoryItem.objects.create(name='Gauze Roll', category=self.category)
+
+    def test_earliest_expiry_first_across_lines(self):
+        late = self.receive(10, batch='LATE', expiry_date=date(2031, 1, 1))
+        early = self.receive(4, batch='EARLY', expiry_date=date(2030, 1, 1))
+        gauze = StockRecord.objects.create(item=self.other, batch_number='G1', quantity=5, current_location=self.store)
+
+        demands = [
+            StockDemand(self.item, 3, self.store, 'Line 1'),
+            StockDemand(self.item, 5, self.store, 'Line 2'),
+            StockDemand(self.other, 2, self.store, 'Line 3'),
+        ]
+        with transaction.atomic():
+            allocate_stock(demands, self.user)
+
+        self.assertTrue(all(d.fulfilled for d in demands))
+        self.assertEqual([(r.batch_number, n) for r, n in demands[1].allocations], [('EARLY', 1), ('LATE', 4)])
+        early.refresh_from_db()
+        late.refresh_from_db()
+        gauze.refresh_from_db()
+        self.assertEqual((early.quantity, late.quantity, gauze.quantity), (0, 6, 3))
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 6)
+        self.assertEqual(StockLevel.on_hand(self.other, self.store), 3)
+        self.assertEqual(
+            list(StockAdjustment.objects.order_by('id').values_list('reason', 'quantity')),
+            [('Line 1', -3), ('Line 2', -5), ('Line 3', -2)]
+        )
+
+    def test_short_line_is_left_untouched(self):
+        self.receive(5)
+        demands = [
+            StockDemand(self.item, 4, self.store, 'Fits'),
+            StockDemand(self.item, 4, self.store, 'Short'),
+            StockDemand(self.item, 1, self.pharmacy, 'Nothing here'),
+        ]
+        with transaction.atomic():
+            allocate_stock(demands, self.user)
+
+        self.assertEqual([d.fulfilled for d in demands], [True, False, False])
+        self.assertEqual((demands[1].available, demands[2].available), (1, 0))
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 1)
+        self.assertEqual(StockAdjustment.objects.count(), 1)
+
+    def test_batch_filter(self):
+        self.receive(5, batch='ABC-1', expiry_date=date(2030, 1, 1))
+        wanted = self.receive(5, batch='XYZ-2', expiry_date=date(2031, 1, 1))
+        with transaction.atomic():
+            demand, = allocate_stock([StockDemand(self.item, 3, self.store, 'Transfer', batch_number='xyz')], self.user)
+        self.assertEqual(demand.allocations, [(wanted, 3)])
+
+    def test_query_count_does_not_grow_with_lines(self):
+        items = [self.item, self.other] + [
+            InventoryItem.objects.create(name=f'Item {n}', category=self.category) for n in range(8)
+        ]
+        for item in items:
+            for batch in ('A', 'B'):
+                StockRecord.objects.create(item=item, batch_number=batch, quantity=3, current_location=self.store)
+        demands = [StockDemand(item, 5, self.store, 'Dispense All') for item in items]
+
+        # Lock, batch update, stock level update, ledger balances and insert, adjustment insert
+        with transaction.atomic(), self.assertNumQueries(6):
+            allocate_stock(demands, self.user)
+        self.assertTrue(all(d.fulfilled for d in demands))
+
+
+class StockMovementTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='PH001', password='x', role='Pharmacist')
+
+    def ledger(self, location):
+        return list(
+            StockMovement.objects.filter(item=self.item, location=location).order_by('id')
+            .values_list('movement_type', 'quantity', 'balance_after')
+        )
+
+    def test_every_change_is_logged_with_running_balance(self):
+        record = self.receive(100)
+        with transaction.atomic():
+            allocate_stock([
+                StockDemand(self.item, 10, self.store, 'Patient A'),
+                StockDemand(self.item, 5, self.store, 'Patient B'),
+            ], self.user)
+        with stock_movement('Transfer In', 'Transfer from Main Store', self.user):
+            self.receive(20, location=self.pharmacy)
+        StockRecord.objects.filter(pk=record.pk).delete()
+
+        self.assertEqual(self.ledger(self.store), [
+            ('Receipt', 100, 100), ('Dispense', -10, 90), ('Dispense', -5, 85), ('Removal', -85, 0),
+        ])
+        self.assertEqual(self.ledger(self.pharmacy), [('Transfer In', 20, 20)])
+        self.assertEqual(StockMovement.objects.filter(reason='Patient B', user=self.user).count(), 1)
+
+        movement = StockMovement.objects.first()
+        with self.assertRaises(ValueError):
+            movement.save()
+        with self.assertRaises(ValueError):
+            movement.delete()
+
+    def test_balance_at_uses_snapshot_and_later_movements(self):
+        record = self.receive(50)
+        record.quantity = 30
+        record.save()
+        call_command('snapshot_stock_levels', stdout=StringIO())
+        snapshot = StockSnapshot.objects.get(item=self.item, location=self.store)
+        self.assertEqual(snapshot.balance, 30)
+
+        record.quantity = 45
+        record.save()
+        # Backdate the receipt so the history spans days
+        first_day = timezone.now() - timedelta(days=2)
+        StockMovement.objects.filter(movement_type='Receipt').update(created_at=first_day)
+        self.assertEqual(StockMovement.balance_at(self.item, self.store, first_day), 50)
+
+        now = timezone.now()
+        with self.assertNumQueries(2):
+            self.assertEqual(StockMovement.balance_at(self.item, self.store, now), 45)
+        self.assertEqual(StockMovement.balance_at(self.item, self.pharmacy, now), 0)
+
+        # Nothing moved since the last snapshot: nothing new to take
+        record.quantity = 45
+        record.save()
+        out = StringIO()
+        call_command('snapshot_stock_levels', stdout=out)
+        call_command('snapshot_stock_levels', stdout=out)
+        self.assertIn('Took 0 stock snapshot(s)', out.getvalue())
+
+    def test_snapshot_opens_ledger_for_untracked_levels(self):
+        StockLevel.objects.create(item=self.item, location=self.pharmacy, quantity=12)
+        out = StringIO()
+        call_command('snapshot_stock_levels', stdout=out)
+        self.assertIn('Opened the ledger for 1 stock level(s)', out.getvalue())
+        self.assertEqual(self.ledger(self.pharmacy), [('Opening', 12, 12)])
+        self.assertEqual(StockMovement.balance_at(self.item, self.pharmacy, timezone.now()), 12)
+
+
+class GRNImportTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='ST001', password='x', role='Procurement')
+        self.supplier = Supplier.objects.create(name='MedSupplies Ltd')
+        self.purchase = InventoryPurchase.objects.create(supplier=self.supplier, total_amount=0, recorded_by=self.user)
+        self.gauze = InventoryItem.objects.create(name='Gauze Roll 10cm', category=self.category)
+        self.expiry = (timezone.localdate() + timedelta(days=365)).isoformat()
+
+    def test_pasted_delivery_is_received_in_one_go(self):
+        items = [InventoryItem.objects.create(name=f'Item {n}', category=self.category) for n in range(20)]
+        lines = ['Item\tBatch\tQty\tExpiry\tUnit cost', f'paracetamol  500MG\tP-1\t100\t{self.expiry}\t1.50']
+        lines += [f'{item.name}\tB-{n}\t10\t\t2' for n, item in enumerate(items)]
+
+        # Independent of the number of lines
+        with self.assertNumQueries(12):
+            records, errors = import_grn_lines(self.purchase, '\n'.join(lines), self.store, self.user)
+
+        self.assertEqual((len(records), errors), (21, []))
+        para = StockRecord.objects.get(item=self.item)
+        self.assertEqual((para.batch_number, para.quantity, para.purchase_ref, para.supplier), ('P-1', 100, self.purchase, self.supplier))
+        self.assertEqual(StockLevel.on_hand(self.item, self.store), 100)
+        self.assertEqual(StockMovement.objects.filter(movement_type='Receipt').count(), 21)
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.total_amount, 150 + 20 * 20)
+
+    def test_any_bad_line_rejects_the_whole_delivery(self):
+        text = '\n'.join([
+            f'Paracetamol 500mg,P-1,100,{self.expiry},1.50',
+            'Unknown drug,X-1,5,,1',
+            f'Gauze Roll 10cm,G-1,0,{self.expiry},1',
+            'Gauze Roll 10cm,G-2,5,2001-01-01,abc',
+            f'Paracetamol 500mg,p-1,10,{self.expiry},1.50',
+        ])
+        records, errors = import_grn_lines(self.purchase, text, self.store, self.user)
+
+        self.assertEqual(records, [])
+        self.assertEqual([line for line, _ in errors], [2, 3, 4, 5])
+        self.assertIn('no inventory item named "Unknown drug"', errors[0][1])
+        self.assertIn('invalid quantity', errors[1][1])
+        self.assertIn('expired', errors[2][1])
+        self.assertIn('invalid unit cost', errors[2][1])
+        self.assertIn('duplicate of line 1', errors[3][1])
+        self.assertFalse(StockRecord.objects.exists())
+        self.assertFalse(StockLevel.objects.exists())
+
+
+class ExpiringStockTest(InventoryTestMixin, TestCase):
+    def test_materialize_splits_expired_and_expiring_within_horizon(self):
+        today = timezone.localdate()
+        self.receive(10, batch='OLD', expiry_date=today - timedelta(days=3), purchase_price=2)
+        self.receive(4, location=self.pharmacy, batch='SOON', expiry_date=today + timedelta(days=20), purchase_price='1.50')
+        self.receive(6, batch='LATER', expiry_date=today + timedelta(days=200), purchase_price=1)
+        self.receive(0, batch='EMPTY', expiry_date=today - timedelta(days=1), purchase_price=1)
+        self.receive(8, batch='NOCOST', expiry_date=today + timedelta(days=5))
+
+        out = StringIO()
+        call_command('materialize_expiring_stock', stdout=out)
+        self.assertIn('3 batch(es)', out.getvalue())
+        self.assertEqual(
+            list(ExpiringBatch.objects.values_list('batch_number', 'location__name', 'status', 'value_at_risk')),
+            [('OLD', 'Main Store', 'Expired', 20), ('NOCOST', 'Main Store', 'Expiring', 0), ('SOON', 'Pharmacy', 'Expiring', 6)]
+        )
+
+        # A rebuild replaces the previous run
+        StockRecord.objects.filter(batch_number='OLD').update(quantity=0)
+        call_command('materialize_expiring_stock', '--days', '10', stdout=StringIO())
+        self.assertEqual(list(ExpiringBatch.objects.values_list('batch_number', flat=True)), ['NOCOST'])
+
+
+class ReorderSuggestionTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='PH001', password='x', role='Pharmacist')
+        self.patient = Patient.objects.create(
+            first_name='Jane', last_name='Doe', date_of_birth=date(1990, 1, 1), location='Town', gender='F'
+        )
+        self.today = timezone.localdate()
+
+    def use(self, item, location, quantity, days_ago, dispensed=False):
+        StockMovement.objects.create(
+            item=item, location=location, movement_type='Dispense' if dispensed else 'Usage',
+            quantity=-quantity, balance_after=0, user=self.user,
+            created_at=timezone.now() - timedelta(days=days_ago),
+        )
+
+    def test_suggests_cover_for_lead_time_and_review_period(self):
+        self.receive(50, location=self.pharmacy)
+        self.receive(500)
+        for days_ago in range(10):
+            self.use(self.item, self.pharmacy, 10, days_ago, dispensed=days_ago % 2 == 0)
+        self.use(self.item, self.pharmacy, 99, days_ago=30)  # Outside the window
+
+        suggestion, = reorder_suggestions(window_days=10, lead_time_days=7, review_days=14, today=self.today)
+        self.assertEqual((suggestion.item, suggestion.location_id), (self.item, self.pharmacy.id))
+        self.assertEqual((suggestion.daily_usage, suggestion.deviation, suggestion.on_hand), (10, 0, 50))
+        self.assertEqual((suggestion.reorder_point, suggestion.order_quantity), (70, 160))
+        self.assertEqual(suggestion.days_of_cover, 5)
+
+        # Pooled over the hospital the Main Store stock covers it
+        self.assertEqual(reorder_suggestions(by_location=False, window_days=10, today=self.today), [])
+
+    def test_variable_demand_raises_the_reorder_point(self):
+        self.receive(70, location=self.pharmacy)
+        for days_ago in range(0, 10, 2):
+            self.use(self.item, self.pharmacy, 20, days_ago)
+        suggestion, = reorder_suggestions(window_days=10, lead_time_days=7, review_days=14, today=self.today)
+        self.assertEqual((suggestion.daily_usage, suggestion.deviation), (10, 10))
+        self.assertGreater(suggestion.reorder_point, 70)
+
+    def test_query_count_does_not_grow_with_items(self):
+        for n in range(10):
+            item = InventoryItem.objects.create(name=f'Item {n}', category=self.category)
+            for days_ago in range(3):
+                self.use(item, self.pharmacy, 5, days_ago, dispensed=True)
+        # Consumption series, stock levels, items
+        with self.assertNumQueries(3):
+            suggestions = reorder_suggestions(window_days=10, today=self.today)
+        self.assertEqual(len(suggestions), 10)
+
+    def test_transferred_stock_counts_once_when_dispensed(self):
+        self.receive(100)
+        self.client.force_login(self.user)
+        self.client.post(reverse('inventory:transfer_stock'), {
+            'item': self.item.id, 'source_location': self.store.id,
+            'destination_location': self.pharmacy.id, 'quantity': 40,
+        })
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 40)
+        with transaction.atomic():
+            allocate_stock([StockDemand(self.item, 30, self.pharmacy, 'Patient A')], self.user)
+            # A free-of-charge usage the same day is its own units, not a duplicate
+            allocate_stock([StockDemand(self.item, 5, self.pharmacy, 'Ward use')], self.user, movement_type='Usage')
+
+        self.assertEqual(
+            {key: dict(days) for key, days in daily_consumption(self.today, by_location=False).items()},
+            {(self.item.id, None): {self.today: 35}}
+        )
+        self.assertEqual(list(daily_consumption(self.today)), [(self.item.id, self.pharmacy.id)])
+
+    def test_draft_restock_requests_skips_pending_items(self):
+        for days_ago in range(10):
+            self.use(self.item, self.pharmacy, 10, days_ago)
+        created = draft_restock_requests(self.pharmacy, self.store, self.user, window_days=10, today=self.today)
+        self.assertEqual(
+            [(r.item, r.location, r.requested_from, r.quantity, r.status) for r in created],
+            [(self.item, self.pharmacy, self.store, 210, 'Pending')]
+        )
+        self.assertEqual(draft_restock_requests(self.pharmacy, self.store, self.user, window_days=10, today=self.today), [])
+        self.assertEqual(InventoryRequest.objects.count(), 1)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class StockMatrixTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User.objects.create_user(id_number='ST001', password='x', role='Pharmacist')
+        self.client.force_login(self.user)
+        self.url = reverse('inventory:stock_matrix')
+
+    def test_matrix_is_limited_to_staff_who_can_transfer(self):
+        self.receive(30)
+        clerk = User.objects.create_user(id_number='ST002', password='x', role='Procurement')
+        self.client.force_login(clerk)
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_matrix_per_location_with_conditional_get(self):
+        self.receive(30)
+        self.receive(12, location=self.pharmacy)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['locations'], {
+            str(self.store.id): {str(self.item.id): 30},
+            str(self.pharmacy.id): {str(self.item.id): 12},
+        })
+
+        url = f'{self.url}?location_id={self.pharmacy.id}'
+        response = self.client.get(url)
+        self.assertEqual(response.json()['locations'], {str(self.pharmacy.id): {str(self.item.id): 12}})
+        etag = response['ETag']
+
+        # Unchanged: answered from the version aggregate alone
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        level_queries = [q['sql'] for q in queries if 'inventory_stocklevel' in q['sql']]
+        self.assertEqual(len(level_queries), 1)
+        self.assertIn('SUM(', level_queries[0])
+
+        # Stock elsewhere does not invalidate this department
+        self.receive(5, batch='B2')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.receive(8, location=self.pharmacy, batch='B3')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['locations'][str(self.pharmacy.id)], {str(self.item.id): 20})
+
+    def test_etag_follows_balances_not_ledger_ids(self):
+        self.receive(12, location=self.pharmacy)
+        url = f'{self.url}?location_id={self.pharmacy.id}'
+        etag = self.client.get(url)['ETag']
+
+        # A change committed after a newer ledger entry leaves the highest id where it was
+        latest = StockMovement.objects.aggregate(latest=Max('id'))['latest']
+        StockLevel.objects.filter(item=self.item, location=self.pharmacy).update(quantity=9)
+        self.assertEqual(StockMovement.objects.aggregate(latest=Max('id'))['latest'], latest)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['locations'][str(self.pharmacy.id)], {str(self.item.id): 9})
+
+
+class DuplicateCandidateTest(TestCase):
+    def test_normalizes_strengths_and_sizes(self):
+        self.assertEqual(normalize_item_name('Ceftriaxone Inj. 1g'), ('ceftriaxone inj', frozenset({'1000mg'})))
+        self.assertEqual(normalize_item_name('N/Saline 0.9% 500mls'), ('n saline', frozenset({'0.9%', '500ml'})))
+        self.assertEqual(normalize_item_name('Gloves Size 7.5'), ('gloves size', frozenset({'7.5'})))
+
+    def test_near_duplicates_ranked_within_blocks(self):
+        rows = [
+            (1, 'Cefriaxone 1g', ('Pharma', 'Injection')),
+            (2, 'Ceftriaxone 1000mg', ('Pharma', 'Injection')),
+            (3, 'Cotton woo', ('Supplies', '')),
+            (4, 'Cotton wool', ('Supplies', '')),
+            (5, 'Paracetamol 500mg', ('Pharma', 'Tablet')),
+            (6, 'Paracetamol 1g', ('Pharma', 'Tablet')),
+            (7, 'Gauze Roll 10cm', ('Supplies', '')),
+            (8, 'Gauze Roll 15cm', ('Supplies', '')),
+            (9, 'Ceftriaxone 1g', ('Pharma', 'Tablet')),
+            (10, 'Paracetamol 500 MG', ('Pharma', 'Tablet')),
+        ]
+        candidates = duplicate_candidates(rows)
+        self.assertEqual([(a, b) for _, a, b in candidates], [(5, 10), (3, 4), (1, 2)])
+        self.assertEqual(candidates[0][0], 1.0)
+
+    def test_missing_strength_penalty_applies_before_threshold(self):
+        rows = [(1, 'Amoxicillin 500mg', 'Pharma'), (2, 'Amoxicillin', 'Pharma')]
+        self.assertEqual(duplicate_candidates(rows), [(0.9, 1, 2)])
+        self.assertEqual(duplicate_candidates(rows, threshold=0.95), [])
+
+    def test_clean_duplicates_lists_pairs(self):
+        user = User.objects.create_user(id_number='AD001', password='x', role='Admin')
+        self.client.force_login(user)
+        category = InventoryCategory.objects.create(name='Supplies')
+        keep = InventoryItem.objects.create(name='Cotton wool', category=category)
+        typo = InventoryItem.objects.create(name='Cotton woo', category=category)
+        InventoryItem.objects.create(name='Surgical blade', category=category)
+
+        response = self.client.get(reverse('inventory:clean_duplicates'))
+        pair, = response.context['duplicate_pairs']
+        self.assertEqual({pair['item'], pair['other']}, {keep, typo})
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class InventorySearchIndexTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.item.aliases = 'Panadol, PCM'
+        self.item.save()
+        Medication.objects.create(item=self.item, generic_name='Acetaminophen', formulation='Tablet')
+        self.gauze = InventoryItem.objects.create(name='Gauze Roll', category=self.category, selling_price=50)
+        self.amox = InventoryItem.objects.create(name='Co-Amoxiclav 625mg', category=self.category)
+        self.user = User.objects.create_user(id_number='NU001', password='x', role='Nurse')
+        self.client.force_login(self.user)
+
+    def names(self, query, **kwargs):
+        return [entry['name'] for entry in inventory_search_index().search(query, **kwargs)]
+
+    def test_matches_names_generic_names_and_aliases(self):
+        self.assertEqual(self.names('pana'), ['Paracetamol 500mg'])
+        self.assertEqual(self.names('acetamin'), ['Paracetamol 500mg'])
+        self.assertEqual(self.names('AMOX'), ['Co-Amoxiclav 625mg'])
+        self.assertEqual(self.names('ro'), ['Gauze Roll'])
+        self.assertEqual(self.names('a', exclude_pharmaceuticals=True), [])
+        self.assertEqual(self.names('o'), [])
+        # Name prefix before a match inside the name
+        with self.captureOnCommitCallbacks(execute=True):
+            InventoryItem.objects.create(name='Olive Oil', category=self.category)
+        self.assertEqual(self.names('ol'), ['Olive Oil', 'Gauze Roll', 'Paracetamol 500mg'])
+        self.assertEqual(self.names('pa', exclude_pharmaceuticals=True), [])
+
+    def test_hot_path_skips_the_database_until_an_item_changes(self):
+        inventory_search_index()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names('gauze'), ['Gauze Roll'])
+
+        self.gauze.name = 'Gauze Swab'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gauze.save()
+            # Other workers keep the old index until the save commits
+            self.assertEqual(self.names('swab'), [])
+        self.assertEqual(self.names('swab'), ['Gauze Swab'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gauze.delete()
+        self.assertEqual(self.names('gauze'), [])
+
+    def test_search_endpoint_joins_department_stock(self):
+        self.receive(40, location=self.pharmacy)
+        response = self.client.get(reverse('inventory:search_inventory'), {'q': 'pcm', 'department_id': self.pharmacy.id})
+        result, = response.json()['results']
+        self.assertEqual((result['id'], result['stock'], result['text']), (self.item.id, 40, 'Paracetamol 500mg (Tablet)'))
+
+
+class StockTakeTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='AD001', password='x', role='Admin')
+        self.gauze = InventoryItem.objects.create(name='Gauze Roll', category=self.category)
+        self.syringe = InventoryItem.objects.create(name='Syringe 5ml', category=self.category)
+
+    def test_variances_allow_for_dispensing_during_the_count(self):
+        early = self.receive(30, location=self.pharmacy, batch='EARLY', expiry_date=date(2030, 1, 1))
+        late = self.receive(70, location=self.pharmacy, batch='LATE', expiry_date=date(2031, 1, 1))
+        StockRecord.objects.create(item=self.gauze, batch_number='G1', quantity=10, current_location=self.pharmacy)
+        self.receive(500)  # Other locations are not part of the count
+
+        take = StockTake.start(self.pharmacy, self.user)
+        self.assertEqual(
+            sorted(take.lines.values_list('item__name', 'system_quantity')),
+            [('Gauze Roll', 10), ('Paracetamol 500mg', 100)]
+        )
+
+        # Dispensing carries on while the shelves are counted
+        with transaction.atomic():
+            allocate_stock([StockDemand(self.item, 5, self.pharmacy, 'Patient A')], self.user)
+        self.assertEqual(take.moved_since_snapshot(), {self.item.id: -5})
+
+        counts, errors = read_stock_counts('Item,Counted\nparacetamol 500MG,60\nSyringe 5ml,12\nGauze Roll,10')
+        self.assertEqual(errors, [])
+        take.record_counts(counts)
+        adjustments = take.post(self.user)
+
+        # Counted 35 short of the 95 on hand when counted: the shelf count stands
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 60)
+        self.assertEqual(StockLevel.on_hand(self.syringe, self.pharmacy), 12)
+        self.assertEqual(StockLevel.on_hand(self.gauze, self.pharmacy), 10)
+        early.refresh_from_db()
+        late.refresh_from_db()
+        self.assertEqual((early.quantity, late.quantity), (0, 60))
+        self.assertEqual(
+            sorted((a.item.name, a.quantity, a.adjustment_type) for a in adjustments),
+            [('Paracetamol 500mg', -35, 'Correction'), ('Syringe 5ml', 12, 'Correction')]
+        )
+        self.assertEqual(StockRecord.objects.get(item=self.syringe).batch_number, f'STOCK-TAKE-{take.id}')
+        self.assertEqual(
+            StockMovement.objects.filter(movement_type='Correction', location=self.pharmacy).count(), 2
+        )
+        take.refresh_from_db()
+        self.assertEqual(take.status, 'Posted')
+        with self.assertRaises(ValueError):
+            take.post(self.user)
+
+    def test_loss_never_takes_more_than_is_left(self):
+        record = self.receive(20, location=self.pharmacy)
+        take = StockTake.start(self.pharmacy, self.user)
+        take.record_counts({self.item.id: 2})
+        record.quantity = 5  # Dispensed after the count
+        record.save()
+        adjustment, = take.post(self.user)
+        self.assertEqual(adjustment.quantity, -5)
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 0)
+
+    def test_count_upload_errors_reject_the_file(self):
+        counts, errors = read_stock_counts('Gauze Roll,4\nUnknown,3\nGauze roll,x')
+        self.assertEqual(counts, {})
+        self.assertEqual([line for line, _ in errors], [2, 3])
+
+    def test_grid_counts_and_posting_through_the_page(self):
+        self.receive(10, location=self.pharmacy)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('inventory:stock_take_list'), {'location_id': self.pharmacy.id})
+        take = StockTake.objects.get()
+        self.assertRedirects(response, reverse('inventory:stock_take_detail', args=[take.id]))
+
+        url = reverse('inventory:stock_take_detail', args=[take.id])
+        self.client.post(url, {'action': 'save_counts', f'count_{self.item.id}': '7'})
+        self.assertEqual(self.client.get(url).context['net_variance'], -3)
+        self.client.post(url, {'action': 'post', f'count_{self.item.id}': '8'})
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 8)
+        self.assertContains(self.client.get(reverse('inventory:stock_take_list')), 'Posted')
+
+
+class VisitFulfilmentTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='PH001', password='x', role='Pharmacist')
+        self.gauze = InventoryItem.objects.create(name='Gauze Roll', category=self.category, selling_price=20)
+        patient = Patient.objects.create(first_name='Jane', last_name='Doe', date_of_birth=date(1990, 1, 1), location='Town', gender='F')
+        self.visit = Visit.objects.create(patient=patient, visit_type='OUT-PATIENT', visit_mode='Walk In')
+        self.invoice = Invoice.objects.create(patient=patient, visit=self.visit)
+
+    def ledger(self, item):
+        row = VisitFulfilment.objects.filter(visit=self.visit, item=item).first()
+        return (row.requested, row.billed, row.dispensed) if row else None
+
+    def prescribe(self, quantity):
+        prescription = Prescription.objects.create(patient=self.visit.patient, visit=self.visit, diagnosis='Fever')
+        PrescriptionItem.objects.create(prescription=prescription, medication=self.item, quantity=quantity)
+        InvoiceItem.objects.create(invoice=self.invoice, inventory_item=self.item, name=self.item.name, quantity=quantity, unit_price=5)
+
+    def test_ledger_follows_requests_billing_and_dispensing(self):
+        self.prescribe(10)
+        line, = self.invoice.add_items([InvoiceItem(inventory_item=self.gauze, name='Gauze Roll (Consumable)', quantity=3, unit_price=20)])
+        self.assertEqual(self.ledger(self.item), (10, 10, 0))
+        self.assertEqual(self.ledger(self.gauze), (0, 3, 0))
+        # The prescribed units are an open order; only the gauze is owed on top
+        self.assertEqual(consumables_owed([self.visit.id]), {(self.visit.id, self.gauze.id): 3})
+
+        line = InvoiceItem.objects.get(inventory_item=self.gauze)
+        line.quantity = 4
+        line.save()
+        DispensedItem.objects.create(item=self.gauze, patient=self.visit.patient, visit=self.visit, quantity=1, dispensed_by=self.user)
+        self.assertEqual(self.ledger(self.gauze), (0, 4, 1))
+        self.assertEqual(VisitFulfilment.objects.get(visit=self.visit, item=self.gauze).pending, 3)
+
+        line.delete()
+        self.assertEqual(self.ledger(self.gauze), (0, 0, 1))
+        self.assertEqual(consumables_owed([self.visit.id]), {})
+
+    def test_dispense_all_reads_pending_consumables_from_the_ledger(self):
+        self.receive(50, location=self.pharmacy)
+        StockRecord.objects.create(item=self.gauze, batch_number='G1', quantity=20, current_location=self.pharmacy)
+        self.prescribe(10)
+        # Same item and quantity billed a second time as a consumable: still owed
+        InvoiceItem.objects.create(invoice=self.invoice, inventory_item=self.item, name='Paracetamol (Consumable)', quantity=10, unit_price=5)
+        InvoiceItem.objects.create(invoice=self.invoice, inventory_item=self.gauze, name='Gauze Roll (Consumable)', quantity=2, unit_price=20)
+        Invoice.objects.filter(pk=self.invoice.pk).update(status='Paid')
+
+        self.client.force_login(self.user)
+        url = reverse('home:dispense_all_visit_items', args=[self.visit.id])
+        response = self.client.post(url)
+        self.assertTrue(response.json()['success'], response.json())
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 30)
+        self.assertEqual(StockLevel.on_hand(self.gauze, self.pharmacy), 18)
+        self.assertEqual(self.ledger(self.item), (10, 20, 20))
+        self.assertEqual(self.ledger(self.gauze), (0, 2, 2))
+        self.assertFalse(VisitFulfilment.objects.filter(visit=self.visit).pending().exists())
+        self.assertFalse(self.client.post(url).json()['success'])
+
+    def test_verify_command_backfills_and_repairs(self):
+        self.prescribe(6)
+        VisitFulfilment.objects.all().delete()
+        out = StringIO()
+        call_command('verify_visit_fulfilment', stdout=out)
+        self.assertIn('1 visit fulfilment row(s) drifted', out.getvalue())
+        call_command('verify_visit_fulfilment', '--repair', stdout=StringIO())
+        self.assertEqual(self.ledger(self.item), (6, 6, 0))
+        out = StringIO()
+        call_command('verify_visit_fulfilment', stdout=out)
+        self.assertIn('All 1 visit fulfilment rows match', out.getvalue())
+
+
+class DispenseBatchTest(InventoryTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(id_number='PH001', password='x', role='Pharmacist')
+        self.receive(100, location=self.pharmacy)
+        self.url = reverse('home:dispense_visits_batch')
+        self.client.force_login(self.user)
+
+    def opd_visit(self, name, quantity, paid=True):
+        patient = Patient.objects.create(first_name=name, last_name='Doe', date_of_birth=date(1990, 1, 1), location='Town', gender='F')
+        visit = Visit.objects.create(patient=patient, visit_type='OUT-PATIENT', visit_mode='Walk In')
+        invoice = Invoice.objects.create(patient=patient, visit=visit)
+        prescription = Prescription.objects.create(patient=patient, visit=visit, invoice=invoice, diagnosis='Fever')
+        PrescriptionItem.objects.create(prescription=prescription, medication=self.item, quantity=quantity)
+        InvoiceItem.objects.create(invoice=invoice, inventory_item=self.item, name=self.item.name, quantity=quantity, unit_price=5)
+        if paid:
+            Invoice.objects.filter(pk=invoice.pk).update(status='Paid')
+        return visit
+
+    def post(self, key, visit_ids):
+        return self.client.post(self.url, {'idempotency_key': key, 'visit_ids': visit_ids}, content_type='application/json')
+
+    def test_dispenses_each_visit_and_reports_per_visit(self):
+        first, second = self.opd_visit('Ann', 10), self.opd_visit('Ben', 20)
+        unpaid = self.opd_visit('Cy', 5, paid=False)
+        response = self.post('key-1', [first.id, unpaid.id, second.id, 999999])
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertFalse(data['replayed'])
+        self.assertEqual(list(data['results']), [str(first.id), str(unpaid.id), str(second.id), '999999'])
+        self.assertEqual(data['results'][str(first.id)]['dispensed_count'], 1)
+        self.assertIn('Payment required', data['results'][str(unpaid.id)]['error'])
+        self.assertEqual(data['results']['999999'], {'success': False, 'error': 'Visit not found.'})
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 70)
+        self.assertEqual(DispensedItem.objects.filter(visit=second).get().quantity, 20)
+        self.assertFalse(PrescriptionItem.objects.filter(prescription__visit__in=[first, second], dispensed=False).exists())
+
+    def test_queries_do_not_grow_with_the_number_of_visits(self):
+        def queries(count, key):
+            visit_ids = [self.opd_visit(f'P{key}{n}', 2).id for n in range(count)]
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertTrue(self.post(key, visit_ids).json()['success'])
+            return len(ctx.captured_queries)
+
+        self.assertEqual(queries(2, 'a'), queries(6, 'b'))
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 84)
+
+    def test_batch_dispense_leaves_the_fulfilment_ledger_in_step(self):
+        patient = Patient.objects.create(first_name='Ida', last_name='Doe', date_of_birth=date(1990, 1, 1), location='Town', gender='F')
+        visit = Visit.objects.create(patient=patient, visit_type='IN-PATIENT', visit_mode='Walk In')
+        admission = Admission.objects.create(patient=patient, visit=visit, provisional_diagnosis='Malaria')
+        MedicationChart.objects.create(admission=admission, item=self.item, quantity=6)
+        # Stopped before it was dispensed: asks for nothing until it is
+        MedicationChart.objects.create(admission=admission, item=self.item, quantity=4, is_active=False)
+        InpatientConsumable.objects.create(admission=admission, item=self.item, quantity=2, total_quantity=2)
+        self.assertEqual(VisitFulfilment.objects.get(visit=visit, item=self.item).requested, 8)
+
+        self.assertTrue(self.post('key-1', [visit.id]).json()['results'][str(visit.id)]['success'])
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 88)
+        row = VisitFulfilment.objects.get(visit=visit, item=self.item)
+        self.assertEqual((row.requested, row.dispensed), (12, 12))
+        out = StringIO()
+        call_command('verify_visit_fulfilment', stdout=out)
+        self.assertIn('match', out.getvalue())
+        self.assertNotIn('drifted', out.getvalue())
+
+    def test_dispense_that_cannot_be_billed_is_rolled_back(self):
+        patient = Patient.objects.create(first_name='Ida', last_name='Doe', date_of_birth=date(1990, 1, 1), location='Town', gender='F')
+        visit = Visit.objects.create(patient=patient, visit_type='IN-PATIENT', visit_mode='Walk In')
+        admission = Admission.objects.create(patient=patient, visit=visit, provisional_diagnosis='Malaria')
+        chart = MedicationChart.objects.create(admission=admission, item=self.item, quantity=6)
+        InpatientConsumable.objects.create(admission=admission, item=self.item, quantity=2, total_quantity=2)
+        self.item.selling_price = 10
+        self.item.save()
+
+        with mock.patch.object(Invoice, 'add_items', side_effect=DatabaseError('lock wait timeout')):
+            response = self.post('key-1', [visit.id])
+            self.assertFalse(response.json()['success'])
+            single = self.client.post(reverse('home:dispense_all_visit_items', args=[visit.id])).json()
+            self.assertEqual(single, {'success': False, 'error': 'lock wait timeout'})
+
+        chart.refresh_from_db()
+        self.assertFalse(chart.is_dispensed)
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 100)
+        self.assertFalse(DispensedItem.objects.exists())
+        # The key was released with the rest, so the dispense can be retried
+        self.assertFalse(DispenseBatch.objects.exists())
+        self.assertTrue(self.post('key-1', [visit.id]).json()['results'][str(visit.id)]['success'])
+        self.assertEqual(
+            sorted(InvoiceItem.objects.filter(invoice__visit=visit).values_list('quantity', flat=True)), [2, 6]
+        )
+
+    def test_replayed_key_is_a_no_op(self):
+        visit = self.opd_visit('Ann', 10)
+        first = self.post('key-1', [visit.id]).json()
+
+        with CaptureQueriesContext(connection) as ctx:
+            replay = self.post('key-1', [visit.id]).json()
+        # Past the session and user, the stored batch is the only thing read
+        app_queries = [q['sql'] for q in ctx.captured_queries if 'inventory_' in q['sql'] or 'home_' in q['sql']]
+        self.assertEqual(len(app_queries), 1)
+        self.assertIn('inventory_dispensebatch', app_queries[0])
+        self.assertTrue(replay['replayed'])
+        self.assertEqual(replay['results'], first['results'])
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 90)
+        self.assertEqual(DispenseBatch.objects.count(), 1)
+
+        # The key cannot be reused for other visits
+        other = self.opd_visit('Ben', 5)
+        response = self.post('key-1', [other.id])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(StockLevel.on_hand(self.item, self.pharmacy), 90)
@@ -14,13 +14,18 @@ urlpatterns = [
     # Dispensing APIs
     path('api/search/', views.search_inventory, name='search_inventory'),
     path('api/dispense/', views.dispense_item, name='dispense_item'),
+    path('api/stock-matrix/', views.stock_matrix, name='stock_matrix'),
     
     # Procurement
     path('procurement/', views.procurement_dashboard, name='procurement_dashboard'),
     path('procurement/add/', views.add_inventory_purchase, name='add_inventory_purchase'),
+    path('procurement/reorder/', views.draft_reorder_requests, name='draft_reorder_requests'),
     path('procurement/<int:grn_id>/add-items/', views.add_grn_item, name='add_grn_item'),
     path('procurement/<int:grn_id>/delete-item/<int:record_id>/', views.delete_grn_item, name='delete_grn_item'),
     path('stock-activity/', views.stock_activity, name='stock_activity'),
+    path('expiry/', views.expiry_report, name='expiry_report'),
+    path('stock-takes/', views.stock_take_list, name='stock_take_list'),
+    path('stock-takes/<int:take_id>/', views.stock_take_detail, name='stock_take_detail'),
     path('items/<int:item_id>/distribution/', views.inventory_distribution, name='inventory_distribution'),
     path('items/<int:item_id>/update-details/', views.update_item_details, name='update_item_details'),
     path('items/<int:item_id>/reconcile/<int:location_id>/', views.reconcile_stock, name='reconcile_stock'),
@@ -1,5 +1,19 @@
+import csv
+import io
+import logging
+import math
+import re
+import uuid
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from django.db.models import DecimalField, F, Q, Sum
 from django.utils import timezone
-from datetime import time
+from datetime import datetime, time
+from time import monotonic
+
+logger = logging.getLogger(__name__)
 
 def get_current_dispensing_department():
     """
@@ -15,3 +29,653 @@ def get_current_dispensing_department():
         return "Pharmacy"
     else:
         return "Mini Pharmacy"
+
+
+class StockDemand:
+    """
+    One line to take out of stock: `quantity` of `item` from `location`,
+    logged under `reason`. allocate_stock() fills in the result:
+    `fulfilled`, `available` and `allocations` ([(StockRecord, taken)]).
+    """
+    def __init__(self, item, quantity, location, reason, batch_number=None, source=None):
+        self.item = item
+        self.quantity = quantity
+        self.location = location
+        self.reason = reason
+        self.batch_number = batch_number
+        self.source = source  # The caller's object for this line (prescription item, request, ...)
+        self.fulfilled = False
+        self.available = 0
+        self.allocations = []
+
+    def matches(self, record):
+        return not self.batch_number or self.batch_number.lower() in record.batch_number.lower()
+
+
+def allocate_stock(demands, user, adjustment_type='Usage', movement_type='Dispense'):
+    """
+    Takes a list of StockDemand lines out of stock, earliest expiry first.
+    All candidate batches are locked in one select_for_update query and split
+    in memory; batches, stock levels, the movement ledger and the adjustment
+    log are then written in bulk. A line is only taken when it can be met in
+    full; the others are left untouched with `fulfilled` False. Must run
+    inside a transaction. Returns the demands.
+    """
+    from .models import StockRecord, StockLevel, StockAdjustment
+
+    demands = [d for d in demands if d.quantity and d.quantity > 0]
+    if not demands:
+        return demands
+
+    pairs = {(d.item.id, d.location.id) for d in demands}
+    pair_filter = Q()
+    for item_id, location_id in pairs:
+        pair_filter |= Q(item_id=item_id, current_location_id=location_id)
+
+    batches = defaultdict(list)
+    locked = StockRecord.objects.filter(pair_filter, quantity__gt=0).order_by(
+        'expiry_date', 'received_date', 'id'
+    ).select_for_update()
+    for record in locked:
+        batches[(record.item_id, record.current_location_id)].append(record)
+
+    touched = {}
+    changes = []
+    adjustments = []
+    for demand in demands:
+        key = (demand.item.id, demand.location.id)
+        candidates = [r for r in batches[key] if r.quantity > 0 and demand.matches(r)]
+        demand.available = sum(r.quantity for r in candidates)
+        if demand.available < demand.quantity:
+            continue
+
+        remaining = demand.quantity
+        for record in candidates:
+            if remaining <= 0:
+                break
+            take = min(record.quantity, remaining)
+            record.quantity -= take
+            touched[record.pk] = record
+            demand.allocations.append((record, take))
+            remaining -= take
+        demand.fulfilled = True
+        changes.append((demand.item.id, demand.location.id, -demand.quantity, demand.reason))
+        adjustments.append(StockAdjustment(
+            item=demand.item,
+            quantity=-demand.quantity,
+            adjustment_type=adjustment_type,
+            reason=demand.reason,
+            adjusted_by=user,
+            adjusted_from=demand.location,
+        ))
+
+    if touched:
+        StockRecord.objects.bulk_update(list(touched.values()), ['quantity'], batch_size=500)
+        StockLevel.adjust_many(changes, movement_type, user)
+        StockAdjustment.objects.bulk_create(adjustments, batch_size=500)
+    return demands
+
+
+def consumables_owed(visits):
+    """
+    {(visit_id, item_id): units} still owed on visits beyond their open
+    orders (undispensed prescription items, active medication charts and
+    ward consumable requests), i.e. billed consumables and direct charges
+    the pharmacy has yet to hand over. Reads the VisitFulfilment ledger,
+    plus one grouped query per kind of order for the visits that owe.
+    """
+    from django.db.models.functions import Coalesce
+    from home.models import PrescriptionItem
+    from inpatient.models import InpatientConsumable, MedicationChart
+    from .models import VisitFulfilment
+
+    owed = {
+        (visit_id, item_id): units
+        for visit_id, item_id, units in VisitFulfilment.objects.filter(visit__in=visits).pending()
+        .values_list('visit_id', 'item_id', 'pending_quantity')
+    }
+    if not owed:
+        return {}
+    visit_ids = {visit_id for visit_id, _ in owed}
+    open_orders = [
+        PrescriptionItem.objects.filter(prescription__visit__in=visit_ids, dispensed=False)
+        .values_list('prescription__visit_id', 'medication_id')
+        .annotate(units=Sum(Coalesce('quantity', 0))),
+        MedicationChart.objects.filter(admission__visit__in=visit_ids, is_active=True, is_dispensed=False)
+        .values_list('admission__visit_id', 'item_id')
+        .annotate(units=Sum(F('quantity') - F('quantity_dispensed'))),
+        InpatientConsumable.objects.filter(admission__visit__in=visit_ids, is_dispensed=False)
+        .values_list('admission__visit_id', 'item_id')
+        .annotate(units=Sum(F('total_quantity') - F('quantity_dispensed'))),
+    ]
+    for rows in open_orders:
+        for visit_id, item_id, units in rows.order_by():
+            if (visit_id, item_id) in owed:
+                owed[(visit_id, item_id)] -= units or 0
+    return {key: units for key, units in owed.items() if units > 0}
+
+
+GRN_IMPORT_COLUMNS = ['item', 'batch', 'quantity', 'expiry', 'unit cost']
+GRN_DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%m/%Y']
+
+
+def parse_grn_date(value):
+    for fmt in GRN_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def read_grn_rows(text):
+    """
+    Rows of a delivery note pasted from a spreadsheet (tab separated) or
+    uploaded as CSV, as (line number, [cells]). A header row is skipped.
+    """
+    text = text.lstrip('\ufeff')
+    first_line = text.split('\n', 1)[0]
+    reader = csv.reader(io.StringIO(text), delimiter='\t' if '\t' in first_line else ',')
+    rows = []
+    for line_no, cells in enumerate(reader, start=1):
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        if not rows and line_no == 1 and cells[0].lower() in ('item', 'item name', 'product', 'name'):
+            continue
+        rows.append((line_no, cells))
+    return rows
+
+
+def item_name_index():
+    """
+    Items by name, case and spacing insensitive, for matching pasted or
+    uploaded lines: {normalized name: [items]} (more than one is ambiguous).
+    """
+    from .models import InventoryItem
+
+    index = defaultdict(list)
+    for item in InventoryItem.objects.only('id', 'name').order_by():
+        index[' '.join(item.name.lower().split())].append(item)
+    return index
+
+
+def read_stock_counts(text):
+    """
+    Counted quantities pasted from a spreadsheet or uploaded as CSV, one
+    (item name, counted) line each. Returns ({item_id: counted}, errors);
+    nothing is returned as counted if any line has an error.
+    """
+    index = item_name_index()
+    counts, errors, seen = {}, [], {}
+    for line_no, cells in read_grn_rows(text):
+        name, counted = (cells + ['', ''])[:2]
+        problems = []
+        matches = index.get(' '.join(name.lower().split()), [])
+        if not matches:
+            problems.append(f'no inventory item named "{name}"')
+        elif len(matches) > 1:
+            problems.append(f'"{name}" matches {len(matches)} inventory items')
+        elif matches[0].id in seen:
+            problems.append(f'duplicate of line {seen[matches[0].id]}')
+        try:
+            counted = int(counted)
+            if counted < 0:
+                raise ValueError
+        except ValueError:
+            problems.append(f'invalid count "{counted}"')
+
+        if problems:
+            errors.append((line_no, '; '.join(problems)))
+        else:
+            seen[matches[0].id] = line_no
+            counts[matches[0].id] = counted
+    return ({} if errors else counts), errors
+
+
+def import_grn_lines(purchase, text, location, user):
+    """
+    Receives a whole delivery into a GRN (InventoryPurchase) in one go.
+    Each line is (item name, batch, quantity, expiry, unit cost). Every line
+    is validated in memory against one item-name index first; if any line
+    fails nothing is written and the per-line errors are returned.
+    Otherwise all stock records are inserted with one bulk_create, the
+    stock levels and movement ledger are updated and the GRN total is
+    recomputed once. Returns (records, errors).
+    """
+    from .models import StockRecord, StockLevel
+
+    rows = read_grn_rows(text)
+    if not rows:
+        return [], [(None, 'No lines found. Expected columns: ' + ', '.join(GRN_IMPORT_COLUMNS))]
+
+    index = item_name_index()
+    today = timezone.localdate()
+    records, errors, seen = [], [], {}
+    for line_no, cells in rows:
+        cells = (cells + [''] * len(GRN_IMPORT_COLUMNS))[:len(GRN_IMPORT_COLUMNS)]
+        name, batch, quantity, expiry, unit_cost = cells
+        problems = []
+
+        matches = index.get(' '.join(name.lower().split()), [])
+        if not name:
+            problems.append('item name is missing')
+        elif not matches:
+            problems.append(f'no inventory item named "{name}"')
+        elif len(matches) > 1:
+            problems.append(f'"{name}" matches {len(matches)} inventory items')
+        if not batch:
+            problems.append('batch number is missing')
+        elif matches and (matches[0].id, batch.lower()) in seen:
+            problems.append(f'duplicate of line {seen[(matches[0].id, batch.lower())]}')
+
+        try:
+            quantity = int(quantity)
+            if quantity <= 0:
+                raise ValueError
+        except ValueError:
+            problems.append(f'invalid quantity "{quantity}"')
+
+        expiry_date = None
+        if expiry:
+            expiry_date = parse_grn_date(expiry)
+            if not expiry_date:
+                problems.append(f'invalid expiry date "{expiry}"')
+            elif expiry_date <= today:
+                problems.append(f'batch expired on {expiry_date}')
+
+        try:
+            unit_cost = Decimal(unit_cost.replace(',', '')) if unit_cost else None
+            if unit_cost is not None and unit_cost < 0:
+                raise InvalidOperation
+        except InvalidOperation:
+            problems.append(f'invalid unit cost "{unit_cost}"')
+
+        if problems:
+            errors.append((line_no, '; '.join(problems)))
+            continue
+        seen[(matches[0].id, batch.lower())] = line_no
+        records.append(StockRecord(
+            item=matches[0],
+            batch_number=batch,
+            quantity=quantity,
+            expiry_date=expiry_date,
+            supplier=purchase.supplier,
+            purchase_price=unit_cost,
+            purchase_ref=purchase,
+            current_location=location,
+        ))
+
+    if errors:
+        return [], errors
+
+    with transaction.atomic():
+        StockRecord.objects.bulk_create(records, batch_size=500)
+        StockLevel.adjust_many(
+            [(r.item.id, location.id, r.quantity, f'GRN #{purchase.id}: batch {r.batch_number}') for r in records],
+            'Receipt', user
+        )
+        # GRN total: value received on all of its lines, recomputed once
+        total = purchase.stock_records.aggregate(
+            total=Sum(F('quantity') * F('purchase_price'), output_field=DecimalField(max_digits=12, decimal_places=2))
+        )['total'] or 0
+        type(purchase).objects.filter(pk=purchase.pk).update(total_amount=total)
+        purchase.total_amount = total
+    return records, []
+
+
+REORDER_WINDOW_DAYS = 90
+REORDER_LEAD_TIME_DAYS = 7
+REORDER_REVIEW_DAYS = 14
+REORDER_SERVICE_Z = 1.65  # ~95% of cycles without a stock-out
+
+
+# Ledger movements that take stock out of the hospital; transfers, corrections and removals do not
+CONSUMPTION_MOVEMENTS = ('Dispense', 'Usage')
+
+
+def daily_consumption(since, location=None, by_location=True):
+    """
+    Units consumed per day from `since` on, as {(item_id, location_id): {date: quantity}}
+    (location_id None when `by_location` is False). Read as one grouped query over the
+    StockMovement ledger, where each unit leaving stock is logged once: stock moved from
+    the Main Store to a pharmacy and dispensed there counts only as the dispense.
+    """
+    from django.db.models.functions import TruncDate
+    from .models import StockMovement
+
+    start = timezone.make_aware(datetime.combine(since, time.min))
+    movements = StockMovement.objects.filter(
+        movement_type__in=CONSUMPTION_MOVEMENTS, quantity__lt=0, created_at__gte=start
+    )
+    if location is not None:
+        movements = movements.filter(location=location)
+
+    series = defaultdict(lambda: defaultdict(int))
+    for item_id, location_id, day, total in (
+        movements.values_list('item_id', 'location_id', TruncDate('created_at'))
+        .annotate(total=-Sum('quantity')).order_by()
+    ):
+        series[(item_id, location_id if by_location else None)][day] += total
+    return series
+
+
+class ReorderSuggestion:
+    """
+    Reorder figures for one item at one location (or the whole hospital when
+    `location_id` is None): average and standard deviation of daily use over
+    the window, stock on hand, the reorder point and the quantity to order.
+    """
+    def __init__(self, item_id, location_id, daily_usage, deviation, on_hand, reorder_point, order_quantity):
+        self.item_id = item_id
+        self.location_id = location_id
+        self.daily_usage = daily_usage
+        self.deviation = deviation
+        self.on_hand = on_hand
+        self.reorder_point = reorder_point
+        self.order_quantity = order_quantity
+        self.item = None
+
+    @property
+    def days_of_cover(self):
+        return max(self.on_hand, 0) / self.daily_usage
+
+
+def reorder_suggestions(location=None, by_location=True, window_days=REORDER_WINDOW_DAYS,
+                        lead_time_days=REORDER_LEAD_TIME_DAYS, review_days=REORDER_REVIEW_DAYS,
+                        service_z=REORDER_SERVICE_Z, today=None):
+    """
+    Items whose stock will not last the supplier lead time, most urgent first.
+
+    Demand is the daily consumption over the last `window_days` (days without
+    use count as zero). The reorder point is the lead-time demand plus safety
+    stock (`service_z` standard deviations of it); an item at or below it is
+    topped up to cover the lead time and the `review_days` until the next
+    order. Pass by_location=False to pool every location, as procurement buys
+    for the whole hospital. The history is read in a fixed number of grouped
+    queries whatever the number of items.
+    """
+    from datetime import timedelta
+    from .models import InventoryItem, StockLevel
+
+    today = today or timezone.localdate()
+    series = daily_consumption(today - timedelta(days=window_days - 1), location, by_location)
+
+    levels = StockLevel.objects.all()
+    if location is not None:
+        levels = levels.filter(location=location)
+    on_hand = defaultdict(int)
+    for item_id, location_id, quantity in levels.values_list('item_id', 'location_id', 'quantity'):
+        on_hand[(item_id, location_id if by_location else None)] += quantity
+
+    cover_days = lead_time_days + review_days
+    suggestions = []
+    for (item_id, location_id), per_day in series.items():
+        total = sum(per_day.values())
+        squares = sum(q * q for q in per_day.values())
+        mean = total / window_days
+        deviation = math.sqrt(max(squares / window_days - mean * mean, 0))
+        if mean <= 0:
+            continue
+
+        stock = on_hand[(item_id, location_id)]
+        reorder_point = math.ceil(mean * lead_time_days + service_z * deviation * math.sqrt(lead_time_days))
+        if stock > reorder_point:
+            continue
+        target = math.ceil(mean * cover_days + service_z * deviation * math.sqrt(cover_days))
+        order_quantity = target - max(stock, 0)
+        if order_quantity > 0:
+            suggestions.append(ReorderSuggestion(
+                item_id, location_id, mean, deviation, stock, reorder_point, order_quantity
+            ))
+
+    items = InventoryItem.objects.in_bulk({s.item_id for s in suggestions})
+    for suggestion in suggestions:
+        suggestion.item = items[suggestion.item_id]
+    suggestions.sort(key=lambda s: (s.days_of_cover, -s.daily_usage, s.item.name))
+    return suggestions
+
+
+def draft_restock_requests(location, source, user, **options):
+    """
+    Pending InventoryRequests from `source` for every reorder suggestion at
+    `location`, skipping items that already have a pending request there.
+    Returns the created requests.
+    """
+    from .models import InventoryRequest
+
+    suggestions = reorder_suggestions(location=location, **options)
+    pending = set(InventoryRequest.objects.filter(
+        location=location, status='Pending', item_id__in=[s.item_id for s in suggestions]
+    ).values_list('item_id', flat=True))
+    return InventoryRequest.objects.bulk_create([
+        InventoryRequest(
+            location=location, requested_from=source, item=s.item,
+            quantity=s.order_quantity, requested_by=user,
+        )
+        for s in suggestions if s.item_id not in pending
+    ])
+
+
+DUPLICATE_THRESHOLD = 0.5
+
+# Unit spellings -> (base unit, multiplier), so "1g" and "1000 mg" compare equal
+STRENGTH_UNITS = {
+    'mcg': ('mg', 0.001), 'ug': ('mg', 0.001), 'mg': ('mg', 1), 'mgs': ('mg', 1),
+    'g': ('mg', 1000), 'gm': ('mg', 1000), 'gms': ('mg', 1000),
+    'ml': ('ml', 1), 'mls': ('ml', 1), 'l': ('ml', 1000), 'ltr': ('ml', 1000),
+    'iu': ('iu', 1), '%': ('%', 1), 'mm': ('mm', 1), 'cm': ('mm', 10),
+}
+STRENGTH_PATTERN = re.compile(
+    r'(\d+(?:\.\d+)?)\s*(' + '|'.join(sorted(map(re.escape, STRENGTH_UNITS), key=len, reverse=True)) + r')(?![a-z])'
+)
+
+
+def normalize_item_name(name):
+    """
+    Splits an item name into its words and its strength/size tokens:
+    "Ceftriaxone Inj. 1g" -> ("ceftriaxone inj", {"1000mg"}). Strengths are
+    converted to a base unit; other numbers ("Gloves Size 7") are kept as is.
+    """
+    name = name.lower()
+    sizes = set()
+    for value, unit in STRENGTH_PATTERN.findall(name):
+        base, multiplier = STRENGTH_UNITS[unit]
+        sizes.add(f"{float(value) * multiplier:g}{base}")
+    words = re.sub(r'[^a-z0-9.]+', ' ', STRENGTH_PATTERN.sub(' ', name)).split()
+    sizes.update(word for word in words if any(c.isdigit() for c in word))
+    words = [word.strip('.') for word in words if not any(c.isdigit() for c in word)]
+    return ' '.join(word for word in words if word), frozenset(sizes)
+
+
+def name_trigrams(words):
+    padded = f"  {words} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def duplicate_candidates(rows, threshold=DUPLICATE_THRESHOLD):
+    """
+    Likely duplicate pairs among `rows` of (item_id, name, block), best first,
+    as [(score, item_id, other_item_id)]. Only items in the same block (e.g.
+    category and formulation) are compared.
+
+    Names are compared by the Jaccard similarity of their character trigrams
+    ("Cefriaxone" / "Ceftriaxone" share most of theirs). Items with different
+    strengths or sizes are never paired; a matching strength adds to the score
+    and a strength on only one side takes from it before the threshold applies.
+    Candidate pairs come from a trigram index over each name's rarest trigrams:
+    two names reaching `threshold` must share one of them (prefix filtering),
+    so most pairs are never scored.
+    """
+    blocks = defaultdict(list)
+    for item_id, name, block in rows:
+        words, sizes = normalize_item_name(name or '')
+        blocks[block].append((item_id, words, sizes, name_trigrams(words)))
+
+    candidates = []
+    for entries in blocks.values():
+        frequency = Counter(gram for entry in entries for gram in entry[3])
+        entries.sort(key=lambda entry: len(entry[3]))
+        index = defaultdict(list)
+        for position, (item_id, words, sizes, grams) in enumerate(entries):
+            ordered = sorted(grams, key=lambda gram: (frequency[gram], gram))
+            prefix = ordered[:len(ordered) - math.ceil(threshold * len(ordered)) + 1]
+            seen = set()
+            for gram in prefix:
+                for other in index[gram]:
+                    if other in seen:
+                        continue
+                    seen.add(other)
+                    other_id, other_words, other_sizes, other_grams = entries[other]
+                    # Shorter names first: only the size bound on the other side can fail
+                    if len(other_grams) < threshold * len(grams):
+                        continue
+                    if sizes and other_sizes and sizes != other_sizes:
+                        continue
+                    score = len(grams & other_grams) / len(grams | other_grams)
+                    if sizes != other_sizes:
+                        # Only one of the two names gives a strength
+                        score -= 0.1
+                    if score < threshold:
+                        continue
+                    if sizes and sizes == other_sizes:
+                        score = min(score + 0.1, 1.0)
+                    candidates.append((round(score, 3), other_id, item_id))
+                index[gram].append(position)
+
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+    return candidates
+
+
+SEARCH_INDEX_VERSION_KEY = 'inventory-search-index-version'
+SEARCH_INDEX_MAX_AGE = 300  # Seconds; also picks up bulk loads that skip the save signals
+
+
+def bump_search_index_version():
+    """
+    Makes every process rebuild its search index on the next search. The key
+    changes once the save commits, so no worker rebuilds from the old rows
+    under the new version.
+    """
+    from django.core.cache import cache
+
+    def bump():
+        try:
+            cache.set(SEARCH_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+        except Exception:
+            # The save stands; other workers catch up within SEARCH_INDEX_MAX_AGE
+            logger.warning("Could not bump the inventory search index version", exc_info=True)
+
+    transaction.on_commit(bump)
+
+
+class InventorySearchIndex:
+    """
+    Autocomplete index over item names, medication generic names and aliases.
+    Matches are found in order of quality and the search stops at the limit:
+    names starting with the query, then names with a word starting with it,
+    then generic names/aliases starting with it (sorted prefix lists), then
+    names containing it anywhere. For the last, every 2- and 3-character
+    slice points to the items containing it, so only the items sharing the
+    query's rarest slice are checked.
+    """
+    def __init__(self, rows):
+        self.entries = []
+        self.prefixes = ([], [], [])
+        self.grams = defaultdict(list)
+        rows = sorted(rows, key=lambda row: (row[1].lower(), row[0]))
+        for item_id, name, aliases, unit, price, category, generic_name, medication_id in rows:
+            position = len(self.entries)
+            name_key = name.lower()
+            keys = [name_key]
+            if generic_name:
+                keys.append(generic_name.lower())
+            keys += [alias.strip().lower() for alias in (aliases or '').split(',') if alias.strip()]
+            self.entries.append({
+                'id': item_id,
+                'name': name,
+                'unit': unit,
+                'price': price,
+                'category': category,
+                'is_medication': medication_id is not None,
+                'keys': keys,
+            })
+
+            self.prefixes[0].append((name_key, position))
+            words = name_key.split()
+            for n in range(1, len(words)):
+                self.prefixes[1].append((' '.join(words[n:]), position))
+            for key in keys[1:]:
+                self.prefixes[2].append((key, position))
+
+            grams = set()
+            for key in keys:
+                for n in (2, 3):
+                    grams.update(key[i:i + n] for i in range(len(key) - n + 1))
+            for gram in grams:
+                self.grams[gram].append(position)
+        for prefixes in self.prefixes:
+            prefixes.sort()
+
+    def search(self, query, limit=20, exclude_pharmaceuticals=False):
+        """Up to `limit` entries matching `query`, best first"""
+        query = ' '.join(query.lower().split())
+        if len(query) < 2:
+            return []
+
+        found = []
+        seen = set()
+
+        def take(position):
+            entry = self.entries[position]
+            if position not in seen and not (exclude_pharmaceuticals and entry['is_medication']):
+                seen.add(position)
+                found.append(entry)
+            return len(found) >= limit
+
+        for prefixes in self.prefixes:
+            for i in range(bisect_left(prefixes, (query,)), len(prefixes)):
+                key, position = prefixes[i]
+                if not key.startswith(query):
+                    break
+                if take(position):
+                    return found
+
+        n = min(len(query), 3)
+        postings = [self.grams.get(query[i:i + n], []) for i in range(len(query) - n + 1)]
+        for position in min(postings, key=len):
+            if position not in seen and any(query in key for key in self.entries[position]['keys']):
+                if take(position):
+                    break
+        return found
+
+
+_search_index = {'version': None, 'built_at': 0, 'index': None}
+
+
+def inventory_search_index():
+    """
+    This process's InventorySearchIndex, rebuilt when the version key in the
+    shared cache is bumped (item or medication saved/deleted) or it is older than
+    SEARCH_INDEX_MAX_AGE. Searches against a current index do not touch the database.
+    """
+    from django.core.cache import cache
+    from .models import InventoryItem
+
+    try:
+        version = cache.get(SEARCH_INDEX_VERSION_KEY)
+        if version is None:
+            cache.add(SEARCH_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(SEARCH_INDEX_VERSION_KEY)
+    except Exception:
+        # Cache unreachable: keep the index we have until it ages out
+        logger.warning("Could not read the inventory search index version", exc_info=True)
+        version = _search_index['version']
+    if (_search_index['index'] is None or _search_index['version'] != version
+            or monotonic() - _search_index['built_at'] > SEARCH_INDEX_MAX_AGE):
+        rows = InventoryItem.objects.values_list(
+            'id', 'name', 'aliases', 'dispensing_unit', 'selling_price', 'category__name',
+            'medication__generic_name', 'medication__id',
+        ).order_by()
+        _search_index.update(version=version, built_at=monotonic(), index=InventorySearchIndex(rows))
+    return _search_index['index']
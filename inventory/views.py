@@ -1,14 +1,15 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, condition
 from django.contrib import messages
-from django.http import HttpResponseForbidden
-from .models import InventoryItem, InventoryCategory, Supplier, StockRecord, InventoryRequest, StockAdjustment
+from django.http import HttpResponseForbidden, JsonResponse
+from .models import InventoryItem, InventoryCategory, Supplier, StockRecord, StockLevel, StockMovement, ExpiringBatch, StockTake, InventoryRequest, StockAdjustment, stock_movement
 from .forms import InventoryItemForm, InventoryCategoryForm, SupplierForm, StockRecordForm, InventoryRequestForm, MedicationForm, ConsumableDetailForm, GeneralUsageForm
 from home.models import Departments, Patient, Visit
 from accounts.utils import get_or_create_invoice
+from .utils import StockDemand, allocate_stock, import_grn_lines, GRN_IMPORT_COLUMNS, reorder_suggestions, draft_restock_requests, duplicate_candidates, inventory_search_index, read_stock_counts
 
-from django.db.models import Sum, Count, Q, Case, When, Value, IntegerField
+from django.db.models import Sum, Count, Max, Q, Case, When, Value, IntegerField
 from django.db import transaction
 from django.utils import timezone
 from django.db.models import ManyToManyRel, ManyToOneRel, OneToOneRel
@@ -17,7 +18,7 @@ from django.db.models import ManyToManyRel, ManyToOneRel, OneToOneRel
 def item_list(request):
     # Start with all items, annotate with total stock
     items = InventoryItem.objects.annotate(
-        total_stock=Sum('stock_records__quantity')
+        total_stock=Sum('stock_levels__quantity')
     ).select_related('category').order_by('name')
     
     # Get filter parameters from GET request
@@ -133,19 +134,25 @@ def clean_duplicates(request):
     if search_query:
         search_results = InventoryItem.objects.filter(name__icontains=search_query).order_by('name')[:50]
 
-    # Find duplicates by exact name grouping
-    duplicates = InventoryItem.objects.values('name').annotate(name_count=Count('id')).filter(name_count__gt=1).order_by('name')
-    
-    duplicate_groups = []
-    for dup in duplicates:
-        items = InventoryItem.objects.filter(name=dup['name']).annotate(total_stock=Sum('stock_records__quantity'))
-        duplicate_groups.append({
-            'name': dup['name'],
-            'items': items
-        })
+    # Likely duplicates (near-identical names with the same strength), compared
+    # within the same category and formulation
+    rows = (
+        (item_id, name, (category_id, formulation or ''))
+        for item_id, name, category_id, formulation in InventoryItem.objects.values_list(
+            'id', 'name', 'category_id', 'medication__formulation'
+        ).order_by()
+    )
+    candidates = duplicate_candidates(rows)[:100]
+    items = InventoryItem.objects.filter(
+        id__in={item_id for _, a, b in candidates for item_id in (a, b)}
+    ).annotate(total_stock=Sum('stock_records__quantity')).in_bulk()
+    duplicate_pairs = [
+        {'score': round(score * 100), 'item': items[a], 'other': items[b]}
+        for score, a, b in candidates
+    ]
         
     return render(request, 'inventory/clean_duplicates.html', {
-        'duplicate_groups': duplicate_groups,
+        'duplicate_pairs': duplicate_pairs,
         'search_query': search_query,
         'search_results': search_results,
         'title': 'Clean Inventory Duplicates'
@@ -323,70 +330,43 @@ def update_request_status(request, request_id):
                         messages.error(request, 'Default source department (Main Store) not found.')
                         return redirect('inventory:request_list')
 
-                # Check if enough stock in Source Department
-                total_stock = StockRecord.objects.filter(
-                    item=inventory_request.item, 
-                    current_location=source_dept
-                ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-                
-                if total_stock < adjusted_qty:
-                    messages.error(request, f'Insufficient stock in {source_dept.name}. Available: {total_stock}')
-                    return redirect('inventory:request_list')
-
-                # Proceed with Transfer
-                remaining_qty = adjusted_qty
-                # Get batches from Source Department (FIFO)
-                source_records = StockRecord.objects.filter(
-                    item=inventory_request.item, 
-                    current_location=source_dept, 
-                    quantity__gt=0
-                ).order_by('expiry_date')
-
-                for record in source_records:
-                    if remaining_qty <= 0:
-                        break
-                    
-                    qty_to_take = min(record.quantity, remaining_qty)
-                    
-                    # Deduct from source
-                    record.quantity -= qty_to_take
-                    record.save()
-                    
-                    # Add to destination
-                    dest_record, created = StockRecord.objects.get_or_create(
-                        item=inventory_request.item,
-                        current_location=inventory_request.location,
-                        batch_number=record.batch_number,
-                        defaults={
-                            'quantity': 0,
-                            'expiry_date': record.expiry_date,
-                            'supplier': record.supplier,
-                            'purchase_price': record.purchase_price
-                        }
-                    )
-                    dest_record.quantity += qty_to_take
-                    dest_record.save()
-                    
-                    # Log Adjustments
-                    StockAdjustment.objects.create(
-                        item=inventory_request.item,
-                        quantity=-qty_to_take,
-                        adjustment_type='Transfer Out',
+                with transaction.atomic():
+                    # Check and take the batches from Source Department (FEFO)
+                    demand, = allocate_stock([StockDemand(
+                        inventory_request.item, adjusted_qty, source_dept,
                         reason=f'Approved Request to {inventory_request.location.name}',
-                        adjusted_by=request.user,
-                        adjusted_from=source_dept
-                    )
+                    )], request.user, adjustment_type='Transfer Out', movement_type='Transfer Out')
+
+                    if not demand.fulfilled:
+                        messages.error(request, f'Insufficient stock in {source_dept.name}. Available: {demand.available}')
+                        return redirect('inventory:request_list')
+
+                    with stock_movement('Transfer In', f'Approved Request from {source_dept.name}', request.user):
+                        for record, qty_to_take in demand.allocations:
+                            # Add to destination
+                            dest_record, created = StockRecord.objects.get_or_create(
+                                item=inventory_request.item,
+                                current_location=inventory_request.location,
+                                batch_number=record.batch_number,
+                                defaults={
+                                    'quantity': 0,
+                                    'expiry_date': record.expiry_date,
+                                    'supplier': record.supplier,
+                                    'purchase_price': record.purchase_price
+                                }
+                            )
+                            dest_record.quantity += qty_to_take
+                            dest_record.save()
+
                     StockAdjustment.objects.create(
                         item=inventory_request.item,
-                        quantity=qty_to_take,
+                        quantity=adjusted_qty,
                         adjustment_type='Transfer In',
                         reason=f'Approved Request from {source_dept.name}',
                         adjusted_by=request.user,
                         adjusted_from=inventory_request.location
                     )
 
-                    remaining_qty -= qty_to_take
-
                 inventory_request.adjusted_quantity = adjusted_qty
                 inventory_request.status = 'Approved'
                 messages.success(request, f'Request approved. {adjusted_qty} units transferred to {inventory_request.location.name} from {source_dept.name}.')
@@ -422,32 +402,24 @@ def search_inventory(request):
     if len(query) < 2:
         return JsonResponse({'results': []})
         
-    items = InventoryItem.objects.filter(name__icontains=query)
+    # Names, generic names and aliases from the in-process index
+    items = inventory_search_index().search(query, exclude_pharmaceuticals=exclude_pharmaceuticals)
     
-    if exclude_pharmaceuticals:
-        # Items that don't have a linked Medication record
-        items = items.filter(medication__isnull=True)
-        
-    items = items.select_related('category').order_by('name')[:20]
+    # Stock for every result in the specific department, in one lookup
+    levels = StockLevel.quantities(department_id, [item['id'] for item in items]) if department_id and items else {}
     
     results = []
     for item in items:
-        # Calculate stock for this item in the specific department
-        stock = 0
-        if department_id:
-            stock = StockRecord.objects.filter(
-                item=item, 
-                current_location_id=department_id
-            ).aggregate(total=Sum('quantity'))['total'] or 0
+        stock = levels.get(item['id'], 0)
             
         results.append({
-            'id': item.id,
-            'text': f"{item.name} ({item.dispensing_unit})",
-            'name': item.name,
-            'category': item.category.name if item.category else 'General',
+            'id': item['id'],
+            'text': f"{item['name']} ({item['unit']})",
+            'name': item['name'],
+            'category': item['category'] or 'General',
             'stock': stock,
             'stock_quantity': stock, # Added for compatibility
-            'selling_price': str(item.selling_price) if item.selling_price else '0' # Added for compatibility
+            'selling_price': str(item['price']) if item['price'] else '0' # Added for compatibility
         })
     return JsonResponse({'results': results})
 
@@ -565,31 +537,16 @@ def dispense_item(request):
             if not is_pharmacy:
                 # Deduct Stock immediately for non-pharmacy departments (FEFO/FIFO)
                 if department:
-                    remaining_to_deduct = quantity
-                    batches = StockRecord.objects.filter(
-                        item=item, 
-                        current_location=department, 
-                        quantity__gt=0
-                    ).order_by('expiry_date', 'received_date')
-                    
-                    for batch in batches:
-                        if remaining_to_deduct <= 0:
-                            break
-                        
-                        deduction = min(batch.quantity, remaining_to_deduct)
-                        batch.quantity -= deduction
-                        batch.save()
-                        remaining_to_deduct -= deduction
-
-                    # Create audit trail for immediate stock reduction (Non-Pharmacy)
-                    StockAdjustment.objects.create(
-                        item=item,
-                        quantity=-quantity,
-                        adjustment_type='Usage',
+                    # Audit trail for the immediate stock reduction is written alongside (Non-Pharmacy)
+                    demand, = allocate_stock([StockDemand(
+                        item, quantity, department,
                         reason=f'Dispensed to Patient: {patient.full_name} (Visit: {visit.id if visit else "N/A"})',
-                        adjusted_by=request.user,
-                        adjusted_from=department
-                    )
+                    )], request.user)
+                    if not demand.fulfilled:
+                        return JsonResponse({
+                            'status': 'error',
+                            'message': f'Insufficient stock. Requested: {quantity}, Available: {demand.available}'
+                        }, status=400)
 
                 # Record Physical Dispensing (Inventory Stock Movement)
                 DispensedItem.objects.create(
@@ -710,6 +667,9 @@ def procurement_dashboard(request):
     from django.db.models import Sum
     total_value = purchases.aggregate(Sum('total_amount'))['total_amount__sum'] or 0
     total_suppliers = purchases.values('supplier').distinct().count()
+
+    # Hospital-wide reorder suggestions from consumption velocity
+    suggestions = reorder_suggestions(by_location=False)
     
     context = {
         'purchases': purchases,
@@ -718,9 +678,32 @@ def procurement_dashboard(request):
         'purchase_form': InventoryPurchaseForm(),
         'total_value': total_value,
         'total_suppliers': total_suppliers,
+        'reorder_suggestions': suggestions[:50],
+        'reorder_count': len(suggestions),
+        'restock_locations': Departments.objects.exclude(name='Main Store').order_by('name'),
     }
     return render(request, 'inventory/procurement_dashboard.html', context)
 
+@login_required
+@require_POST
+def draft_reorder_requests(request):
+    """Drafts pending restock requests from the Main Store for a department's reorder suggestions"""
+    location = get_object_or_404(Departments, id=request.POST.get('location_id'))
+    source = Departments.objects.filter(name='Main Store').first()
+    if not source:
+        messages.error(request, 'Default source department (Main Store) not found.')
+        return redirect('inventory:procurement_dashboard')
+    if location == source:
+        messages.error(request, 'The Main Store restocks through procurement, not internal requests.')
+        return redirect('inventory:procurement_dashboard')
+
+    created = draft_restock_requests(location, source, request.user)
+    if created:
+        messages.success(request, f"Drafted {len(created)} restock request(s) for {location.name}. Review them before approval.")
+    else:
+        messages.info(request, f"Nothing to reorder for {location.name} (or requests are already pending).")
+    return redirect('inventory:request_list')
+
 @login_required
 def add_inventory_purchase(request):
     from .forms import InventoryPurchaseForm
@@ -760,8 +743,35 @@ def add_grn_item(request, grn_id):
     from .forms import StockRecordForm
     
     purchase = get_object_or_404(InventoryPurchase, id=grn_id)
+    import_errors = []
+    bulk_lines = ''
     
-    if request.method == 'POST':
+    if request.method == 'POST' and request.POST.get('mode') == 'bulk':
+        # Bulk receiving: a whole delivery note as CSV upload or pasted table
+        form = StockRecordForm()
+        form.fields['supplier'].required = False
+        bulk_lines = request.POST.get('bulk_lines', '')
+        upload = request.FILES.get('bulk_file')
+        location = Departments.objects.filter(id=request.POST.get('bulk_location') or None).first() or \
+            Departments.objects.filter(name='Main Store').first()
+        if upload:
+            try:
+                bulk_lines = upload.read().decode('utf-8-sig')
+            except UnicodeDecodeError:
+                import_errors = [(None, 'The file is not a UTF-8 CSV file.')]
+        if not location:
+            import_errors = [(None, 'Select a storage location for the delivery.')]
+
+        if not import_errors:
+            records, import_errors = import_grn_lines(purchase, bulk_lines, location, request.user)
+            if not import_errors:
+                messages.success(
+                    request,
+                    f'{len(records)} line(s) received into {location.name}. GRN total is now KES {purchase.total_amount:,.2f}.'
+                )
+                return redirect('inventory:add_grn_item', grn_id=purchase.id)
+        messages.error(request, f'Bulk import failed: {len(import_errors)} line(s) need fixing. Nothing was saved.')
+    elif request.method == 'POST':
         form = StockRecordForm(request.POST)
         # Supplier comes from the GRN header, not the form
         form.fields['supplier'].required = False
@@ -828,6 +838,10 @@ def add_grn_item(request, grn_id):
         'added_items': added_items,
         'inventory_items': inventory_items,
         'all_items_prices_json': all_items_prices_json,
+        'import_errors': import_errors,
+        'bulk_lines': bulk_lines,
+        'bulk_columns': GRN_IMPORT_COLUMNS,
+        'locations': Departments.objects.all().order_by('name'),
     }
     return render(request, 'inventory/add_grn_item.html', context)
 
@@ -954,19 +968,22 @@ def inventory_distribution(request, item_id):
     med_form = MedicationForm(instance=getattr(item, 'medication', None))
     con_form = ConsumableDetailForm(instance=getattr(item, 'consumable_detail', None))
     
-    # Aggregate stock by location (only locations with stock > 0)
-    distribution_qs = StockRecord.objects.filter(
-        item=item, 
-        quantity__gt=0
-    ).values(
-        'current_location__name', 
-        'current_location__id'
-    ).annotate(
-        total_quantity=Sum('quantity'),
-        batch_count=Count('id')
-    ).order_by('-total_quantity')
-    
-    distribution = list(distribution_qs)
+    # Stock by location (only locations with stock > 0) from the balance table
+    batch_counts = dict(
+        StockRecord.objects.filter(item=item, quantity__gt=0)
+        .values('current_location_id').annotate(batch_count=Count('id'))
+        .values_list('current_location_id', 'batch_count')
+    )
+    distribution = [
+        {
+            'current_location__name': level['location__name'],
+            'current_location__id': level['location_id'],
+            'total_quantity': level['quantity'],
+            'batch_count': batch_counts.get(level['location_id'], 0),
+        }
+        for level in StockLevel.objects.filter(item=item, quantity__gt=0)
+        .values('location_id', 'location__name', 'quantity').order_by('-quantity')
+    ]
     
     # Always ensure Pharmacy and Main Store appear in the list
     pinned_depts = Departments.objects.filter(name__iexact='Pharmacy') | Departments.objects.filter(name__iexact='Main Store')
@@ -1058,35 +1075,12 @@ def record_usage(request):
                 quantity = usage.quantity
                 department = usage.adjusted_from
                 
-                # Deduct Stock (FEFO/FIFO)
-                available_stock = StockRecord.objects.filter(
-                    item=item, 
-                    current_location=department
-                ).aggregate(total=Sum('quantity'))['total'] or 0
-                
-                if available_stock < quantity:
-                    messages.error(request, f'Insufficient stock in {department.name}. Available: {available_stock}')
+                # Deduct Stock (FEFO/FIFO); the usage is logged as the demand's adjustment record
+                demand, = allocate_stock([StockDemand(item, quantity, department, reason=usage.reason)], request.user, movement_type='Usage')
+
+                if not demand.fulfilled:
+                    messages.error(request, f'Insufficient stock in {department.name}. Available: {demand.available}')
                 else:
-                    remaining_to_deduct = quantity
-                    batches = StockRecord.objects.filter(
-                        item=item, 
-                        current_location=department, 
-                        quantity__gt=0
-                    ).order_by('expiry_date', 'received_date')
-                    
-                    for batch in batches:
-                        if remaining_to_deduct <= 0:
-                            break
-                        
-                        deduction = min(batch.quantity, remaining_to_deduct)
-                        batch.quantity -= deduction
-                        batch.save()
-                        remaining_to_deduct -= deduction
-                    
-                    # Set quantity to negative for the adjustment record
-                    usage.quantity = -quantity
-                    usage.save()
-                    
                     messages.success(request, f'Recorded usage of {quantity} {item.dispensing_unit}(s) of {item.name}.')
                     return redirect('inventory:record_usage')
     else:
@@ -1101,22 +1095,22 @@ def record_usage(request):
     
     inventory_items = InventoryItem.objects.all().order_by('name')
     
-    # Calculate stock by department for all items
-    stock_records = StockRecord.objects.filter(quantity__gt=0).values(
-        'item_id', 'current_location_id', 'current_location__name'
-    ).annotate(total_quantity=Sum('quantity'))
+    # Stock by department for all items
+    stock_levels = StockLevel.objects.filter(quantity__gt=0).values(
+        'item_id', 'location_id', 'location__name', 'quantity'
+    )
     
     stock_by_department = {}
-    for record in stock_records:
-        dept_id = str(record['current_location_id'])
+    for level in stock_levels:
+        dept_id = str(level['location_id'])
         if dept_id not in stock_by_department:
             stock_by_department[dept_id] = {
-                'name': record['current_location__name'],
+                'name': level['location__name'],
                 'items': []
             }
         stock_by_department[dept_id]['items'].append({
-            'item_id': record['item_id'],
-            'total_quantity': record['total_quantity']
+            'item_id': level['item_id'],
+            'total_quantity': level['quantity']
         })
 
     return render(request, 'inventory/record_usage.html', {
@@ -1157,41 +1151,43 @@ def reconcile_stock(request, item_id, location_id):
             return redirect('inventory:inventory_distribution', item_id=item.id)
 
         with transaction.atomic():
-            if diff < 0:
-                # Reduce stock (Loss, etc.)
-                to_reduce = abs(diff)
-                for record in records:
-                    if record.quantity >= to_reduce:
-                        record.quantity -= to_reduce
-                        record.save()
-                        to_reduce = 0
-                        break
-                    else:
-                        to_reduce -= record.quantity
-                        record.quantity = 0
-                        record.save()
-            else:
-                # Stock addition
-                # Find the most recent record to add the surplus to, or create one if none exist
-                target_record = records.last()
-                if target_record:
-                    target_record.quantity += diff
-                    target_record.save()
+            reason = f"Stock Reconciliation: Physical count was {actual_count}, system was {current_total}"
+            with stock_movement('Correction', reason, request.user):
+                if diff < 0:
+                    # Reduce stock (Loss, etc.)
+                    to_reduce = abs(diff)
+                    for record in records:
+                        if record.quantity >= to_reduce:
+                            record.quantity -= to_reduce
+                            record.save()
+                            to_reduce = 0
+                            break
+                        else:
+                            to_reduce -= record.quantity
+                            record.quantity = 0
+                            record.save()
                 else:
-                    StockRecord.objects.create(
-                        item=item,
-                        batch_number="RECONCILIATION",
-                        quantity=diff,
-                        current_location=location,
-                        received_date=timezone.now().date()
-                    )
+                    # Stock addition
+                    # Find the most recent record to add the surplus to, or create one if none exist
+                    target_record = records.last()
+                    if target_record:
+                        target_record.quantity += diff
+                        target_record.save()
+                    else:
+                        StockRecord.objects.create(
+                            item=item,
+                            batch_number="RECONCILIATION",
+                            quantity=diff,
+                            current_location=location,
+                            received_date=timezone.now().date()
+                        )
 
             # Record in adjustment log
             StockAdjustment.objects.create(
                 item=item,
                 quantity=diff,
                 adjustment_type='Correction',
-                reason=f"Stock Reconciliation: Physical count was {actual_count}, system was {current_total}",
+                reason=reason,
                 adjusted_by=request.user,
                 adjusted_from=location
             )
@@ -1205,6 +1201,99 @@ def reconcile_stock(request, item_id, location_id):
 def is_pharmacist_or_admin(user):
     return user.is_authenticated and (user.is_superuser or user.role in ['Pharmacist', 'Admin'])
 
+@login_required
+@user_passes_test(is_pharmacist_or_admin)
+def stock_take_list(request):
+    """Stock take sessions; starting one snapshots a whole location"""
+    if request.method == 'POST':
+        location = get_object_or_404(Departments, id=request.POST.get('location_id'))
+        open_take = StockTake.objects.filter(location=location, status='Counting').first()
+        if open_take:
+            messages.info(request, f"A stock take of {location.name} is already under way.")
+            return redirect('inventory:stock_take_detail', take_id=open_take.id)
+        take = StockTake.start(location, request.user)
+        messages.success(request, f"Stock take #{take.id} started: {take.lines.count()} items snapshotted in {location.name}.")
+        return redirect('inventory:stock_take_detail', take_id=take.id)
+
+    stock_takes = StockTake.objects.select_related('location', 'started_by', 'posted_by').annotate(
+        line_count=Count('lines'),
+        counted_count=Count('lines', filter=Q(lines__counted_quantity__isnull=False)),
+    )[:50]
+    return render(request, 'inventory/stock_take_list.html', {
+        'stock_takes': stock_takes,
+        'locations': Departments.objects.all().order_by('name'),
+        'title': 'Stock Takes'
+    })
+
+@login_required
+@user_passes_test(is_pharmacist_or_admin)
+def stock_take_detail(request, take_id):
+    """
+    Count grid for a stock take. Counts are saved from the grid or a pasted /
+    uploaded CSV (item name, counted) in bulk; an admin posts the variances.
+    """
+    take = get_object_or_404(StockTake.objects.select_related('location'), id=take_id)
+    import_errors = []
+    counts_text = ''
+
+    if request.method == 'POST' and take.status == 'Counting':
+        action = request.POST.get('action')
+        # Grid counts, keyed by item
+        counts = {}
+        for key, value in request.POST.items():
+            if key.startswith('count_') and value.strip():
+                try:
+                    counts[int(key[len('count_'):])] = max(int(value), 0)
+                except ValueError:
+                    continue
+
+        if action == 'save_counts':
+            counts_text = request.POST.get('counts_text', '')
+            counts_file = request.FILES.get('counts_file')
+            if counts_file:
+                counts_text = counts_file.read().decode('utf-8-sig', errors='replace')
+            if counts_text.strip():
+                file_counts, import_errors = read_stock_counts(counts_text)
+                counts.update(file_counts)
+            if not import_errors:
+                saved = take.record_counts(counts)
+                messages.success(request, f"Saved {saved} count(s).")
+                return redirect('inventory:stock_take_detail', take_id=take.id)
+        elif action == 'post':
+            if not is_admin(request.user):
+                messages.error(request, "Only an administrator can post stock take corrections.")
+            else:
+                try:
+                    take.record_counts(counts)
+                    adjustments = take.post(request.user)
+                    messages.success(request, f"Stock take #{take.id} posted with {len(adjustments)} correction(s).")
+                except ValueError as e:
+                    messages.error(request, str(e))
+            return redirect('inventory:stock_take_detail', take_id=take.id)
+        elif action == 'cancel':
+            take.status = 'Cancelled'
+            take.save(update_fields=['status'])
+            messages.info(request, f"Stock take #{take.id} cancelled. No stock was changed.")
+            return redirect('inventory:stock_take_list')
+
+    lines = list(take.lines_with_movements().select_related('item').order_by('item__name'))
+    moved = take.moved_since_snapshot() if take.status == 'Counting' else {}
+    for line in lines:
+        line.moved = moved.get(line.item_id, 0)
+    counted = [line for line in lines if line.counted_quantity is not None]
+
+    return render(request, 'inventory/stock_take_detail.html', {
+        'take': take,
+        'lines': lines,
+        'counted_count': len(counted),
+        'variance_count': sum(1 for line in counted if line.variance),
+        'net_variance': sum(line.variance for line in counted),
+        'import_errors': import_errors,
+        'counts_text': counts_text,
+        'can_post': is_admin(request.user),
+        'title': f'Stock Take #{take.id}'
+    })
+
 @login_required
 @user_passes_test(is_pharmacist_or_admin)
 def transfer_stock(request):
@@ -1222,138 +1311,117 @@ def transfer_stock(request):
             quantity = form.cleaned_data['quantity']
             batch_query = form.cleaned_data.get('batch_number')
 
-            # 1. Validate Stock Availability
-            # If batch specified, check specific batch
-            stock_filter = {
-                'item': item,
-                'current_location': source,
-                'quantity__gt': 0
-            }
-            if batch_query:
-                stock_filter['batch_number__icontains'] = batch_query
-
-            available_stock = StockRecord.objects.filter(**stock_filter).aggregate(total=Sum('quantity'))['total'] or 0
-
-            if available_stock < quantity:
-                messages.error(request, f"Insufficient stock in {source.name}. Requested: {quantity}, Available: {available_stock}")
-            else:
-                try:
-                    with transaction.atomic():
-                        # 2. Get Source Records (FEFO)
-                        source_records = StockRecord.objects.filter(**stock_filter).order_by('expiry_date').select_for_update()
-                        
-                        remaining_qty = quantity
-                        for record in source_records:
-                            if remaining_qty <= 0:
-                                break
-                            
-                            take = min(record.quantity, remaining_qty)
-                            
-                            # Deduct from source
-                            record.quantity -= take
-                            record.save()
-                            
-                            # Add to destination
-                            dest_record, created = StockRecord.objects.get_or_create(
-                                item=item,
-                                current_location=destination,
-                                batch_number=record.batch_number,
-                                defaults={
-                                    'quantity': 0,
-                                    'expiry_date': record.expiry_date,
-                                    'supplier': record.supplier,
-                                    'purchase_price': record.purchase_price
-                                }
-                            )
-                            # If existing record, lock it too? get_or_create doesn't select_for_update easily.
-                            # Just update quantity.
-                            dest_record.quantity += take
-                            dest_record.save()
-                            
-                            # Log Adjustments
-                            StockAdjustment.objects.create(
-                                item=item,
-                                quantity=-take,
-                                adjustment_type='Usage', # Or maybe a new type 'Transfer Out'? usage implies consumption.
-                                reason=f'Transfer to {destination.name}',
-                                adjusted_by=request.user,
-                                adjusted_from=source
-                            )
-                            StockAdjustment.objects.create(
-                                item=item,
-                                quantity=take,
-                                adjustment_type='Addition', # 'Transfer In'
-                                reason=f'Transfer from {source.name}',
-                                adjusted_by=request.user,
-                                adjusted_from=destination
-                            )
+            try:
+                with transaction.atomic():
+                    # 1-2. Validate availability and take the source batches (FEFO)
+                    demand, = allocate_stock([StockDemand(
+                        item, quantity, source,
+                        reason=f'Transfer to {destination.name}',
+                        batch_number=batch_query,
+                    )], request.user, movement_type='Transfer Out')
+
+                    if not demand.fulfilled:
+                        messages.error(request, f"Insufficient stock in {source.name}. Requested: {quantity}, Available: {demand.available}")
+                    else:
+                        with stock_movement('Transfer In', f'Transfer from {source.name}', request.user):
+                            for record, take in demand.allocations:
+                                # Add to destination, keeping the batch details
+                                dest_record, created = StockRecord.objects.get_or_create(
+                                    item=item,
+                                    current_location=destination,
+                                    batch_number=record.batch_number,
+                                    defaults={
+                                        'quantity': 0,
+                                        'expiry_date': record.expiry_date,
+                                        'supplier': record.supplier,
+                                        'purchase_price': record.purchase_price
+                                    }
+                                )
+                                dest_record.quantity += take
+                                dest_record.save()
+
+                        StockAdjustment.objects.create(
+                            item=item,
+                            quantity=quantity,
+                            adjustment_type='Addition', # 'Transfer In'
+                            reason=f'Transfer from {source.name}',
+                            adjusted_by=request.user,
+                            adjusted_from=destination
+                        )
 
-                            remaining_qty -= take
-                        
                         messages.success(request, f"Successfully transferred {quantity} units of {item.name} from {source.name} to {destination.name}.")
                         return redirect('inventory:transfer_stock')
 
-                except Exception as e:
-                    messages.error(request, f"Transfer failed: {str(e)}")
+            except Exception as e:
+                messages.error(request, f"Transfer failed: {str(e)}")
 
     else:
         form = StockTransferForm()
 
-    # Get stock information for all items by department
-    stock_by_department = {}
-    departments = Departments.objects.all()
-    
-    for dept in departments:
-        stock_info = StockRecord.objects.filter(
-            current_location=dept,
-            quantity__gt=0
-        ).select_related('item', 'supplier').values(
-            'item_id',
-            'item__name',
-            'quantity'
-        ).annotate(
-            total_quantity=Sum('quantity')
-        ).order_by('item__name')
-        
-        stock_by_department[dept.id] = {
-            'name': dept.name,
-            'items': list(stock_info)
-        }
-
+    # The form fetches the source department's stock from stock_matrix
     return render(request, 'inventory/transfer_stock.html', {
         'form': form, 
         'title': 'Stock Transfer',
         'inventory_items': InventoryItem.objects.all().order_by('name'),
-        'stock_by_department': stock_by_department
     })
 
+def stock_matrix_etag(request):
+    """
+    Version of the stock matrix, from the StockLevel rows it is built from:
+    their count, total quantity and latest update for the requested location
+    (or any location). Ledger ids are assigned at insert, not commit, so a
+    change committed after a newer one would not move them; it does move the
+    total of the balances it changed.
+    """
+    location_id = request.GET.get('location_id', '')
+    levels = StockLevel.objects.filter(quantity__gt=0)
+    if location_id.isdigit():
+        levels = levels.filter(location_id=location_id)
+    else:
+        location_id = 'all'
+    version = levels.aggregate(rows=Count('id'), total=Sum('quantity'), latest=Max('updated_at'))
+    latest = version['latest'].timestamp() if version['latest'] else 0
+    return f"stock-matrix-{location_id}-{version['rows']}-{version['total'] or 0}-{latest}"
+
 @login_required
-def ipd_pharmacy_dashboard(request):
+@user_passes_test(is_pharmacist_or_admin)
+@condition(etag_func=stock_matrix_etag)
+def stock_matrix(request):
     """
-    Dashboard for pharmacists to dispense items to inpatients.
-    Shows pending partial fulfillments grouped by visit/patient.
+    Item x department stock on hand as JSON: {location_id: {item_id: quantity}},
+    optionally for one `location_id`. Built from one StockLevel query, cached
+    per ETag version and answered with 304 when the client's copy is current.
+    """
+    from django.core.cache import cache
+    from django.utils.cache import patch_cache_control
+
+    version = stock_matrix_etag(request)
+    matrix = cache.get(version)
+    if matrix is None:
+        levels = StockLevel.objects.filter(quantity__gt=0)
+        location_id = request.GET.get('location_id', '')
+        if location_id.isdigit():
+            levels = levels.filter(location_id=location_id)
+        matrix = {}
+        for location_id, item_id, quantity in levels.values_list('location_id', 'item_id', 'quantity'):
+            matrix.setdefault(location_id, {})[item_id] = quantity
+        cache.set(version, matrix, 60 * 60)
+
+    response = JsonResponse({'locations': matrix})
+    # Let the browser keep its copy but revalidate it on every use
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def ipd_queue_groups(search_query='', visit_ids=None, include_consumables=True):
+    """
+    Undispensed medication chart entries and inpatient consumables for
+    currently admitted patients, grouped by visit. `visit_ids` limits it to
+    some visits, which is how the live queue re-renders a single card.
     """
     from inpatient.models import MedicationChart, InpatientConsumable
-    from home.models import Departments
     from django.db.models import F
     from collections import OrderedDict
-    
-    # Pharmacist, Nurse, and Admin can access this page.
-    if request.user.role not in ['Pharmacist', 'Nurse', 'Admin'] and not request.user.is_superuser:
-        return HttpResponseForbidden("Access denied.")
 
-    # Identify and lock to the user's dispensing department.
-    user_dept = None
-    if request.user.role == 'Pharmacist':
-        user_dept = Departments.objects.filter(name='Pharmacy').first()
-    elif request.user.role == 'Nurse':
-        user_dept = Departments.objects.filter(name='Mini Pharmacy').first()
-    elif request.user.role == 'Admin' or request.user.is_superuser:
-        user_dept = Departments.objects.filter(name='Pharmacy').first()
-    
-    # Search filter
-    search_query = request.GET.get('q', '').strip()
-    
     # Fetch pending meds (only for currently admitted patients)
     pending_meds = MedicationChart.objects.filter(
         quantity_dispensed__lt=F('total_quantity'),
@@ -1362,7 +1430,7 @@ def ipd_pharmacy_dashboard(request):
     ).select_related('admission__patient', 'admission__visit', 'admission__bed__ward', 'item', 'request_location')
     
     # Fetch pending consumables (only for currently admitted patients) - restricted strictly to roles
-    if request.user.role in ['Pharmacist', 'Admin']:
+    if include_consumables:
         pending_consumables = InpatientConsumable.objects.filter(
             quantity_dispensed__lt=F('total_quantity'),
             admission__status='Admitted'
@@ -1370,6 +1438,10 @@ def ipd_pharmacy_dashboard(request):
     else:
         pending_consumables = InpatientConsumable.objects.none()
 
+    if visit_ids is not None:
+        pending_meds = pending_meds.filter(admission__visit_id__in=visit_ids)
+        pending_consumables = pending_consumables.filter(admission__visit_id__in=visit_ids)
+
     # Apply search filter — split into words so "John Doe" works
     if search_query:
         search_terms = search_query.split()
@@ -1408,6 +1480,38 @@ def ipd_pharmacy_dashboard(request):
             }
         visits_meds[key]['consumables'].append(con)
 
+    return visits_meds
+
+
+@login_required
+def ipd_pharmacy_dashboard(request):
+    """
+    Dashboard for pharmacists to dispense items to inpatients.
+    Shows pending partial fulfillments grouped by visit/patient.
+    """
+    from home.models import Departments
+
+    # Pharmacist, Nurse, and Admin can access this page.
+    if request.user.role not in ['Pharmacist', 'Nurse', 'Admin'] and not request.user.is_superuser:
+        return HttpResponseForbidden("Access denied.")
+
+    # Identify and lock to the user's dispensing department.
+    user_dept = None
+    if request.user.role == 'Pharmacist':
+        user_dept = Departments.objects.filter(name='Pharmacy').first()
+    elif request.user.role == 'Nurse':
+        user_dept = Departments.objects.filter(name='Mini Pharmacy').first()
+    elif request.user.role == 'Admin' or request.user.is_superuser:
+        user_dept = Departments.objects.filter(name='Pharmacy').first()
+    
+    # Search filter
+    search_query = request.GET.get('q', '').strip()
+    
+    visits_meds = ipd_queue_groups(
+        search_query,
+        include_consumables=request.user.role in ['Pharmacist', 'Admin'],
+    )
+
     total_pending_meds = sum(len(v['meds']) for v in visits_meds.values())
     total_pending_consumables = sum(len(v['consumables']) for v in visits_meds.values())
 
@@ -1441,6 +1545,8 @@ def ipd_pharmacy_dashboard(request):
         'mini_pharmacy_stock': mini_pharmacy_stock,
         'mini_pharmacy_requests': mini_pharmacy_requests,
         'search_query': search_query,
+        # The unfiltered queue is kept current over the pharmacy queue socket
+        'live_queue': not search_query and user_dept is not None,
         'title': 'IPD Pharmacy Fulfillment',
         'all_pharmacies': [user_dept] if user_dept else [],
         'locked_department': user_dept,
@@ -1458,8 +1564,6 @@ def confirm_ipd_fulfillment(request):
     from accounts.models import InvoiceItem
     from accounts.utils import get_or_create_invoice
     from home.models import Departments
-    from .models import StockRecord, StockAdjustment
-    from django.db.models import Sum
     
     item_type = request.POST.get('type') # 'med' or 'consumable'
     item_id = request.POST.get('id')
@@ -1499,41 +1603,16 @@ def confirm_ipd_fulfillment(request):
                  messages.error(request, "Admissions visit not found. Billing cannot proceed.")
                  return redirect('inventory:ipd_pharmacy_dashboard')
 
-            # 1. Check Stock
-            available_stock = StockRecord.objects.filter(
-                item=obj.item, 
-                current_location=department
-            ).aggregate(total=Sum('quantity'))['total'] or 0
-            
-            if available_stock < dispense_qty:
-                messages.error(request, f"Insufficient stock in {department.name}. Available: {available_stock}")
-                return redirect('inventory:ipd_pharmacy_dashboard')
-                
-            # 2. Deduct Stock (FEFO)
-            remaining_to_deduct = dispense_qty
-            batches = StockRecord.objects.filter(
-                item=obj.item, 
-                current_location=department, 
-                quantity__gt=0
-            ).order_by('expiry_date', 'received_date')
-            
-            for batch in batches:
-                if remaining_to_deduct <= 0: break
-                take = min(batch.quantity, remaining_to_deduct)
-                batch.quantity -= take
-                batch.save()
-                remaining_to_deduct -= take
-                
-            # 3. Create Stock Adjustment Record
-            StockAdjustment.objects.create(
-                item=obj.item,
-                quantity=-dispense_qty,
-                adjustment_type='Usage',
+            # 1-3. Check and deduct stock (FEFO) and log the adjustment
+            demand, = allocate_stock([StockDemand(
+                obj.item, dispense_qty, department,
                 reason=f'IPD Dispense: {admission.patient.full_name} (Admission #{admission.id})',
-                adjusted_by=request.user,
-                adjusted_from=department
-            )
-            
+            )], request.user)
+
+            if not demand.fulfilled:
+                messages.error(request, f"Insufficient stock in {department.name}. Available: {demand.available}")
+                return redirect('inventory:ipd_pharmacy_dashboard')
+
             # 4. Billing (Invoice Item)
             invoice = get_or_create_invoice(visit=visit, user=request.user)
             InvoiceItem.objects.create(
@@ -1562,15 +1641,17 @@ def confirm_ipd_fulfillment(request):
 @login_required
 def stock_activity(request):
     """
-    View to track how inventory has been used by patients.
-    Combines data from DispensedItem and StockAdjustment for a complete picture.
-    Includes filtering by item and date.
+    View to track how inventory has moved: receipts, transfers, dispensing and adjustments.
+    Reads the StockMovement ledger newest first, filtered by item, location and date,
+    one page at a time (`?before=<movement id>` cursor).
     """
     item_id = request.GET.get('item_id')
     item_search = request.GET.get('item_search', '').strip()
+    location_id = request.GET.get('location_id')
     from_date = request.GET.get('from_date')
     to_date = request.GET.get('to_date')
-    from django.db.models import Sum, Q
+    before = request.GET.get('before')
+    from django.db.models import Sum
     from datetime import datetime, time
 
     # Convert date strings to timezone-aware datetimes (avoids __date lookup issues on MySQL)
@@ -1587,80 +1668,57 @@ def stock_activity(request):
         except (ValueError, TypeError):
             to_dt = None
 
-    # --- 1. DispensedItem records (patient-linked dispensing) ---
-    dispensed_qs = DispensedItem.objects.all().select_related(
-        'item', 'patient', 'dispensed_by', 'department', 'visit'
-    )
-    if item_id:
-        dispensed_qs = dispensed_qs.filter(item_id=item_id)
+    movements_qs = StockMovement.objects.all()
+    if item_id and item_id.isdigit():
+        movements_qs = movements_qs.filter(item_id=item_id)
     elif item_search:
-        dispensed_qs = dispensed_qs.filter(item__name__icontains=item_search)
+        movements_qs = movements_qs.filter(item__name__icontains=item_search)
+    if location_id and location_id.isdigit():
+        movements_qs = movements_qs.filter(location_id=location_id)
     if from_dt:
-        dispensed_qs = dispensed_qs.filter(dispensed_at__gte=from_dt)
+        movements_qs = movements_qs.filter(created_at__gte=from_dt)
     if to_dt:
-        dispensed_qs = dispensed_qs.filter(dispensed_at__lte=to_dt)
-
-    # --- 2. StockAdjustment records (all stock movements) ---
-    adjustments_qs = StockAdjustment.objects.all().select_related(
-        'item', 'adjusted_by', 'adjusted_from'
+        movements_qs = movements_qs.filter(created_at__lte=to_dt)
+
+    # Keyset page: the ledger is append-only, so ids give a stable newest-first order
+    page_size = 100
+    page = movements_qs
+    if before and before.isdigit():
+        page = page.filter(id__lt=before)
+    activities = list(
+        page.select_related('item', 'location', 'user').order_by('-id')[:page_size + 1]
     )
-    if item_id:
-        adjustments_qs = adjustments_qs.filter(item_id=item_id)
-    elif item_search:
-        adjustments_qs = adjustments_qs.filter(item__name__icontains=item_search)
-    if from_dt:
-        adjustments_qs = adjustments_qs.filter(adjusted_at__gte=from_dt)
-    if to_dt:
-        adjustments_qs = adjustments_qs.filter(adjusted_at__lte=to_dt)
-
-    # --- 3. Merge into a unified activity list ---
-    activities = []
-
-    for d in dispensed_qs[:300]:
-        activities.append({
-            'timestamp': d.dispensed_at,
-            'item': d.item,
-            'quantity': d.quantity,
-            'type': 'Dispensed',
-            'patient': d.patient,
-            'department': d.department,
-            'user': d.dispensed_by,
-            'reason': f'Dispensed to {d.patient.full_name}' if d.patient else 'Dispensed',
-            'visit': d.visit,
-        })
-
-    for a in adjustments_qs[:300]:
-        activities.append({
-            'timestamp': a.adjusted_at,
-            'item': a.item,
-            'quantity': abs(a.quantity),
-            'type': a.adjustment_type,
-            'patient': None,
-            'department': a.adjusted_from,
-            'user': a.adjusted_by,
-            'reason': a.reason,
-            'visit': None,
-        })
-
-    # Sort by timestamp descending
-    activities.sort(key=lambda x: x['timestamp'], reverse=True)
-    activities = activities[:200]
+    next_cursor = activities[page_size - 1].id if len(activities) > page_size else None
+    activities = activities[:page_size]
 
-    # All items for the filter search
+    # All items and locations for the filters
     items = InventoryItem.objects.all().order_by('name')
+    locations = Departments.objects.all().order_by('name')
 
-    # Calculate Total Quantity if filtered by item
+    # Total consumed (dispensed or used) if filtered by item
     total_quantity = 0
     if item_id or item_search:
-        dispensed_total = dispensed_qs.aggregate(total=Sum('quantity'))['total'] or 0
-        adjustment_total = adjustments_qs.filter(quantity__lt=0).aggregate(total=Sum('quantity'))['total'] or 0
-        total_quantity = dispensed_total + abs(adjustment_total)
+        used = movements_qs.filter(movement_type__in=['Dispense', 'Usage']).aggregate(total=Sum('quantity'))['total'] or 0
+        total_quantity = abs(used)
+
+    # Point-in-time stock of the selected item at the selected location
+    balance_as_at = None
+    if item_id and item_id.isdigit() and location_id and location_id.isdigit():
+        balance_as_at = StockMovement.balance_at(int(item_id), int(location_id), to_dt or timezone.now())
+
+    query = request.GET.copy()
+    query.pop('before', None)
 
     context = {
         'activities': activities,
+        'next_cursor': next_cursor,
+        'filter_query': query.urlencode(),
         'total_quantity': total_quantity,
+        'balance_as_at': balance_as_at,
         'items': items,
+        'locations': locations,
         'selected_item_id': int(item_id) if item_id and item_id.isdigit() else None,
+        'selected_location_id': int(location_id) if location_id and location_id.isdigit() else None,
         'item_search': item_search,
         'from_date': from_date,
         'to_date': to_date,
@@ -1668,3 +1726,51 @@ def stock_activity(request):
     }
     return render(request, 'inventory/stock_activity.html', context)
 
+@login_required
+def expiry_report(request):
+    """
+    Expired and expiring batches per department with the value at risk,
+    read from the nightly ExpiringBatch table.
+    """
+    from datetime import timedelta
+
+    location_id = request.GET.get('location_id')
+    status = request.GET.get('status')
+    try:
+        days = min(max(int(request.GET.get('days', 90)), 0), 365)
+    except (TypeError, ValueError):
+        days = 90
+    horizon = timezone.localdate() + timedelta(days=days)
+
+    batches = ExpiringBatch.objects.filter(expiry_date__lte=horizon)
+    if status in ('Expired', 'Expiring'):
+        batches = batches.filter(status=status)
+
+    # Value at risk per department (before narrowing to one department)
+    departments = batches.values('location_id', 'location__name').annotate(
+        batch_count=Count('id'),
+        expired_value=Sum('value_at_risk', filter=Q(status='Expired')),
+        expiring_value=Sum('value_at_risk', filter=Q(status='Expiring')),
+        total_value=Sum('value_at_risk'),
+    ).order_by('-total_value')
+
+    if location_id and location_id.isdigit():
+        batches = batches.filter(location_id=location_id)
+    batches = batches.select_related('item', 'location')
+    totals = batches.aggregate(total_value=Sum('value_at_risk'), total_quantity=Sum('quantity'))
+
+    context = {
+        'batches': batches,
+        'departments': departments,
+        'total_value': totals['total_value'] or 0,
+        'total_quantity': totals['total_quantity'] or 0,
+        'computed_at': ExpiringBatch.objects.aggregate(latest=Max('computed_at'))['latest'],
+        'locations': Departments.objects.all().order_by('name'),
+        'selected_location_id': int(location_id) if location_id and location_id.isdigit() else None,
+        'status': status,
+        'days': days,
+        'today': timezone.localdate(),
+        'title': 'Expiry Report'
+    }
+    return render(request, 'inventory/expiry_report.html', context)
+
@@ -363,7 +363,7 @@ class Newborn(models.Model):
 
     def _handle_stock_reduction(self, old_instance):
         """Automated stock reduction from Mini Pharmacy"""
-        from inventory.models import InventoryItem, StockRecord, StockAdjustment, DispensedItem
+        from inventory.models import InventoryItem, StockRecord, StockAdjustment, DispensedItem, stock_movement
         from home.models import Departments
         from django.db import transaction
         from django.db.models import Sum
@@ -406,7 +406,8 @@ class Newborn(models.Model):
                             if remaining_to_deduct <= 0: break
                             deduction = min(batch.quantity, remaining_to_deduct)
                             batch.quantity -= deduction
-                            batch.save()
+                            with stock_movement('Dispense', f"Auto-dispensed to newborn baby of {self.delivery.pregnancy.patient.full_name}", self.created_by):
+                                batch.save()
                             remaining_to_deduct -= deduction
 
                         # 3. Log Adjustment
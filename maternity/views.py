@@ -430,72 +430,13 @@ def visit_queue_center(request):
     
     clinical_queue = process_maternity_queue(clinical_queue_raw)
 
-    # 2. Search Results: Broader search across all patients with robust multi-term search
+    # 2. Search Results: ranked search across all patients
     search_results = []
     if search_query:
-        from home.models import Patient
-        
-        # Split search query into individual terms
-        search_terms = search_query.strip().split()
-        
-        if search_terms:
-            # Start with base queryset
-            base_queryset = Patient.objects.all()
-            
-            # Build Q objects for each search term
-            term_q_objects = []
-            for term in search_terms:
-                if term.strip():
-                    term_q = Q() | Q(id_number__icontains=term) | Q(first_name__icontains=term) | Q(last_name__icontains=term) | Q(phone__icontains=term)
-                    
-                    # Check if term is a number for ID lookup
-                    if term.isdigit():
-                        term_q = term_q | Q(pk=int(term))
-                    
-                    term_q_objects.append(term_q)
-            
-            # Combine all term queries with AND (all terms must match somewhere)
-            combined_q = Q()
-            for term_q in term_q_objects:
-                combined_q = combined_q & term_q
-            
-            patients_queryset = base_queryset.filter(combined_q)
-            
-            # Rank results by relevance
-            # Higher priority for exact matches in first_name or last_name
-            # Then partial matches, then other fields
-            ranked_patients = []
-            for patient in patients_queryset:
-                relevance_score = 0
-                
-                for term in search_terms:
-                    term_lower = term.lower()
-                    
-                    # Exact match in first_name or last_name gets highest score
-                    if patient.first_name.lower() == term_lower or patient.last_name.lower() == term_lower:
-                        relevance_score += 100
-                    # Starts with gets high score
-                    elif patient.first_name.lower().startswith(term_lower) or patient.last_name.lower().startswith(term_lower):
-                        relevance_score += 50
-                    # Contains gets medium score
-                    elif term_lower in patient.first_name.lower() or term_lower in patient.last_name.lower():
-                        relevance_score += 25
-                    # ID or phone match gets lower score
-                    elif term_lower in str(patient.id_number).lower() or term_lower in str(patient.phone).lower():
-                        relevance_score += 10
-                    # PK match gets highest score
-                    elif term.isdigit() and patient.pk == int(term):
-                        relevance_score += 200
-                
-                ranked_patients.append((relevance_score, patient))
-            
-            # Sort by relevance score (descending) then by creation date
-            ranked_patients.sort(key=lambda x: (-x[0], x[1].created_at))
-            
-            # Extract just the patient objects and limit to 20 results
-            patients = [patient for score, patient in ranked_patients[:20]]
-        else:
-            patients = Patient.objects.none()
+        from home.utils import search_patients
+
+        # Best 20 matches from the patient search index
+        patients = search_patients(search_query, limit=20)
 
         for patient in patients:
             # Check if patient is currently in any maternity queues
@@ -881,7 +822,7 @@ def pregnancy_detail(request, pregnancy_id):
     ).order_by('name')
 
     # Get dispensed items history (Normalized from both InvoiceItem and DispensedItem)
-    from inventory.models import DispensedItem, StockRecord, StockAdjustment
+    from inventory.models import DispensedItem, StockRecord, StockAdjustment, stock_movement
     from accounts.models import Invoice, InvoiceItem
     
     today = timezone.now().date()
@@ -1027,7 +968,8 @@ def pregnancy_detail(request, pregnancy_id):
             if stock_record:
                 # Deduct Stock
                 stock_record.quantity -= d_item.quantity
-                stock_record.save()
+                with stock_movement('Dispense', f"Dispensed to {pregnancy.patient.full_name} (Maternity)", request.user):
+                    stock_record.save()
                 
                 # Create Stock Adjustment
                 StockAdjustment.objects.create(
@@ -2371,7 +2313,8 @@ def api_cwc_create_visit(request):
 @user_passes_test(is_pharmacist_or_admin)
 def maternity_free_dispensing(request):
     """View to dispense free items specifically to maternity patients, listing pending requests from nurses."""
-    from inventory.models import InventoryItem, DispensedItem, StockRecord, StockAdjustment
+    from inventory.models import InventoryItem, DispensedItem
+    from inventory.utils import StockDemand, allocate_stock
     from home.models import Departments
     from inpatient.models import InpatientConsumable
     from django.db.models import F
@@ -2430,30 +2373,15 @@ def maternity_free_dispensing(request):
                         return redirect('maternity:free_dispensing')
 
                     with transaction.atomic():
-                        # Deduct stock
-                        available_stock = StockRecord.objects.filter(
-                            item=item, 
-                            current_location=dept
-                        ).aggregate(total=Sum('quantity'))['total'] or 0
-                        
-                        if available_stock < dispense_qty:
-                            messages.error(request, f"Insufficient stock in {dept.name}. Available: {available_stock}")
+                        # Deduct stock (FEFO) and log the adjustment
+                        demand, = allocate_stock([StockDemand(
+                            item, dispense_qty, dept,
+                            reason=f'Free Maternity Dispense (Request) to {admission.patient.full_name}',
+                        )], request.user)
+
+                        if not demand.fulfilled:
+                            messages.error(request, f"Insufficient stock in {dept.name}. Available: {demand.available}")
                             return redirect('maternity:free_dispensing')
-                            
-                        remaining_to_deduct = dispense_qty
-                        batches = StockRecord.objects.filter(
-                            item=item, 
-                            current_location=dept, 
-                            quantity__gt=0
-                        ).order_by('expiry_date', 'received_date')
-                        
-                        for batch in batches:
-                            if remaining_to_deduct <= 0:
-                                break
-                            deduction = min(batch.quantity, remaining_to_deduct)
-                            batch.quantity -= deduction
-                            batch.save()
-                            remaining_to_deduct -= deduction
 
                         # Create DispensedItem (No Invoice Item = Free)
                         DispensedItem.objects.create(
@@ -2473,16 +2401,6 @@ def maternity_free_dispensing(request):
                             obj.dispensed_by = request.user
                         obj.save()
                         
-                        # Log Adjustment
-                        StockAdjustment.objects.create(
-                            item=item,
-                            quantity=-dispense_qty,
-                            adjustment_type='Usage',
-                            reason=f'Free Maternity Dispense (Request) to {admission.patient.full_name}',
-                            adjusted_by=request.user,
-                            adjusted_from=dept
-                        )
-                        
                         messages.success(request, f"Successfully dispensed {dispense_qty} {item.name} for free to {admission.patient.full_name}.")
             except Exception as e:
                 messages.error(request, f"Error: {str(e)}")
@@ -2508,30 +2426,15 @@ def maternity_free_dispensing(request):
                         return redirect('maternity:free_dispensing')
 
                     with transaction.atomic():
-                        # Deduct stock
-                        available_stock = StockRecord.objects.filter(
-                            item=item, 
-                            current_location=dept
-                        ).aggregate(total=Sum('quantity'))['total'] or 0
-                        
-                        if available_stock < quantity:
-                            messages.error(request, f"Insufficient stock in {dept.name}. Available: {available_stock}")
+                        # Deduct stock (FEFO) and log the adjustment
+                        demand, = allocate_stock([StockDemand(
+                            item, quantity, dept,
+                            reason=f'Free Maternity Dispense (Direct) to {admission.patient.full_name}',
+                        )], request.user)
+
+                        if not demand.fulfilled:
+                            messages.error(request, f"Insufficient stock in {dept.name}. Available: {demand.available}")
                             return redirect('maternity:free_dispensing')
-                            
-                        remaining_to_deduct = quantity
-                        batches = StockRecord.objects.filter(
-                            item=item, 
-                            current_location=dept, 
-                            quantity__gt=0
-                        ).order_by('expiry_date', 'received_date')
-                        
-                        for batch in batches:
-                            if remaining_to_deduct <= 0:
-                                break
-                            deduction = min(batch.quantity, remaining_to_deduct)
-                            batch.quantity -= deduction
-                            batch.save()
-                            remaining_to_deduct -= deduction
 
                         # Create DispensedItem
                         DispensedItem.objects.create(
@@ -2543,16 +2446,6 @@ def maternity_free_dispensing(request):
                             department=dept
                         )
                         
-                        # Log Adjustment
-                        StockAdjustment.objects.create(
-                            item=item,
-                            quantity=-quantity,
-                            adjustment_type='Usage',
-                            reason=f'Free Maternity Dispense (Direct) to {admission.patient.full_name}',
-                            adjusted_by=request.user,
-                            adjusted_from=dept
-                        )
-                        
                         messages.success(request, f"Successfully dispensed {quantity} {item.name} for free to {admission.patient.full_name}.")
             except Exception as e:
                 messages.error(request, f"Error: {str(e)}")